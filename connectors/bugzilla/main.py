@@ -1,10 +1,113 @@
+import time
 from datetime import datetime
-from typing import Any, Dict
+from urllib.parse import urlencode
 
-import bugzilla
+from runtime.cache import TTLCache
+from runtime.concurrency import map_concurrent
+from runtime.deadline import TimeBudget
+from runtime.hashing import fingerprint
+from runtime.metrics import STATE_KEY as METRICS_STATE_KEY
+from runtime.metrics import instrumented
+from runtime.paging import STATE_KEY as PAGE_SIZES_STATE_KEY
+from runtime.paging import AdaptivePageSize
+from runtime.ratelimit import configure_host
+from runtime.response import ResponseWriter
+from runtime.session import get_session
+from runtime.watermark import STATE_KEY as HIGH_WATER_MARK_STATE_KEY
+from runtime.watermark import HighWaterMark
 
+# max. number of products whose components are fetched at the same time
+DEFAULT_COMPONENT_CONCURRENCY = 8
+# number of seconds component details are cached for across warm invocations
+DEFAULT_COMPONENT_CACHE_TTL = 3600
+# number of seconds a logged in client is reused for across warm invocations
+CLIENT_CACHE_TTL = 3600
+# max. number of bugs whose history or comments are fetched in a single request
+DEFAULT_RELATED_BATCH_SIZE = 100
+# max. number of history and comment requests sent at the same time
+DEFAULT_RELATED_CONCURRENCY = 4
+# number of time slices the range of a backfill is split into
+DEFAULT_BACKFILL_PARTITIONS = 16
+# max. number of partitions of a sync whose bugs are fetched at the same time
+DEFAULT_PARTITION_CONCURRENCY = 4
+# max. length of the product and component parameters of a single bug search
+DEFAULT_MAX_QUERY_LENGTH = 2000
 
-def main(request):
+# number of seconds before the latest change of a sync that the next sync starts at,
+# for bugs whose changes become visible late
+DEFAULT_CURSOR_OVERLAP = 60
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+# format of since_id in the state of earlier versions
+LEGACY_TIMESTAMP_FORMAT = "%Y-%m-%dT%H-%M-%SZ"
+
+KEYSET_PAGINATION = "keyset"
+OFFSET_PAGINATION = "offset"
+
+# Columns of the synced tables. Field names match the ones returned by the Bugzilla
+# REST API, which allows requesting just these fields and copying them as-is into rows.
+TABLES = {
+    "products": {
+        "primary_key": ["name"],
+        "columns": ["name"],
+    },
+    "components": {
+        "primary_key": ["id", "name"],
+        "columns": ["name", "id", "default_qa_contact", "is_active", "description"],
+    },
+    "bugs": {
+        "primary_key": ["id"],
+        "columns": [
+            "id",
+            "summary",
+            "assigned_to",
+            "creation_time",
+            "status",
+            "last_change_time",
+            "creator",
+            "product",
+            "component",
+        ],
+    },
+    # one row per changed field, entries of attachments carry their attachment ID
+    "bug_history": {
+        "primary_key": ["bug_id", "when", "who", "field_name", "attachment_id"],
+        "columns": [
+            "bug_id",
+            "when",
+            "who",
+            "field_name",
+            "removed",
+            "added",
+            "attachment_id",
+        ],
+    },
+    "comments": {
+        "primary_key": ["id"],
+        "columns": [
+            "id",
+            "bug_id",
+            "count",
+            "creator",
+            "creation_time",
+            "time",
+            "text",
+            "is_private",
+            "attachment_id",
+        ],
+    },
+}
+
+SCHEMA = {table: {"primary_key": spec["primary_key"]} for table, spec in TABLES.items()}
+
+# components per (Bugzilla URL, product), kept for as long as the instance is warm
+_components_cache = TTLCache(ttl=DEFAULT_COMPONENT_CACHE_TTL)
+# logged in clients per (Bugzilla URL, API key)
+_clients = TTLCache(ttl=CLIENT_CACHE_TTL)
+
+
+@instrumented("bugzilla")
+def main(request, metrics):
     """
     Function to execute.
 
@@ -15,118 +118,655 @@ def main(request):
     """
     # authenticate to Bugzilla API
     config = request.json["secrets"]
-    bzapi = bugzilla.Bugzilla(config["url"], api_key=config["api_key"])
+    budget = TimeBudget.from_config(config.get("time_budget"))
+    # requests are paced and throttled ones retried, optionally with custom limits
+    configure_host(config["url"], config.get("rate_limit"))
+    with metrics.phase("auth"):
+        bzapi = get_client(config["url"], config["api_key"])
 
-    if not bzapi.logged_in:
-        raise ValueError("Could not connect to Bugzilla.")
-
-    # get product data
-    products_data = [
-        {"name": product} for product in config["products"]
-    ]
+    with metrics.phase("discovery"):
+        components_by_product = fetch_components_by_product(bzapi, config)
+    products_data, components_data = metadata_rows(config, components_by_product)
 
-    # get component data
-    products = config["products"]
-    components_data = [
-        {
-            "name": component["name"],
-            "id": component["id"],
-            "default_qa_contact": component["default_qa_contact"],
-            "is_active": component["is_active"],
-            "description": component["description"],
-        }
-        for product in products
-        for _, component in bzapi.getcomponentsdetails(product).items()
-    ]
+    # products and components rarely change, so only send them to Fivetran if
+    # they differ from what has been sent in a previous run
+    metadata_fingerprint = fingerprint(
+        {"products": products_data, "components": components_data}
+    )
+    metadata_changed = (
+        request.json["state"].get("metadata_fingerprint") != metadata_fingerprint
+    )
 
-    # since_id is based on the last date the import ran
+    # since_id is based on the latest change of a bug seen by the last import
     # only fetch bugs that have been updated since then
     since_id = None
     if "since_id" in request.json["state"]:
-        since_id = request.json["state"]["since_id"]
+        since_id = normalize_timestamp(request.json["state"]["since_id"])
 
     if since_id is None:
         # if this is the first time the connector is executed
         # limit the max. of data to be queried
         since_id = config["max_date"]
 
-    # check if the invokation happened because a previous run indicated
-    # that there is more data available
-    offset = 1
-    if "offset" in request.json["state"]:
-        offset = request.json["state"]["offset"]
+    # bug_limit is used as is unless adaptive page sizing is configured
+    page_size_config = config.get("page_size")
+    page_size = AdaptivePageSize.from_config(
+        page_size_config,
+        request.json["state"].get(PAGE_SIZES_STATE_KEY, {}).get("bugs"),
+        int(config["bug_limit"]),
+    )
+    pagination = config.get("pagination", KEYSET_PAGINATION)
+    if pagination not in (KEYSET_PAGINATION, OFFSET_PAGINATION):
+        raise ValueError(f"Unsupported pagination mode: {pagination}")
 
     # query bugs from all available products and components
-    # sort product and component names to ensure the same query is executed in 
+    # sort product and component names to ensure the same query is executed in
     # subsequent runs
     sorted_products = sorted([product["name"] for product in products_data])
     sorted_components = sorted([component["name"] for component in components_data])
-    query = bzapi.build_query(
-        product=sorted_products,
-        component=sorted_components,
-        limit=config["bug_limit"]
+    base_query = bzapi.build_query(product=sorted_products, component=sorted_components)
+    base_query["last_change_time"] = since_id
+    base_query["include_fields"] = ",".join(TABLES["bugs"]["columns"])
+
+    # history and comments of changed bugs are only synced if configured, every table
+    # only requests entries since the cursor of bugs after its last complete sync
+    related_tables = config.get("related_tables", [])
+    unsupported = set(related_tables) - set(RELATED_TABLES)
+    if unsupported:
+        raise ValueError(f"Unsupported related tables: {sorted(unsupported)}")
+    related_since = {
+        table: request.json["state"].get("related_since", {}).get(table)
+        or config["max_date"]
+        for table in related_tables
+    }
+    # the next since_id is taken from the latest change seen, bugs in the overlap with
+    # the previous sync are skipped if they haven't changed since
+    watermark = HighWaterMark.from_state(
+        request.json["state"].get(HIGH_WATER_MARK_STATE_KEY),
+        float(config.get("cursor_overlap", DEFAULT_CURSOR_OVERLAP)),
     )
-    query["last_change_time"] = since_id
-    query["offset"] = offset
-
-    bugs = bzapi.query(query)
-
-    bug_data = [
-        {
-            "id": bug.id,
-            "summary": bug.summary,
-            "assigned_to": bug.assigned_to,
-            "creation_time": bug.creation_time,
-            "status": bug.status,
-            "last_change_time": bug.last_change_time,
-            "creator": bug.creator,
-            "product": bug.product,
-            "component": bug.component,
-        }
-        for bug in bugs
+
+    # check if the invokation happened because a previous run indicated
+    # that there is more data available
+    cursor = request.json["state"].get("cursor")
+    offset = request.json["state"].get("offset", 0)
+
+    # Optionally the sync is split into partitions that are fetched concurrently: per
+    # product or chunk of components with `query_plan`, and into time slices on the
+    # first sync with `backfill`. Every partition pages with its own keyset cursor.
+    plan = request.json["state"].get("plan")
+    query_plan_config = config.get("query_plan")
+    backfill_config = None
+    if "since_id" not in request.json["state"]:
+        backfill_config = config.get("backfill")
+    if plan is None and (query_plan_config is not None or backfill_config is not None):
+        queries = [{}]
+        if query_plan_config is not None:
+            queries = plan_queries(
+                components_by_product,
+                query_plan_config.get("components_per_query"),
+                int(
+                    query_plan_config.get("max_query_length", DEFAULT_MAX_QUERY_LENGTH)
+                ),
+            )
+        slices = 1
+        if backfill_config is not None:
+            slices = int(backfill_config.get("partitions", DEFAULT_BACKFILL_PARTITIONS))
+        plan = plan_partitions(queries, since_id, upstream_time(bzapi, config), slices)
+
+    # Rows are written to the response page by page. With `serialize_response` they're
+    # serialized right away, so rows of previous pages aren't kept as dicts. Only
+    # serialized rows have a known size, which budgets and page sizes rely on.
+    serialize = config.get(
+        "serialize_response", budget is not None or page_size_config is not None
+    )
+    writer = ResponseWriter(SCHEMA, serialize=serialize)
+
+    # without a time budget a single page is fetched per invocation
+    while plan is None:
+        bug_limit = page_size.size
+        query = dict(base_query, limit=bug_limit)
+        if pagination == KEYSET_PAGINATION:
+            add_keyset_condition(query, cursor)
+        else:
+            query["offset"] = offset
+
+        start = time.monotonic()
+        with metrics.phase("fetch"):
+            bugs, new_bugs, related = fetch_page(
+                bzapi, config, query, related_since, watermark
+            )
+        page_seconds = time.monotonic() - start
+
+        with metrics.phase("transform"):
+            page_bytes = write_page(writer, metrics, new_bugs, related)
+        page_size.observe(len(bugs), page_seconds, page_bytes)
+        watermark.observe(bugs, "id", "last_change_time")
+
+        # check if there is more data
+        hasMore = len(bugs) == bug_limit
+        last_bug = bugs[-1] if bugs else None
+        # drop the decoded page, its rows have been written to the response
+        del bugs, new_bugs, related
+        if hasMore:
+            cursor = {
+                "last_change_time": last_bug["last_change_time"],
+                "id": last_bug["id"],
+            }
+            offset += bug_limit
+
+        if budget is None or not hasMore:
+            break
+        budget.add_bytes(page_bytes)
+        if not budget.allows_another_page(page_seconds, page_bytes):
+            break
+
+    if plan is not None:
+        hasMore = run_partitions(
+            bzapi,
+            config,
+            base_query,
+            plan,
+            page_size,
+            budget,
+            related_since,
+            watermark,
+            writer,
+            metrics,
+        )
+
+    state = {"since_id": since_id, "metadata_fingerprint": metadata_fingerprint}
+    if page_size_config is not None:
+        state[PAGE_SIZES_STATE_KEY] = {"bugs": page_size.to_state()}
+
+    if hasMore:
+        if plan is not None:
+            state["plan"] = plan
+        elif pagination == KEYSET_PAGINATION:
+            state["cursor"] = cursor
+        else:
+            state["offset"] = offset
+        if related_tables:
+            state["related_since"] = related_since
+    else:
+        # the next sync picks up the bugs that changed since the latest change seen.
+        # New history entries and comments change their bug, so they are requested
+        # from the same point in Bugzilla's time, rather than the function's.
+        state["since_id"] = watermark.cursor(since_id)
+        if related_tables:
+            state["related_since"] = {
+                table: watermark.cursor(since) for table, since in related_since.items()
+            }
+    state[HIGH_WATER_MARK_STATE_KEY] = watermark.to_state(finished=not hasMore)
+
+    if metadata_changed:
+        for table, rows in (
+            ("products", products_data),
+            ("components", components_data),
+        ):
+            metrics.add_rows(table, len(rows), writer.write_rows(table, rows))
+
+    if config.get("metrics_in_state", False):
+        state[METRICS_STATE_KEY] = metrics.summary()
+
+    with metrics.phase("serialize"):
+        return writer.finish(state, hasMore=hasMore)
+
+
+def get_client(url, api_key):
+    """
+    Return a logged in Bugzilla client, reusing the one of previous warm invocations.
+
+    Connecting checks the Bugzilla version and the login, which takes two requests.
+    python-bugzilla is imported here rather than at module scope to keep it out of
+    the module import of cold starts.
+    """
+
+    def connect():
+        import bugzilla
+
+        # python-bugzilla modifies session headers, so it gets its own pooled session
+        bzapi = bugzilla.Bugzilla(
+            url, api_key=api_key, requests_session=get_session("bugzilla")
+        )
+        if not bzapi.logged_in:
+            raise ValueError("Could not connect to Bugzilla.")
+        return bzapi
+
+    return _clients.get_or_set((url, api_key), connect)
+
+
+def fetch_components_by_product(bzapi, config):
+    """Return the components of every product, fetched concurrently and cached."""
+    products = config["products"]
+    concurrency = int(
+        config.get("component_concurrency", DEFAULT_COMPONENT_CONCURRENCY)
+    )
+    cache_ttl = float(config.get("component_cache_ttl", DEFAULT_COMPONENT_CACHE_TTL))
+    return dict(
+        zip(
+            products,
+            map_concurrent(
+                lambda product: _components_cache.get_or_set(
+                    (config["url"], product),
+                    lambda: fetch_components(bzapi, product),
+                    ttl=cache_ttl,
+                ),
+                products,
+                max_workers=concurrency,
+            ),
+        )
+    )
+
+
+def metadata_rows(config, components_by_product):
+    """Return the rows of the products and components tables."""
+    products_data = [{"name": product} for product in config["products"]]
+    components_data = [
+        component
+        for product_components in components_by_product.values()
+        for component in product_components
     ]
+    return products_data, components_data
+
 
-    # check if there is more data
-    if len(bugs) == config["bug_limit"]:
-        hasMore = True
+def fetch_components(bzapi, product):
+    """
+    Fetch the components of a single product.
+
+    This uses `product_get` rather than `getcomponentsdetails` since the latter updates
+    the product cache of `bzapi`, which isn't safe to do from multiple threads.
+    """
+    component_columns = TABLES["components"]["columns"]
+    components = [
+        {column: component[column] for column in component_columns}
+        for product_details in bzapi.product_get(
+            names=[product], include_fields=["name", "id", "components"]
+        )
+        for component in product_details["components"]
+    ]
+    return sorted(components, key=lambda component: component["name"])
+
+
+def search_bugs(bzapi, config, query):
+    """
+    Search for bugs and return the raw bug JSON objects returned by the REST API.
+
+    `bzapi.query()` would turn every result into a `Bug` object, which is expensive
+    for large pages and not needed since rows are built straight from the JSON.
+    """
+    return get_json(bzapi, config, "/bug", query)["bugs"]
+
+
+def upstream_time(bzapi, config):
+    """Return the current time of the Bugzilla database in TIMESTAMP_FORMAT."""
+    # bugs are timestamped by the database, whose clock can differ from the function's
+    return normalize_timestamp(get_json(bzapi, config, "/time", {})["db_time"])
+
+
+def get_json(bzapi, config, path, params):
+    """Send a GET request to the REST API path `path` and return the JSON result."""
+    url = bzapi.url.rstrip("/") + path
+    # the key is sent as a header, since URLs end up in error messages and logs
+    http_response = bzapi.get_requests_session().get(
+        url, params=params, headers={"X-BUGZILLA-API-KEY": config["api_key"]}
+    )
+    if not http_response.ok:
+        # Bugzilla explains errors in a JSON body, which raise_for_status drops
+        try:
+            result = http_response.json()
+        except ValueError:
+            result = None
+        if not isinstance(result, dict) or not result.get("message"):
+            http_response.raise_for_status()
     else:
-        hasMore = False
-        since_id = datetime.now().strftime("%Y-%m-%dT%H-%M-%SZ")
+        result = http_response.json()
 
-    state = {"since_id": since_id, "offset": offset + 1}
+    if result.get("error") or not http_response.ok:
+        import bugzilla
 
-    schema = {
-        "products": {
-            "primary_key": ["name"],
-        },
-        "components": {"primary_key": ["id", "name"]},
-        "bugs": {"primary_key": ["id"]},
-    }
+        raise bugzilla.BugzillaError(
+            f"{result.get('message')} (HTTP {http_response.status_code} from {path})",
+            code=result.get("code"),
+        )
+    return result
+
+
+def fetch_page(bzapi, config, query, related_since, watermark):
+    """
+    Fetch a page of bugs matching `query` and the rows of their related tables.
 
-    return response(
-        state,
-        schema=schema,
-        inserts={
-            "products": products_data,
-            "components": components_data,
-            "bugs": bug_data,
-        },
-        hasMore=hasMore,
+    Returns the page, the bugs of it that haven't been synced in the overlap with the
+    previous sync, and the related rows of those.
+    """
+    bugs = search_bugs(bzapi, config, query)
+    new_bugs = [
+        bug for bug in bugs if watermark.is_new(bug["id"], bug["last_change_time"])
+    ]
+    related = fetch_related(
+        bzapi, config, [bug["id"] for bug in new_bugs], related_since
     )
+    return bugs, new_bugs, related
 
 
-def response(
-    state: Dict[str, Any],
-    schema: Dict[Any, Any],
-    inserts: Dict[Any, Any] = {},
-    deletes: Dict[Any, Any] = {},
-    hasMore: bool = False,
-):
-    """Creates the response JSON object that will be processed by Fivetran."""
+def write_page(writer, metrics, bugs, related):
+    """Write a page of bugs and their related rows to the response, return its size."""
+    bug_columns = TABLES["bugs"]["columns"]
+    bug_bytes = writer.write_rows(
+        "bugs", ({column: bug.get(column) for column in bug_columns} for bug in bugs)
+    )
+    metrics.add_rows("bugs", len(bugs), bug_bytes)
+    # history and comments count towards the page, which they are part of
+    page_bytes = bug_bytes
+    for table, records in related.items():
+        table_bytes = writer.write_records(table, TABLES[table]["columns"], records)
+        metrics.add_rows(table, len(records), table_bytes)
+        page_bytes += table_bytes
+    return page_bytes
+
+
+def normalize_timestamp(timestamp):
+    """Return `timestamp` in TIMESTAMP_FORMAT, converting it from the legacy format."""
+    try:
+        return datetime.strptime(timestamp, LEGACY_TIMESTAMP_FORMAT).strftime(
+            TIMESTAMP_FORMAT
+        )
+    except ValueError:
+        return timestamp
+
+
+def plan_queries(components_by_product, components_per_query, max_query_length):
+    """
+    Split the bug search into a query per product, or per chunk of its components.
+
+    Unlike a single query for all products and the union of their components, every
+    query only matches a single product. Components are only listed if a product is
+    split into chunks of at most `components_per_query` components, and chunks are
+    kept within `max_query_length` characters of URL parameters.
+    """
+    queries = []
+    for product, components in components_by_product.items():
+        if not components_per_query or not components:
+            queries.append({"product": product})
+            continue
+
+        chunk = []
+        for name in sorted(component["name"] for component in components):
+            if chunk and (
+                len(chunk) == int(components_per_query)
+                or query_length(product, chunk + [name]) > max_query_length
+            ):
+                queries.append({"product": product, "components": chunk})
+                chunk = []
+            chunk.append(name)
+        queries.append({"product": product, "components": chunk})
+    return queries
+
+
+def query_length(product, components):
+    """Return the length of the URL parameters selecting `product` and `components`."""
+    return len(urlencode({"product": product, "component": components}, doseq=True))
+
+
+def plan_partitions(queries, start, end, slices):
+    """
+    Partition the sync of bugs changed in [`start`, `end`) by `queries` and time.
+
+    The range is split into `slices` time slices of equal length, and every slice is
+    synced for every query.
+    """
+    start_time = datetime.strptime(start, TIMESTAMP_FORMAT)
+    end_time = datetime.strptime(end, TIMESTAMP_FORMAT)
+    step = (end_time - start_time) / slices
+    bounds = [start_time + step * i for i in range(slices)] + [end_time]
     return {
-        "state": state,
-        "schema": schema,
-        "insert": inserts,
-        "delete": deletes,
-        "hasMore": hasMore,
+        "partitions": [
+            {
+                **query,
+                "start": slice_start.strftime(TIMESTAMP_FORMAT),
+                "end": slice_end.strftime(TIMESTAMP_FORMAT),
+                "cursor": None,
+                "done": False,
+            }
+            for query in queries
+            for slice_start, slice_end in zip(bounds, bounds[1:])
+        ],
     }
+
+
+def backfill_partitions(config, count):
+    """
+    Return the initial states of `count` partitions for `fivetran connector backfill`.
+
+    Every partition syncs the bugs changed in a time slice between `max_date` and the
+    current time of the Bugzilla database. Products and components aren't split by time,
+    so only the first partition sends them: the others start with their fingerprint.
+    """
+    bzapi = get_client(config["url"], config["api_key"])
+    until = upstream_time(bzapi, config)
+    plan = plan_partitions([{}], config["max_date"], until, count)
+    products_data, components_data = metadata_rows(
+        config, fetch_components_by_product(bzapi, config)
+    )
+    metadata_fingerprint = fingerprint(
+        {"products": products_data, "components": components_data}
+    )
+    states = []
+    for number, partition in enumerate(plan["partitions"]):
+        state = {"plan": {"partitions": [partition]}}
+        if number > 0:
+            state["metadata_fingerprint"] = metadata_fingerprint
+        states.append(state)
+    return states
+
+
+def backfill_state(states):
+    """Return the state that incremental syncs continue a backfill from."""
+    # the partition with the latest changes determines where the next sync starts
+    return max(states, key=lambda state: state["since_id"])
+
+
+def partition_query(base_query, partition, limit):
+    """Return the query for the next page of bugs of `partition`."""
+    query = dict(base_query, limit=limit, last_change_time=partition["start"])
+    if "product" in partition:
+        query["product"] = [partition["product"]]
+        query.pop("component", None)
+        if partition.get("components"):
+            query["component"] = partition["components"]
+    add_keyset_condition(query, partition["cursor"])
+    add_chart_condition(query, "delta_ts", "lessthan", partition["end"])
+    return query
+
+
+def run_partitions(
+    bzapi,
+    config,
+    base_query,
+    plan,
+    page_size,
+    budget,
+    related_since,
+    watermark,
+    writer,
+    metrics,
+):
+    """
+    Fetch pages of the unfinished partitions of `plan`, return if any are left.
+
+    Every partition pages through its bugs with its own keyset cursor, which is kept
+    in `plan`. Pages of up to `concurrency` partitions are fetched at the same time, in
+    rounds for as long as the time budget allows.
+    """
+    concurrency = DEFAULT_PARTITION_CONCURRENCY
+    for key in ("backfill", "query_plan"):
+        concurrency = int((config.get(key) or {}).get("concurrency", concurrency))
+
+    def fetch_partition(partition):
+        query = partition_query(base_query, partition, bug_limit)
+        start = time.monotonic()
+        bugs, new_bugs, related = fetch_page(
+            bzapi, config, query, related_since, watermark
+        )
+        return bugs, new_bugs, related, time.monotonic() - start
+
+    while True:
+        partitions = [p for p in plan["partitions"] if not p["done"]][:concurrency]
+        if not partitions:
+            return False
+        bug_limit = page_size.size
+
+        start = time.monotonic()
+        with metrics.phase("fetch"):
+            pages = map_concurrent(fetch_partition, partitions, max_workers=concurrency)
+        round_seconds = time.monotonic() - start
+
+        round_bytes = 0
+        for partition, (bugs, new_bugs, related, page_seconds) in zip(
+            partitions, pages
+        ):
+            with metrics.phase("transform"):
+                page_bytes = write_page(writer, metrics, new_bugs, related)
+            page_size.observe(len(bugs), page_seconds, page_bytes)
+            watermark.observe(bugs, "id", "last_change_time")
+            round_bytes += page_bytes
+
+            if len(bugs) == bug_limit:
+                partition["cursor"] = {
+                    "last_change_time": bugs[-1]["last_change_time"],
+                    "id": bugs[-1]["id"],
+                }
+            else:
+                partition["done"] = True
+        # drop the decoded pages, their rows have been written to the response
+        del pages, bugs, new_bugs, related
+
+        if all(partition["done"] for partition in plan["partitions"]):
+            return False
+        if budget is None:
+            return True
+        budget.add_bytes(round_bytes)
+        if not budget.allows_another_page(round_seconds, round_bytes):
+            return True
+
+
+def fetch_related(bzapi, config, bug_ids, related_since):
+    """
+    Fetch the rows of the related tables in `related_since` for bugs with `bug_ids`.
+
+    Rows are returned as tuples of the values of the table's columns, which take less
+    memory than dicts while the batches of a page are being fetched.
+
+    python-bugzilla requests the history or comments of every bug separately, whereas
+    the REST API accepts many bug IDs per request. IDs are therefore sent in batches,
+    and the batches of all tables are fetched concurrently.
+    """
+    batch_size = int(config.get("related_batch_size", DEFAULT_RELATED_BATCH_SIZE))
+    concurrency = int(config.get("related_concurrency", DEFAULT_RELATED_CONCURRENCY))
+    batches = [
+        (table, bug_ids[i : i + batch_size])
+        for table in related_since
+        for i in range(0, len(bug_ids), batch_size)
+    ]
+    results = map_concurrent(
+        lambda batch: RELATED_TABLES[batch[0]](
+            bzapi, config, batch[1], related_since[batch[0]]
+        ),
+        batches,
+        max_workers=concurrency,
+    )
+
+    rows = {table: [] for table in related_since}
+    for (table, _), batch_rows in zip(batches, results):
+        rows[table].extend(batch_rows)
+    return rows
+
+
+def fetch_bug_history(bzapi, config, bug_ids, since):
+    """Fetch the history of the bugs with `bug_ids` since `since`, one row per change."""
+    # the path needs a bug ID, further bugs are passed as `ids`
+    result = get_json(
+        bzapi,
+        config,
+        f"/bug/{bug_ids[0]}/history",
+        {"ids": bug_ids[1:], "new_since": since},
+    )
+    return [
+        (
+            bug["id"],
+            entry["when"],
+            entry["who"],
+            change["field_name"],
+            change.get("removed"),
+            change.get("added"),
+            # part of the primary key, so changes of the bug itself get 0
+            change.get("attachment_id", 0),
+        )
+        for bug in result["bugs"]
+        for entry in bug["history"]
+        for change in entry["changes"]
+    ]
+
+
+def fetch_comments(bzapi, config, bug_ids, since):
+    """Fetch the comments of the bugs with `bug_ids` created after `since`."""
+    result = get_json(
+        bzapi,
+        config,
+        f"/bug/{bug_ids[0]}/comment",
+        {"ids": bug_ids[1:], "new_since": since},
+    )
+    comment_columns = TABLES["comments"]["columns"]
+    return [
+        tuple(comment.get(column) for column in comment_columns)
+        for bug in result["bugs"].values()
+        for comment in bug["comments"]
+    ]
+
+
+# tables with data of individual bugs and the functions fetching them
+RELATED_TABLES = {
+    "bug_history": fetch_bug_history,
+    "comments": fetch_comments,
+}
+
+
+def add_keyset_condition(query, cursor):
+    """
+    Restrict `query` to bugs that come after `cursor` in (last_change_time, id) order.
+
+    Bugs are sorted by last change time and ID so that every page picks up right
+    where the previous one ended, which keeps the cost per page constant and doesn't
+    skip or duplicate bugs that change while paging through the results.
+    """
+    query["order"] = "changeddate,bug_id"
+    if cursor is None:
+        return
+
+    query["query_format"] = "advanced"
+    # (last_change_time > t) OR (last_change_time = t AND id > id)
+    conditions = [
+        ("OP", None, None),
+        ("delta_ts", "greaterthan", cursor["last_change_time"]),
+        ("OP", None, None),
+        ("delta_ts", "equals", cursor["last_change_time"]),
+        ("bug_id", "greaterthan", cursor["id"]),
+        ("CP", None, None),
+        ("CP", None, None),
+    ]
+    query["j1"] = "OR"
+    for i, (field, operator, value) in enumerate(conditions, start=1):
+        query[f"f{i}"] = field
+        if operator is not None:
+            query[f"o{i}"] = operator
+            query[f"v{i}"] = value
+
+
+def add_chart_condition(query, field, operator, value):
+    """Add a condition to the custom search of `query`, ANDed with the existing ones."""
+    used = [int(key[1:]) for key in query if key[:1] == "f" and key[1:].isdigit()]
+    i = max(used, default=0) + 1
+    query["query_format"] = "advanced"
+    query[f"f{i}"] = field
+    query[f"o{i}"] = operator
+    query[f"v{i}"] = value
@@ -0,0 +1,8 @@
+"""
+Shared runtime for custom Fivetran connectors.
+
+This package is vendored into every connector directory (see `tools/connector.py`)
+since Cloud Functions are deployed from a single connector directory and can't import
+code from elsewhere in this repository. Connectors import from the submodules directly,
+e.g. `from runtime.session import get_session`.
+"""
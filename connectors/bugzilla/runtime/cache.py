@@ -0,0 +1,52 @@
+"""
+In-process caches that survive across invocations of a warm function instance.
+
+Values are only kept in memory, so every cold start begins with an empty cache.
+"""
+
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """Thread-safe key-value cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, ttl: float, clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self._clock = clock
+        self._entries: Dict[Hashable, Tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached value for `key` or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= self._clock():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Cache `value` for `key`, optionally overriding the default TTL."""
+        expires_at = self._clock() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+
+    def get_or_set(
+        self, key: Hashable, factory: Callable[[], Any], ttl: Optional[float] = None
+    ) -> Any:
+        """Return the cached value for `key`, computing it with `factory` on a miss."""
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.set(key, value, ttl)
+        return value
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,112 @@
+"""
+Conditional requests for connectors that do a full import on every sync.
+
+Most pages of a full import are the same as in the previous sync. A `PageCache` keeps
+the validators the upstream sent for every page (`ETag` and `Last-Modified`) together
+with a hash of the page, the primary keys of its rows and the stream state after it.
+Pages are requested with `If-None-Match` and `If-Modified-Since`, and if the upstream
+answers `304 Not Modified`, the page neither needs to be downloaded nor its rows sent
+to Fivetran again. Upstreams that don't support validators still send the page, but if
+its hash is unchanged its rows aren't sent either.
+
+Caches are kept in the same stores as row digests, see `runtime.changes`. A cache must
+only be used once Fivetran has committed the rows of the response that filled it, or a
+retried invocation would skip pages that were never delivered.
+"""
+
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+from .hashing import fingerprint
+
+STATE_KEY = "page_validators"
+
+NOT_MODIFIED = 304
+
+
+@dataclass
+class Page:
+    """A page requested conditionally."""
+
+    key: str
+    # decoded body, None if the upstream answered that the page hasn't been modified
+    payload: Any
+    validators: Dict[str, Optional[str]]
+    # cached summary of the page if it is the same as when it was last fetched
+    unchanged: Optional[Dict[str, Any]] = None
+
+
+def page_key(params: Dict[str, Any]) -> str:
+    """Return the key of the page requested with the query parameters `params`."""
+    return fingerprint(params)
+
+
+class PageCache:
+    """
+    Validators and summaries of the pages of one table, keyed by page.
+
+    Entries of pages that haven't been requested during a complete full import are
+    dropped when it finishes, e.g. once the table shrank or the page size changed.
+    """
+
+    def __init__(self, table: str, store):
+        self.table = table
+        self.store = store
+        cache = store.load(table)
+        self.pages: Dict[str, Dict[str, Any]] = cache.get("pages", {})
+        # number of the current full import, to find pages that haven't been requested
+        self.sync: int = cache.get("sync", 0)
+
+    def fetch(self, key: str, send: Callable[..., Any]) -> Page:
+        """
+        Request the page `key` with `send(headers=...)`, conditionally if it is cached.
+
+        `send` returns a `requests.Response`, whose status is either 200 or 304.
+        """
+        entry = self.pages.get(key)
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        http_response = send(headers=headers)
+        if http_response.status_code == NOT_MODIFIED:
+            if entry is None:
+                raise ValueError(f"Upstream answered {NOT_MODIFIED} for uncached page")
+            entry["sync"] = self.sync
+            return Page(key, payload=None, validators={}, unchanged=entry)
+
+        payload = http_response.json()
+        validators = {
+            "etag": http_response.headers.get("ETag"),
+            "last_modified": http_response.headers.get("Last-Modified"),
+            "hash": fingerprint(payload),
+        }
+        page = Page(key, payload=payload, validators=validators)
+        if entry is not None and entry["hash"] == validators["hash"]:
+            entry.update(validators, sync=self.sync)
+            page.unchanged = entry
+        return page
+
+    def put(self, page: Page, keys: List[Any], state: Dict[str, Any]):
+        """Cache a page that has changed, with its rows' keys and the state after it."""
+        self.pages[page.key] = {
+            **page.validators,
+            "keys": keys,
+            "state": state,
+            "sync": self.sync,
+        }
+
+    def finish(self):
+        """Complete the full import of the table, dropping pages it didn't request."""
+        self.pages = {
+            key: entry
+            for key, entry in self.pages.items()
+            if entry.get("sync") == self.sync
+        }
+        self.sync += 1
+
+    def save(self):
+        self.store.save(self.table, {"sync": self.sync, "pages": self.pages})
@@ -0,0 +1,132 @@
+"""
+Adaptive page sizes that are tuned between invocations.
+
+A fixed page size either risks running into the function timeout when the upstream API
+is slow or wastes invocations on tiny pages when it is fast. `AdaptivePageSize` measures
+how long a page took and how large the resulting rows are, and picks the page size for
+the next invocation so that it hits the configured targets. Its tuning is carried in the
+Fivetran state.
+"""
+
+from typing import Any, Dict, List, Optional
+
+from .serialization import dumps
+
+# defaults for the per-stream targets, the function timeout is 60 seconds and responses
+# of 1st gen Cloud Functions are limited to 10MB
+DEFAULT_TARGET_SECONDS = 20.0
+DEFAULT_TARGET_BYTES = 4 * 1024 * 1024
+
+# limits on how quickly the page size may change between invocations
+MAX_GROWTH = 2.0
+MAX_SHRINK = 0.5
+
+# weight of the latest observation in the moving averages of the per-row costs
+SMOOTHING = 0.5
+
+STATE_KEY = "page_sizes"
+
+
+def serialized_size(rows: List[Dict[str, Any]]) -> int:
+    """Return the number of bytes `rows` take up in the response."""
+    return len(dumps(rows))
+
+
+class AdaptivePageSize:
+    """Page size controller for a single stream."""
+
+    def __init__(
+        self,
+        initial: int,
+        min_size: int,
+        max_size: int,
+        target_seconds: float = DEFAULT_TARGET_SECONDS,
+        target_bytes: int = DEFAULT_TARGET_BYTES,
+        seconds_per_row: Optional[float] = None,
+        bytes_per_row: Optional[float] = None,
+    ):
+        if min_size > max_size:
+            raise ValueError(f"Invalid page size bounds: [{min_size}, {max_size}]")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self.target_bytes = target_bytes
+        self.seconds_per_row = seconds_per_row
+        self.bytes_per_row = bytes_per_row
+        self.size = self._clamp(initial)
+
+    @classmethod
+    def fixed(cls, size: int) -> "AdaptivePageSize":
+        """Return a controller that always uses `size`."""
+        return cls(initial=size, min_size=size, max_size=size)
+
+    @classmethod
+    def from_config(
+        cls,
+        config: Optional[Dict[str, Any]],
+        state: Optional[Dict[str, Any]],
+        default: int,
+    ) -> "AdaptivePageSize":
+        """
+        Create a controller from the connector config and the stream's previous state.
+
+        `config` contains the optional `min`, `max`, `target_seconds` and `target_bytes`
+        settings. If it is None, the page size is fixed to `default`.
+        """
+        if config is None:
+            return cls.fixed(default)
+
+        state = state or {}
+        return cls(
+            initial=int(state.get("size", config.get("initial", default))),
+            min_size=int(config.get("min", 1)),
+            max_size=int(config.get("max", max(default, 1))),
+            target_seconds=float(config.get("target_seconds", DEFAULT_TARGET_SECONDS)),
+            target_bytes=int(config.get("target_bytes", DEFAULT_TARGET_BYTES)),
+            seconds_per_row=state.get("seconds_per_row"),
+            bytes_per_row=state.get("bytes_per_row"),
+        )
+
+    def _clamp(self, size: float) -> int:
+        return max(self.min_size, min(self.max_size, int(size)))
+
+    @staticmethod
+    def _smooth(previous: Optional[float], latest: float) -> float:
+        if previous is None:
+            return latest
+        return SMOOTHING * latest + (1 - SMOOTHING) * previous
+
+    def observe(self, rows: int, seconds: float, num_bytes: int) -> int:
+        """
+        Record the cost of a fetched page and return the page size to use next.
+
+        Pages without rows carry no information about the per-row costs and leave the
+        page size unchanged.
+        """
+        if rows <= 0 or self.min_size == self.max_size:
+            return self.size
+
+        self.seconds_per_row = self._smooth(self.seconds_per_row, seconds / rows)
+        self.bytes_per_row = self._smooth(self.bytes_per_row, num_bytes / rows)
+
+        candidates = []
+        if self.seconds_per_row > 0:
+            candidates.append(self.target_seconds / self.seconds_per_row)
+        if self.bytes_per_row > 0:
+            candidates.append(self.target_bytes / self.bytes_per_row)
+        if not candidates:
+            return self.size
+
+        target_size = min(candidates)
+        target_size = min(target_size, self.size * MAX_GROWTH)
+        target_size = max(target_size, self.size * MAX_SHRINK)
+        self.size = self._clamp(target_size)
+        return self.size
+
+    def to_state(self) -> Dict[str, Any]:
+        """Return the tuning that needs to be carried to the next invocation."""
+        return {
+            "size": self.size,
+            "seconds_per_row": self.seconds_per_row,
+            "bytes_per_row": self.bytes_per_row,
+        }
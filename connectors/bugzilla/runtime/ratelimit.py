@@ -0,0 +1,286 @@
+"""
+Adaptive rate limiting and backoff for requests to upstream APIs.
+
+Every upstream host gets a `HostLimiter`: a token bucket paces requests, and an AIMD
+controller adjusts the rate of the bucket. The rate grows additively while requests
+succeed and is cut multiplicatively when the upstream throttles (429 or 503), so that
+the sustained rate settles just below the limit of the API instead of alternating
+between bursts and failures. Throttled requests are retried with exponential backoff
+and jitter, honoring `Retry-After`.
+
+Pacing is opt-in per host: connectors create the limiter of a host with
+`configure_host`, typically from a `rate_limit` entry of their config. Requests to other
+hosts aren't paced, but throttled ones are still retried with the default `Backoff`.
+Limiters are kept at module scope, so the learned rates carry over to later invocations
+of a warm function instance. Sessions from `runtime.session` apply them to every request.
+"""
+
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, Optional
+from urllib.parse import urlsplit
+
+# status codes upstream APIs use to signal that requests should be slowed down
+THROTTLE_STATUSES = frozenset({429, 503})
+
+# requests per second
+DEFAULT_INITIAL_RATE = 20.0
+DEFAULT_MIN_RATE = 0.2
+DEFAULT_MAX_RATE = 100.0
+DEFAULT_MAX_RETRIES = 5
+# seconds
+DEFAULT_BASE_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 30.0
+
+_limiters: Dict[str, "HostLimiter"] = {}
+_lock = threading.Lock()
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` requests per second on average."""
+
+    def __init__(
+        self,
+        rate: float,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.rate = rate
+        # allow bursts of up to a second worth of requests
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def set_rate(self, rate: float):
+        with self._lock:
+            self._refill()
+            self.rate = rate
+            self.capacity = max(1.0, rate)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def acquire(self) -> float:
+        """Take a token, waiting for it if necessary, and return the seconds waited."""
+        with self._lock:
+            self._refill()
+            # tokens are reserved before waiting, so concurrent callers queue up
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            self.sleep(wait)
+        return wait
+
+
+class AIMDController:
+    """
+    Additive increase, multiplicative decrease of a request rate.
+
+    The rate grows by about `increase` requests per second for every second of
+    successful requests and is multiplied by `decrease` when requests are throttled.
+    Throttled responses to requests sent before the last decrease took effect don't
+    decrease the rate again.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        min_rate: float = DEFAULT_MIN_RATE,
+        max_rate: float = DEFAULT_MAX_RATE,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate = min(max(rate, min_rate), max_rate)
+        self.increase = increase
+        self.decrease = decrease
+        self.clock = clock
+        self._last_decrease = float("-inf")
+        self._lock = threading.Lock()
+
+    def on_success(self) -> float:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+            return self.rate
+
+    def on_throttle(self, sent_at: Optional[float] = None) -> float:
+        with self._lock:
+            if sent_at is None or sent_at >= self._last_decrease:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self._last_decrease = self.clock()
+            return self.rate
+
+
+class Backoff:
+    """Backs off and retries throttled requests without pacing them."""
+
+    def __init__(
+        self,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        base_backoff: float = DEFAULT_BASE_BACKOFF,
+        max_backoff: float = DEFAULT_MAX_BACKOFF,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+        rng: Optional[random.Random] = None,
+    ):
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.rng = rng or random.Random()
+
+    def acquire(self) -> float:
+        """Return the time the next request is sent, which is right away."""
+        return self.clock()
+
+    def on_success(self):
+        pass
+
+    def on_throttle(self, sent_at: Optional[float] = None):
+        pass
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None):
+        """
+        Return the seconds to wait before retry number `attempt` (starting at 0).
+
+        Returns None if the request shouldn't be retried, i.e. retries are used up or
+        the upstream asks to wait longer than `max_backoff`.
+        """
+        if attempt >= self.max_retries:
+            return None
+        if retry_after is not None:
+            if retry_after > self.max_backoff:
+                return None
+            # spread out retries of concurrent requests told to wait the same time
+            return retry_after + self.rng.uniform(0, self.base_backoff)
+        # "full jitter" exponential backoff
+        return self.rng.uniform(
+            0, min(self.max_backoff, self.base_backoff * 2**attempt)
+        )
+
+
+class HostLimiter(Backoff):
+    """Paces, backs off and retries requests to a single upstream host."""
+
+    def __init__(
+        self,
+        initial_rate: float = DEFAULT_INITIAL_RATE,
+        min_rate: float = DEFAULT_MIN_RATE,
+        max_rate: float = DEFAULT_MAX_RATE,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        base_backoff: float = DEFAULT_BASE_BACKOFF,
+        max_backoff: float = DEFAULT_MAX_BACKOFF,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+        rng: Optional[random.Random] = None,
+    ):
+        super().__init__(max_retries, base_backoff, max_backoff, clock, sleep, rng)
+        self.controller = AIMDController(initial_rate, min_rate, max_rate, clock=clock)
+        self.bucket = TokenBucket(self.controller.rate, clock=clock, sleep=sleep)
+        # configuration the limiter was created from, if any
+        self.config: Optional[Dict[str, Any]] = None
+
+    @classmethod
+    def from_config(cls, config: Optional[Dict[str, Any]]) -> "HostLimiter":
+        config = config or {}
+        limiter = cls(
+            initial_rate=float(config.get("initial_rate", DEFAULT_INITIAL_RATE)),
+            min_rate=float(config.get("min_rate", DEFAULT_MIN_RATE)),
+            max_rate=float(config.get("max_rate", DEFAULT_MAX_RATE)),
+            max_retries=int(config.get("max_retries", DEFAULT_MAX_RETRIES)),
+            base_backoff=float(config.get("base_backoff", DEFAULT_BASE_BACKOFF)),
+            max_backoff=float(config.get("max_backoff", DEFAULT_MAX_BACKOFF)),
+        )
+        limiter.config = dict(config)
+        return limiter
+
+    @property
+    def rate(self) -> float:
+        return self.controller.rate
+
+    def acquire(self) -> float:
+        """Wait until the next request may be sent and return the time it is sent."""
+        self.bucket.acquire()
+        return self.clock()
+
+    def on_success(self):
+        self.bucket.set_rate(self.controller.on_success())
+
+    def on_throttle(self, sent_at: Optional[float] = None):
+        self.bucket.set_rate(self.controller.on_throttle(sent_at))
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a `Retry-After` header, which is either seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def limiter_for(url: str) -> Optional[HostLimiter]:
+    """Return the limiter of the host of `url`, None if it hasn't been configured."""
+    return _limiters.get(urlsplit(url).netloc)
+
+
+def backoff_for(url: str) -> Backoff:
+    """Return how requests to the host of `url` are retried, paced if configured."""
+    return limiter_for(url) or DEFAULT_BACKOFF
+
+
+def configure_host(url: str, config: Optional[Dict[str, Any]]):
+    """
+    Configure the limiter of the host of `url`, or remove it if `config` is None.
+
+    An empty `config` uses the defaults. A limiter that already exists keeps its learned
+    rate within the new bounds.
+    """
+    host = urlsplit(url).netloc
+    with _lock:
+        if config is None:
+            _limiters.pop(host, None)
+            return
+        previous = _limiters.get(host)
+        if previous is not None and previous.config == config:
+            return
+        limiter = HostLimiter.from_config(config)
+        if previous is not None:
+            controller = limiter.controller
+            controller.rate = min(
+                max(previous.rate, controller.min_rate), controller.max_rate
+            )
+            limiter.bucket.set_rate(controller.rate)
+        _limiters[host] = limiter
+
+
+# retries throttled requests to hosts without a configured limiter
+DEFAULT_BACKOFF = Backoff()
+
+
+def reset():
+    """Forget all limiters and their learned rates."""
+    with _lock:
+        _limiters.clear()
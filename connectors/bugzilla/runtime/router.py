@@ -0,0 +1,67 @@
+"""
+Entry point that serves several connectors from a single Cloud Function.
+
+A grouped deployment (see `deploy.yaml`) bundles the connectors of the group under
+`connectors/<name>/` next to a single copy of this runtime. Each Fivetran request
+names its connector with the `connector` key of the secrets, and the router passes
+it to that connector's `main`.
+
+Connector modules are only imported when the first request for them arrives, so a
+cold start only pays for the connectors it serves. They are kept for the lifetime of
+the instance afterwards, which keeps their warm state, e.g. pooled sessions, caches
+and rate limiters, across invocations just as in a function of its own.
+"""
+
+import importlib.util
+import sys
+import threading
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional
+
+# key of the secrets that names the connector a request is for
+ROUTE_KEY = "connector"
+
+CONNECTORS_DIR = "connectors"
+
+
+class Router:
+    """Dispatches requests to the `main` of connectors that are imported lazily."""
+
+    def __init__(self, root: Path, connectors: Optional[Iterable[str]] = None):
+        self.connectors_dir = Path(root) / CONNECTORS_DIR
+        if connectors is None:
+            connectors = [
+                path.parent.name for path in self.connectors_dir.glob("*/main.py")
+            ]
+        self.connectors = frozenset(connectors)
+        self._mains: Dict[str, Callable] = {}
+        self._lock = threading.Lock()
+
+    def load(self, connector: str) -> Callable:
+        """Return `main` of `connector`, importing it on first use."""
+        main = self._mains.get(connector)
+        if main is not None:
+            return main
+        if connector not in self.connectors:
+            raise ValueError(f"Unknown connector: {connector}")
+
+        with self._lock:
+            if connector not in self._mains:
+                # every connector has a main.py, so modules are named after their
+                # connector to keep them apart
+                spec = importlib.util.spec_from_file_location(
+                    f"{connector}_main", self.connectors_dir / connector / "main.py"
+                )
+                if spec is None or spec.loader is None:
+                    raise FileNotFoundError(f"No main.py for connector {connector}")
+                module = importlib.util.module_from_spec(spec)
+                sys.modules[spec.name] = module
+                spec.loader.exec_module(module)
+                self._mains[connector] = module.main
+        return self._mains[connector]
+
+    def __call__(self, request):
+        secrets = (request.json or {}).get("secrets") or {}
+        if ROUTE_KEY not in secrets:
+            raise ValueError(f"Missing {ROUTE_KEY!r} in secrets")
+        return self.load(secrets[ROUTE_KEY])(request)
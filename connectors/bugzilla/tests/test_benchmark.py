@@ -0,0 +1,111 @@
+import os
+from dataclasses import dataclass
+from pathlib import Path
+
+import main as connector
+import pytest
+
+BASELINE = Path(__file__).parent / "benchmarks" / "baseline.json"
+SIZES = [
+    int(size)
+    for size in os.environ.get("BENCHMARK_SIZES", "1000,10000,100000").split(",")
+]
+
+pytestmark = pytest.mark.skipif(
+    not os.environ.get("RUN_BENCHMARKS"), reason="set RUN_BENCHMARKS=1 to run"
+)
+
+COMPONENTS = ["DOM: Core & HTML", "Layout", "Networking", "Graphics", "General"]
+
+
+@dataclass
+class FivetranRequest:
+    json: dict
+
+
+class ReplayBugzilla:
+    """Stand-in for `bugzilla.Bugzilla` that sends searches through the session."""
+
+    logged_in = True
+
+    def __init__(self, url, api_key, requests_session):
+        self.url = url
+        self.session = requests_session
+
+    def product_get(self, names, include_fields):
+        return [
+            {
+                "name": name,
+                "id": 1,
+                "components": [
+                    {
+                        "name": component,
+                        "id": i,
+                        "default_qa_contact": "",
+                        "is_active": True,
+                        "description": component,
+                    }
+                    for i, component in enumerate(COMPONENTS)
+                ],
+            }
+            for name in names
+        ]
+
+    def build_query(self, **kwargs):
+        return dict(kwargs)
+
+    def get_requests_session(self):
+        return self.session
+
+
+def synthetic_responder(rows):
+    def respond(url, params):
+        fields = params["include_fields"].split(",")
+        bugs = [
+            {
+                "id": 1_000_000 + i,
+                "summary": f"Intermittent crash when loading page {i}",
+                "assigned_to": f"user{i % 500}@mozilla.com",
+                "creation_time": "2019-03-01T12:00:00Z",
+                "status": "NEW",
+                "last_change_time": f"2021-{1 + i % 12:02d}-01T00:00:00Z",
+                "creator": f"user{i % 700}@mozilla.com",
+                "product": "Core",
+                "component": COMPONENTS[i % len(COMPONENTS)],
+                "cc": [f"user{j}@mozilla.com" for j in range(i % 5)],
+                "keywords": ["intermittent-failure"],
+            }
+            for i in range(rows)
+        ]
+        return {"bugs": [{field: bug.get(field) for field in fields} for bug in bugs]}
+
+    return respond
+
+
+class TestBenchmark:
+    @pytest.mark.parametrize("rows", SIZES)
+    def test_main(self, rows):
+        # the harness is part of the tools, installed by `./fivetran bootstrap`
+        from tools.benchmark_harness import compare_to_baseline, run_benchmark
+
+        config = {
+            "url": "https://bugzilla.example.com/rest/",
+            "api_key": "key",
+            "max_date": "2014-09-01T00:00:00Z",
+            "bug_limit": rows,
+            "products": ["Core"],
+        }
+        fivetran_request = FivetranRequest(json={"secrets": config, "state": {}})
+        results = run_benchmark(
+            connector,
+            fivetran_request,
+            synthetic_responder(rows),
+            patches={"bugzilla.Bugzilla": ReplayBugzilla},
+        )
+        regressions = compare_to_baseline(
+            f"main_{rows}",
+            results,
+            BASELINE,
+            update=bool(os.environ.get("UPDATE_BENCHMARK_BASELINE")),
+        )
+        assert not regressions, regressions
@@ -1,4 +1,615 @@
+import json
+import time
+from dataclasses import dataclass
+from unittest import mock
+
+import pytest
+import requests
+from main import (
+    _clients,
+    _components_cache,
+    backfill_partitions,
+    backfill_state,
+    main,
+    plan_queries,
+    query_length,
+)
+
+CONFIG = {
+    "url": "https://bugzilla.example.com/rest/",
+    "api_key": "key",
+    "max_date": "2021-01-01T00:00:00Z",
+    "bug_limit": 2,
+    "products": ["Firefox", "Core"],
+}
+
+COMPONENTS = {
+    "Firefox": ["Toolbars", "General"],
+    "Core": ["DOM", "CSS"],
+}
+
+
+@dataclass
+class FivetranRequest:
+    json: dict
+
+
+def product_get(names, include_fields):
+    # return the first product last to check that results are merged deterministically
+    product = names[0]
+    time.sleep(0.05 if product == CONFIG["products"][0] else 0)
+    return [
+        {
+            "name": product,
+            "id": 1,
+            "components": [
+                {
+                    "name": name,
+                    "id": i,
+                    "default_qa_contact": "",
+                    "is_active": True,
+                    "description": f"{product} {name}",
+                }
+                for i, name in enumerate(COMPONENTS[product])
+            ],
+        }
+    ]
+
+
+def mock_bugzilla(mock_bugzilla_class, bugs=None):
+    bzapi = mock_bugzilla_class.return_value
+    bzapi.url = CONFIG["url"]
+    bzapi.logged_in = True
+    bzapi.product_get.side_effect = product_get
+    bzapi.build_query.side_effect = lambda **kwargs: dict(kwargs)
+    set_bugs(bzapi, bugs or [])
+    return bzapi
+
+
+def set_bugs(bzapi, bugs):
+    http_get = bzapi.get_requests_session.return_value.get
+    http_get.return_value.json.return_value = {"bugs": bugs}
+
+
+def last_query(bzapi):
+    return bzapi.get_requests_session.return_value.get.call_args.kwargs["params"]
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    _components_cache.clear()
+    _clients.clear()
+
+
+def make_bugs(ids, last_change_time="2021-02-01T00:00:00Z"):
+    return [
+        {
+            "id": i,
+            "summary": f"bug {i}",
+            "assigned_to": "nobody@mozilla.org",
+            "creation_time": "2021-01-01T00:00:00Z",
+            "status": "NEW",
+            "last_change_time": last_change_time,
+            "creator": "nobody@mozilla.org",
+            "product": "Core",
+            "component": "DOM",
+        }
+        for i in ids
+    ]
+
+
 class TestMain:
-    def test_main(self):
-        # add tests here
-        assert True
+    @mock.patch("bugzilla.Bugzilla")
+    def test_components_fetched_concurrently_in_stable_order(self, mock_class):
+        bzapi = mock_bugzilla(mock_class)
+        fivetran_request = FivetranRequest(
+            json={"secrets": {**CONFIG, "component_concurrency": 2}, "state": {}}
+        )
+
+        response = main(fivetran_request)
+
+        assert [
+            component["description"] for component in response["insert"]["components"]
+        ] == ["Firefox General", "Firefox Toolbars", "Core CSS", "Core DOM"]
+        assert bzapi.product_get.call_count == 2
+        query_args = bzapi.build_query.call_args.kwargs
+        assert query_args["component"] == ["CSS", "DOM", "General", "Toolbars"]
+        assert query_args["product"] == ["Core", "Firefox"]
+        assert [{"name": "Firefox"}, {"name": "Core"}] == response["insert"]["products"]
+
+    @mock.patch("bugzilla.Bugzilla")
+    def test_metadata_cached_and_only_sent_when_changed(self, mock_class):
+        bzapi = mock_bugzilla(mock_class)
+        first = main(FivetranRequest(json={"secrets": CONFIG, "state": {}}))
+        second = main(
+            FivetranRequest(json={"secrets": CONFIG, "state": first["state"]})
+        )
+
+        assert bzapi.product_get.call_count == 2
+        assert "components" in first["insert"]
+        assert "products" not in second["insert"]
+        assert "components" not in second["insert"]
+        assert (
+            first["state"]["metadata_fingerprint"]
+            == second["state"]["metadata_fingerprint"]
+        )
+
+        _components_cache.clear()
+        COMPONENTS["Core"].append("Layout")
+        try:
+            third = main(FivetranRequest(json={"secrets": CONFIG, "state": {}}))
+            fourth = main(
+                FivetranRequest(json={"secrets": CONFIG, "state": second["state"]})
+            )
+        finally:
+            COMPONENTS["Core"].remove("Layout")
+        assert "components" in third["insert"]
+        assert "components" in fourth["insert"]
+
+    @mock.patch("bugzilla.Bugzilla")
+    def test_keyset_pagination(self, mock_class):
+        bzapi = mock_bugzilla(mock_class, bugs=make_bugs([3, 7]))
+        first = main(FivetranRequest(json={"secrets": CONFIG, "state": {}}))
+
+        query = last_query(bzapi)
+        assert query["order"] == "changeddate,bug_id"
+        assert "f1" not in query
+        assert first["hasMore"] is True
+        assert first["state"]["cursor"] == {
+            "last_change_time": "2021-02-01T00:00:00Z",
+            "id": 7,
+        }
+        assert first["state"]["since_id"] == CONFIG["max_date"]
+
+        set_bugs(bzapi, make_bugs([8]))
+        second = main(
+            FivetranRequest(json={"secrets": CONFIG, "state": first["state"]})
+        )
+
+        query = last_query(bzapi)
+        assert query["last_change_time"] == CONFIG["max_date"]
+        assert query["v2"] == "2021-02-01T00:00:00Z"
+        assert query["v5"] == 7
+        assert "offset" not in query
+        assert second["hasMore"] is False
+        assert "cursor" not in second["state"]
+        # the latest change seen less the overlap
+        assert second["state"]["since_id"] == "2021-01-31T23:59:00Z"
+
+    @mock.patch("bugzilla.Bugzilla")
+    def test_offset_pagination_advances_by_bug_limit(self, mock_class):
+        bzapi = mock_bugzilla(mock_class, bugs=make_bugs([1, 2]))
+        config = {**CONFIG, "pagination": "offset"}
+        first = main(FivetranRequest(json={"secrets": config, "state": {}}))
+        second = main(
+            FivetranRequest(json={"secrets": config, "state": first["state"]})
+        )
+
+        calls = bzapi.get_requests_session.return_value.get.call_args_list
+        assert calls[0].kwargs["params"]["offset"] == 0
+        assert calls[1].kwargs["params"]["offset"] == 2
+        assert second["state"]["offset"] == 4
+
+    @mock.patch("bugzilla.Bugzilla")
+    def test_only_bug_columns_requested_and_synced(self, mock_class):
+        bugs = make_bugs([1])
+        bugs[0]["cc"] = ["someone@mozilla.org"]
+        bzapi = mock_bugzilla(mock_class, bugs=bugs)
+
+        response = main(FivetranRequest(json={"secrets": CONFIG, "state": {}}))
+
+        url = bzapi.get_requests_session.return_value.get.call_args.args[0]
+        query = last_query(bzapi)
+        assert url == "https://bugzilla.example.com/rest/bug"
+        assert query["include_fields"] == (
+            "id,summary,assigned_to,creation_time,status,"
+            "last_change_time,creator,product,component"
+        )
+        headers = bzapi.get_requests_session.return_value.get.call_args.kwargs[
+            "headers"
+        ]
+        assert headers == {"X-BUGZILLA-API-KEY": "key"}
+        assert "Bugzilla_api_key" not in query
+        assert response["insert"]["bugs"] == make_bugs([1])
+
+    @mock.patch("bugzilla.Bugzilla")
+    def test_error_body_in_exception_without_api_key(self, mock_class):
+        import bugzilla
+
+        bzapi = mock_bugzilla(mock_class)
+        http_response = requests.Response()
+        http_response.status_code = 400
+        http_response.url = "https://bugzilla.example.com/rest/bug?limit=2"
+        http_response._content = json.dumps(
+            {"error": True, "message": "Invalid query", "code": 108}
+        ).encode("utf-8")
+        bzapi.get_requests_session.return_value.get.return_value = http_response
+
+        with pytest.raises(bugzilla.BugzillaError) as error:
+            main(FivetranRequest(json={"secrets": CONFIG, "state": {}}))
+
+        assert "Invalid query" in str(error.value)
+        assert "HTTP 400" in str(error.value)
+        assert CONFIG["api_key"] not in str(error.value)
+
+    @mock.patch("bugzilla.Bugzilla")
+    def test_adaptive_page_size_carried_in_state(self, mock_class):
+        bzapi = mock_bugzilla(mock_class, bugs=make_bugs([1, 2]))
+        config = {
+            **CONFIG,
+            "page_size": {"min": 1, "max": 10, "target_bytes": 1000},
+        }
+        # page sizes need the size of the rows, so the response is serialized
+        body, _, _ = main(FivetranRequest(json={"secrets": config, "state": {}}))
+        first = json.loads(body)
+
+        tuning = first["state"]["page_sizes"]["bugs"]
+        assert first["hasMore"] is True
+        assert tuning["size"] == 4
+        assert tuning["bytes_per_row"] > 0
+
+        set_bugs(bzapi, make_bugs([3]))
+        main(FivetranRequest(json={"secrets": config, "state": first["state"]}))
+        assert last_query(bzapi)["limit"] == 4
+
+    @mock.patch("bugzilla.Bugzilla")
+    def test_time_budget_fetches_several_pages(self, mock_class):
+        bzapi = mock_bugzilla(mock_class)
+        http_get = bzapi.get_requests_session.return_value.get
+        http_get.return_value.json.side_effect = [
+            {"bugs": make_bugs([1, 2])},
+            {"bugs": make_bugs([3, 4])},
+            {"bugs": make_bugs([5])},
+        ]
+        config = {**CONFIG, "time_budget": {"fraction": 0.5}}
+        body, _, _ = main(FivetranRequest(json={"secrets": config, "state": {}}))
+        response = json.loads(body)
+
+        assert http_get.call_count == 3
+        assert [bug["id"] for bug in response["insert"]["bugs"]] == [1, 2, 3, 4, 5]
+        assert last_query(bzapi)["v5"] == 4
+        assert response["hasMore"] is False
+        assert "cursor" not in response["state"]
+
+    @mock.patch("bugzilla.Bugzilla")
+    def test_metrics_emitted_and_added_to_state(self, mock_class, capsys):
+        mock_bugzilla(mock_class, make_bugs([1]))
+        # sizes of rows are only known if the response is serialized
+        config = {**CONFIG, "metrics_in_state": True, "serialize_response": True}
+        body, _, _ = main(FivetranRequest(json={"secrets": config, "state": {}}))
+        response = json.loads(body)
+
+        summary = response["state"]["metrics"]
+        assert summary["rows"] == {"bugs": 1, "products": 2, "components": 4}
+        assert {"auth", "discovery", "fetch", "transform"} <= set(summary["phases"])
+
+        record = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+        assert record["severity"] == "INFO"
+        assert record["metrics"]["connector"] == "bugzilla"
+        assert record["metrics"]["tables"]["bugs"]["bytes"] > 0
+
+    @mock.patch("bugzilla.Bugzilla")
+    def test_metrics_emitted_for_failed_invocation(self, mock_class, capsys):
+        mock_bugzilla(mock_class).logged_in = False
+        with pytest.raises(ValueError):
+            main(FivetranRequest(json={"secrets": CONFIG, "state": {}}))
+
+        record = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+        assert record["severity"] == "ERROR"
+        assert "auth" in record["metrics"]["phases"]
+
+    @mock.patch("bugzilla.Bugzilla")
+    def test_client_reused_across_warm_invocations(self, mock_class):
+        mock_bugzilla(mock_class, make_bugs([1]))
+        main(FivetranRequest(json={"secrets": CONFIG, "state": {}}))
+        main(FivetranRequest(json={"secrets": CONFIG, "state": {}}))
+
+        assert mock_class.call_count == 1
+
+    @mock.patch("bugzilla.Bugzilla")
+    def test_related_tables_fetched_in_batches(self, mock_class):
+        bzapi = mock_bugzilla(mock_class)
+        history = {
+            "bugs": [
+                {
+                    "id": 1,
+                    "history": [
+                        {
+                            "when": "2021-02-01T00:00:00Z",
+                            "who": "nobody@mozilla.org",
+                            "changes": [
+                                {
+                                    "field_name": "status",
+                                    "removed": "NEW",
+                                    "added": "FIXED",
+                                }
+                            ],
+                        }
+                    ],
+                }
+            ]
+        }
+        comments = {
+            "bugs": {"1": {"comments": [{"id": 10, "bug_id": 1, "text": "hi"}]}},
+            "comments": {},
+        }
+
+        def get(url, params, **kwargs):
+            response = mock.Mock()
+            if url.endswith("/history"):
+                response.json.return_value = history
+            elif url.endswith("/comment"):
+                response.json.return_value = comments
+            else:
+                response.json.return_value = {"bugs": make_bugs([1, 2, 3])}
+            return response
+
+        http_get = bzapi.get_requests_session.return_value.get
+        http_get.side_effect = get
+        config = {
+            **CONFIG,
+            "bug_limit": 4,
+            "related_tables": ["bug_history", "comments"],
+            "related_batch_size": 2,
+        }
+        response = main(FivetranRequest(json={"secrets": config, "state": {}}))
+
+        related_calls = sorted(
+            (call.args[0].rsplit("/", 3)[1:], call.kwargs["params"]["ids"])
+            for call in http_get.call_args_list
+            if "/bug/" in call.args[0]
+        )
+        assert related_calls == [
+            (["bug", "1", "comment"], [2]),
+            (["bug", "1", "history"], [2]),
+            (["bug", "3", "comment"], []),
+            (["bug", "3", "history"], []),
+        ]
+        assert all(
+            call.kwargs["params"]["new_since"] == CONFIG["max_date"]
+            for call in http_get.call_args_list
+            if "/bug/" in call.args[0]
+        )
+        assert response["insert"]["bug_history"][0] == {
+            "bug_id": 1,
+            "when": "2021-02-01T00:00:00Z",
+            "who": "nobody@mozilla.org",
+            "field_name": "status",
+            "removed": "NEW",
+            "added": "FIXED",
+            "attachment_id": 0,
+        }
+        assert len(response["insert"]["bug_history"]) == 2
+        assert [row["id"] for row in response["insert"]["comments"]] == [10, 10]
+        # the next sync requests entries from the cursor of bugs, in Bugzilla's time
+        related_since = response["state"]["related_since"]
+        assert related_since == {
+            "bug_history": "2021-01-31T23:59:00Z",
+            "comments": "2021-01-31T23:59:00Z",
+        }
+
+    @mock.patch("bugzilla.Bugzilla")
+    def test_serialized_response_matches_response(self, mock_class):
+        mock_bugzilla(mock_class, make_bugs([1, 2]))
+        config = {**CONFIG, "bug_limit": 3}
+        expected = main(FivetranRequest(json={"secrets": config, "state": {}}))
+
+        _components_cache.clear()
+        config["serialize_response"] = True
+        body, status, headers = main(
+            FivetranRequest(json={"secrets": config, "state": {}})
+        )
+
+        assert status == 200
+        assert headers["Content-Type"] == "application/json"
+        response = json.loads(body)
+        assert response == expected
+
+    @mock.patch("bugzilla.Bugzilla")
+    def test_backfill_partitions_synced_concurrently(self, mock_class):
+        bzapi = mock_bugzilla(mock_class)
+        pages = {}
+
+        def get(url, params, **kwargs):
+            response = mock.Mock()
+            if url.endswith("/time"):
+                # time slices end at the time of Bugzilla, not of the function
+                response.json.return_value = {"db_time": "2021-01-03T00:00:00Z"}
+            else:
+                bugs = pages[params["last_change_time"]]
+                response.json.return_value = {"bugs": bugs}
+            return response
+
+        http_get = bzapi.get_requests_session.return_value.get
+        http_get.side_effect = get
+        config = {**CONFIG, "backfill": {"partitions": 2, "concurrency": 2}}
+
+        pages["2021-01-01T00:00:00Z"] = make_bugs([1, 2], "2021-01-01T12:00:00Z")
+        pages["2021-01-02T00:00:00Z"] = make_bugs([3], "2021-01-02T12:00:00Z")
+        first = main(FivetranRequest(json={"secrets": config, "state": {}}))
+
+        queries = sorted(
+            (
+                call.kwargs["params"]
+                for call in http_get.call_args_list
+                if call.args[0].endswith("/bug")
+            ),
+            key=lambda query: query["last_change_time"],
+        )
+        assert [(query["f1"], query["v1"]) for query in queries] == [
+            ("delta_ts", "2021-01-02T00:00:00Z"),
+            ("delta_ts", "2021-01-03T00:00:00Z"),
+        ]
+        assert [bug["id"] for bug in first["insert"]["bugs"]] == [1, 2, 3]
+        assert first["hasMore"] is True
+        partitions = first["state"]["plan"]["partitions"]
+        assert [partition["done"] for partition in partitions] == [False, True]
+        assert partitions[0]["cursor"] == {
+            "last_change_time": "2021-01-01T12:00:00Z",
+            "id": 2,
+        }
+
+        http_get.reset_mock()
+        pages["2021-01-01T00:00:00Z"] = make_bugs([4], "2021-01-01T13:00:00Z")
+        second = main(
+            FivetranRequest(json={"secrets": config, "state": first["state"]})
+        )
+
+        assert http_get.call_count == 1
+        query = last_query(bzapi)
+        assert query["v5"] == 2
+        assert (query["f8"], query["o8"]) == ("delta_ts", "lessthan")
+        assert [bug["id"] for bug in second["insert"]["bugs"]] == [4]
+        # the incremental sync continues from the latest change of the backfill
+        assert second["hasMore"] is False
+        assert "plan" not in second["state"]
+        assert second["state"]["since_id"] == "2021-01-02T11:59:00Z"
+
+        pages["2021-01-02T11:59:00Z"] = []
+        main(FivetranRequest(json={"secrets": config, "state": second["state"]}))
+        assert "f1" not in last_query(bzapi)
+
+    @mock.patch("bugzilla.Bugzilla")
+    def test_query_plan_syncs_products_separately(self, mock_class):
+        bzapi = mock_bugzilla(mock_class)
+        pages = {
+            "Firefox": [make_bugs([1, 2]), make_bugs([5])],
+            "Core": [make_bugs([3])],
+        }
+
+        def get(url, params, **kwargs):
+            response = mock.Mock()
+            if url.endswith("/time"):
+                response.json.return_value = {"db_time": "2021-03-01T00:00:00Z"}
+                return response
+            (product,) = params["product"]
+            response.json.return_value = {"bugs": pages[product].pop(0)}
+            return response
+
+        http_get = bzapi.get_requests_session.return_value.get
+        http_get.side_effect = get
+        config = {**CONFIG, "query_plan": {"concurrency": 2}}
+        first = main(FivetranRequest(json={"secrets": config, "state": {}}))
+
+        queries = [
+            call.kwargs["params"]
+            for call in http_get.call_args_list
+            if call.args[0].endswith("/bug")
+        ]
+        assert sorted(query["product"][0] for query in queries) == ["Core", "Firefox"]
+        assert all("component" not in query for query in queries)
+        assert all(query["last_change_time"] == CONFIG["max_date"] for query in queries)
+        assert first["hasMore"] is True
+        partitions = first["state"]["plan"]["partitions"]
+        assert [(p["product"], p["done"]) for p in partitions] == [
+            ("Firefox", False),
+            ("Core", True),
+        ]
+
+        second = main(
+            FivetranRequest(json={"secrets": config, "state": first["state"]})
+        )
+
+        query = last_query(bzapi)
+        assert query["product"] == ["Firefox"]
+        assert query["v5"] == 2
+        assert [bug["id"] for bug in second["insert"]["bugs"]] == [5]
+        assert second["hasMore"] is False
+        assert second["state"]["since_id"] == "2021-01-31T23:59:00Z"
+
+    @mock.patch("bugzilla.Bugzilla")
+    def test_since_id_from_latest_change_skips_synced_overlap(self, mock_class):
+        bzapi = mock_bugzilla(mock_class, bugs=make_bugs([1], "2021-01-05T10:00:00Z"))
+        config = {**CONFIG, "bug_limit": 10, "cursor_overlap": 3600}
+        # since_id in the format of earlier versions
+        state = {"since_id": "2021-01-04T08-00-00Z"}
+        first = main(FivetranRequest(json={"secrets": config, "state": state}))
+
+        assert last_query(bzapi)["last_change_time"] == "2021-01-04T08:00:00Z"
+        assert first["state"]["since_id"] == "2021-01-05T09:00:00Z"
+
+        # bug 1 is in the overlap but unchanged, bug 2 changed in the overlap
+        set_bugs(
+            bzapi,
+            make_bugs([2], "2021-01-05T09:30:00Z")
+            + make_bugs([1], "2021-01-05T10:00:00Z")
+            + make_bugs([3], "2021-01-05T12:00:00Z"),
+        )
+        second = main(
+            FivetranRequest(json={"secrets": config, "state": first["state"]})
+        )
+
+        assert last_query(bzapi)["last_change_time"] == "2021-01-05T09:00:00Z"
+        assert [bug["id"] for bug in second["insert"]["bugs"]] == [2, 3]
+        assert second["state"]["since_id"] == "2021-01-05T11:00:00Z"
+
+        # nothing changed, the cursor stays
+        set_bugs(bzapi, make_bugs([3], "2021-01-05T12:00:00Z"))
+        third = main(
+            FivetranRequest(json={"secrets": config, "state": second["state"]})
+        )
+
+        assert third["insert"]["bugs"] == []
+        assert third["state"]["since_id"] == "2021-01-05T11:00:00Z"
+
+    @mock.patch("bugzilla.Bugzilla")
+    def test_backfill_partitions_split_range_since_max_date(self, mock_class):
+        bzapi = mock_bugzilla(mock_class)
+        http_get = bzapi.get_requests_session.return_value.get
+        http_get.return_value.json.return_value = {
+            "db_time": "2021-01-03T00:00:00Z",
+            "bugs": [],
+        }
+        states = backfill_partitions(CONFIG, 2)
+
+        assert [state["plan"]["partitions"] for state in states] == [
+            [
+                {
+                    "start": "2021-01-01T00:00:00Z",
+                    "end": "2021-01-02T00:00:00Z",
+                    "cursor": None,
+                    "done": False,
+                }
+            ],
+            [
+                {
+                    "start": "2021-01-02T00:00:00Z",
+                    "end": "2021-01-03T00:00:00Z",
+                    "cursor": None,
+                    "done": False,
+                }
+            ],
+        ]
+        # products and components are only sent by the first partition
+        assert "metadata_fingerprint" not in states[0]
+        synced = main(FivetranRequest(json={"secrets": CONFIG, "state": {}}))
+        assert synced["state"]["metadata_fingerprint"] == (
+            states[1]["metadata_fingerprint"]
+        )
+
+        finished = [
+            {"since_id": "2021-01-01T23:59:00Z"},
+            {"since_id": "2021-01-02T11:59:00Z"},
+        ]
+        assert backfill_state(finished) == finished[1]
+
+    def test_query_plan_chunks_components(self):
+        components = {
+            "Core": [{"name": name} for name in ["DOM", "CSS", "Layout", "Networking"]],
+            "Firefox": [],
+        }
+
+        assert plan_queries(components, None, 2000) == [
+            {"product": "Core"},
+            {"product": "Firefox"},
+        ]
+        assert plan_queries(components, 3, 2000) == [
+            {"product": "Core", "components": ["CSS", "DOM", "Layout"]},
+            {"product": "Core", "components": ["Networking"]},
+            {"product": "Firefox"},
+        ]
+        max_length = query_length("Core", ["CSS", "DOM"])
+        assert plan_queries(components, 3, max_length)[:2] == [
+            {"product": "Core", "components": ["CSS", "DOM"]},
+            {"product": "Core", "components": ["Layout"]},
+        ]
@@ -1,7 +1,23 @@
 import logging
-from typing import Any, Dict
+import threading
+import time
+from dataclasses import dataclass
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
 
-import requests
+from runtime.changes import ChangeTracker, LocalDigestStore, StateDigestStore
+from runtime.concurrency import TaskCancelled, map_concurrent, run_concurrent
+from runtime.conditional import NOT_MODIFIED
+from runtime.conditional import STATE_KEY as PAGE_CACHE_STATE_KEY
+from runtime.conditional import Page, PageCache, page_key
+from runtime.deadline import TimeBudget
+from runtime.metrics import STATE_KEY as METRICS_STATE_KEY
+from runtime.metrics import instrumented
+from runtime.paging import STATE_KEY as PAGE_SIZES_STATE_KEY
+from runtime.paging import AdaptivePageSize
+from runtime.ratelimit import configure_host
+from runtime.response import ResponseWriter
+from runtime.session import get_session
 
 logging.basicConfig(
     format="[%(asctime)s] {%(filename)s:%(lineno)d} %(levelname)s - %(message)s"
@@ -15,11 +31,139 @@ SCHEMA = {
 QUERY_RESULT_LIMIT = 100
 
 CASA_URL = "https://biztera.com/api/v1"
-PROJECTS_URL = f"{CASA_URL}/projects"
-USERS_URL = f"{CASA_URL}/users"
+PROJECTS_PATH = "/projects"
+USERS_PATH = "/users"
+PROJECTS_URL = f"{CASA_URL}{PROJECTS_PATH}"
+USERS_URL = f"{CASA_URL}{USERS_PATH}"
 
+# default directory for row digests if change detection uses the local store
+DIGEST_DIRECTORY = "/tmp/casa_row_digests"
+# default directory for page validators if the page cache uses the local store
+PAGE_CACHE_DIRECTORY = "/tmp/casa_page_validators"
 
-def main(request):
+# defaults for `users_prefetch`, the number of users pages requested at the same time
+DEFAULT_PREFETCH_INITIAL_PAGES = 2
+DEFAULT_PREFETCH_MAX_PAGES = 8
+PREFETCH_STATE_KEY = "users_prefetch"
+
+# state at the start of a new sync
+INITIAL_STATE = {
+    "fetch_more_users": True,
+    "fetch_more_projects": True,
+    "users_offset": 0,
+    "projects_bookmark": None,
+}
+
+
+@dataclass
+class CasaClient:
+    """Sends authenticated requests to the CASA API."""
+
+    access_token: str
+    # can be changed to point the connector to a stand-in of the API
+    base_url: str = CASA_URL
+
+    def fetch(
+        self,
+        path: str,
+        request_params: Optional[Dict[str, Any]] = None,
+        cancelled: Optional[threading.Event] = None,
+        limit: int = QUERY_RESULT_LIMIT,
+    ):
+        return self.get(path, request_params, cancelled, limit).json()
+
+    def get(
+        self,
+        path: str,
+        request_params: Optional[Dict[str, Any]] = None,
+        cancelled: Optional[threading.Event] = None,
+        limit: int = QUERY_RESULT_LIMIT,
+        headers: Optional[Dict[str, str]] = None,
+    ):
+        """
+        Send a request and return the response.
+
+        With conditional `headers`, the response may be `304 Not Modified`.
+        """
+        url = f"{self.base_url}{path}"
+        if cancelled is not None and cancelled.is_set():
+            raise TaskCancelled(f"Request to {url} cancelled")
+
+        request_params = request_params or {}
+        request_params["limit"] = limit
+
+        logging.info(f"Sending request to {url} with params: {request_params}")
+
+        conditional = bool(headers)
+        headers = {**(headers or {}), "Authorization": f"Bearer {self.access_token}"}
+
+        http_response = get_session().get(
+            url=url, params=request_params, headers=headers
+        )
+
+        if http_response.status_code == NOT_MODIFIED and conditional:
+            return http_response
+        if http_response.status_code != 200:
+            raise Exception(
+                f"Error connecting to Biztera API (url: {url}). Response: {http_response}"
+            )
+
+        return http_response
+
+
+# writes the rows of a page and the keys of unchanged rows, returns the rows' size
+WritePage = Callable[[List[Dict[str, Any]], List[Any]], int]
+
+
+@dataclass
+class StreamResult:
+    """Progress of a single table, whose pages have been written to the response."""
+
+    state: Dict[str, Any]
+    has_more: bool
+    # whether the last page of the table has been fetched in this invocation
+    finished: bool = False
+    # serialized size of the rows written, 0 unless the response is serialized
+    num_bytes: int = 0
+
+
+@dataclass
+class Prefetch:
+    """
+    Number of users pages requested at the same time, tuned between rounds.
+
+    The width doubles after every round of full pages, up to `max_pages`. The round
+    that reaches the end of the users is cut short, and if more of its requests were
+    wasted than used, the width is halved for the next sync.
+    """
+
+    pages: int
+    max_pages: int
+
+    @classmethod
+    def from_config(
+        cls, config: Optional[Dict[str, Any]], state: Optional[Dict[str, Any]]
+    ) -> Optional["Prefetch"]:
+        if config is None:
+            return None
+        max_pages = int(config.get("max_pages", DEFAULT_PREFETCH_MAX_PAGES))
+        initial = int(config.get("initial_pages", DEFAULT_PREFETCH_INITIAL_PAGES))
+        pages = int((state or {}).get("pages", initial))
+        return cls(pages=max(1, min(pages, max_pages)), max_pages=max_pages)
+
+    def observe(self, requested: int, used: int, finished: bool):
+        """Record a round of `requested` pages, of which `used` had users."""
+        if not finished:
+            self.pages = min(self.max_pages, self.pages * 2)
+        elif requested - used > used:
+            self.pages = max(1, self.pages // 2)
+
+    def to_state(self) -> Dict[str, Any]:
+        return {"pages": self.pages}
+
+
+@instrumented("casa")
+def main(request, metrics):
     """
     Function to execute.
 
@@ -35,100 +179,349 @@ def main(request):
 
     logging.info(f"Received Fivetran request with state: {state}")
 
-    access_token = config["access_token"]
+    client = CasaClient(config["access_token"], config.get("url", CASA_URL))
+    # requests are paced and throttled ones retried, optionally with custom limits
+    configure_host(client.base_url, config.get("rate_limit"))
+    budget = TimeBudget.from_config(config.get("time_budget"))
 
-    fetch_more_projects = state.get("fetch_more_projects", True)
-    fetch_more_users = state.get("fetch_more_users", True)
-    users_offset = state.get("users_offset", 0)
-    projects_bookmark = state.get("projects_bookmark")
+    # page sizes are fixed to QUERY_RESULT_LIMIT unless adaptive sizing is configured
+    page_size_config = config.get("page_size")
+    previous_page_sizes = state.get(PAGE_SIZES_STATE_KEY, {})
+    page_sizes = {
+        table: AdaptivePageSize.from_config(
+            page_size_config, previous_page_sizes.get(table), QUERY_RESULT_LIMIT
+        )
+        for table in STREAMS
+    }
 
-    def _fetch(url, request_params=None):
-        request_params = request_params or {}
-        request_params["limit"] = QUERY_RESULT_LIMIT
+    # optionally request several users pages at the same time
+    prefetch = Prefetch.from_config(
+        config.get("users_prefetch"), state.get(PREFETCH_STATE_KEY)
+    )
+    streams = dict(STREAMS)
+    if prefetch is not None:
+        streams["users"] = partial(fetch_users, prefetch=prefetch)
 
-        logging.info(f"Sending request to {url} with params: {request_params}")
+    # Pages are written to the response as they arrive. With `serialize_response`
+    # they're serialized right away, so rows of previous pages aren't kept as dicts.
+    # Only serialized rows have a known size, which budgets and page sizes rely on.
+    serialize = config.get(
+        "serialize_response", budget is not None or page_size_config is not None
+    )
+    writer = ResponseWriter(SCHEMA, serialize=serialize)
+    # tables are added in a stable order, independent of which stream finishes first
+    for table in STREAMS:
+        writer.write_rows(table, [])
 
-        headers = {"Authorization": f"Bearer {access_token}"}
+    # optionally only send rows that changed since the last full import
+    digest_store = get_digest_store(config, state)
+    trackers = {}
+    if digest_store is not None:
+        trackers = {table: ChangeTracker(table, digest_store) for table in STREAMS}
 
-        http_response = requests.get(url=url, params=request_params, headers=headers)
+    # optionally request pages conditionally and skip the ones that haven't changed
+    page_store = get_page_store(config, state)
+    page_caches = {}
+    if page_store is not None:
+        page_caches = {table: PageCache(table, page_store) for table in STREAMS}
 
-        if http_response.status_code != 200:
-            raise Exception(
-                f"Error connecting to Biztera API (url: {url}). Response: {http_response}"
-            )
+    def write_page(
+        table: str, rows: List[Dict[str, Any]], unchanged_keys: List[Any]
+    ) -> int:
+        if table in trackers:
+            trackers[table].keep(unchanged_keys)
+            rows = trackers[table].changed_rows(rows)
+        num_bytes = writer.write_rows(table, rows)
+        metrics.add_rows(table, len(rows), num_bytes)
+        return num_bytes
 
-        return http_response.json()
+    # streams are independent of each other, so they are fetched concurrently
+    with metrics.phase("fetch"):
+        results = run_concurrent(
+            {
+                table: partial(
+                    fetch_pages,
+                    fetch_stream,
+                    client,
+                    state,
+                    page_sizes[table],
+                    budget,
+                    page_caches.get(table),
+                    partial(write_page, table),
+                )
+                for table, fetch_stream in streams.items()
+            }
+        )
 
-    projects = []
-    new_fetch_more_projects = False
-    new_projects_bookmark = None
+    has_more = any(result.has_more for result in results.values())
 
-    if fetch_more_projects:
-        if projects_bookmark is not None:
-            projects_response = _fetch(
-                PROJECTS_URL, request_params={"bookmark": projects_bookmark}
-            )
-        else:
-            projects_response = _fetch(PROJECTS_URL)
+    new_state = {}
+    for result in results.values():
+        new_state.update(result.state)
 
-        projects = projects_response["data"]
-        metadata = projects_response["metadata"]
+    # Reset state for next sync
+    if not has_more:
+        new_state = dict(INITIAL_STATE)
 
-        if "nextPage" in metadata:
-            new_projects_bookmark = metadata["nextPage"]["bookmark"]
-            new_fetch_more_projects = True
+    if digest_store is not None:
+        with metrics.phase("transform"):
+            for table, result in results.items():
+                tracker = trackers[table]
+                if result.finished:
+                    writer.write_deletes(table, tracker.finish())
+                tracker.save()
+            new_state.update(digest_store.to_state())
 
-    users = []
-    new_fetch_more_users = False
-    new_users_offset = 0
+    if page_store is not None:
+        for table, result in results.items():
+            page_cache = page_caches[table]
+            if result.finished:
+                page_cache.finish()
+            page_cache.save()
+        new_state.update(page_store.to_state())
 
-    if fetch_more_users:
-        users = _fetch(USERS_URL, request_params={"offset": users_offset})
-        if len(users) == QUERY_RESULT_LIMIT:
-            new_fetch_more_users = True
-            new_users_offset = users_offset + QUERY_RESULT_LIMIT
+    if page_size_config is not None:
+        new_state[PAGE_SIZES_STATE_KEY] = {
+            table: page_size.to_state() for table, page_size in page_sizes.items()
+        }
 
-    has_more = new_fetch_more_users or new_fetch_more_projects
+    if prefetch is not None:
+        new_state[PREFETCH_STATE_KEY] = prefetch.to_state()
 
-    # Reset state for next sync
-    if not has_more:
-        new_fetch_more_projects = True
-        new_fetch_more_users = True
-        new_projects_bookmark = None
-        new_users_offset = 0
-
-    new_state = {
-        "fetch_more_users": new_fetch_more_users,
-        "fetch_more_projects": new_fetch_more_projects,
-        "users_offset": new_users_offset,
-        "projects_bookmark": new_projects_bookmark,
-    }
+    if config.get("metrics_in_state", False):
+        new_state[METRICS_STATE_KEY] = metrics.summary()
 
     logging.info(
-        f"Updated state: {new_state}, hasMore: {has_more}, inserting {len(users)} users and {len(projects)} projects."
+        f"Updated state: {new_state}, hasMore: {has_more}, inserting "
+        f"{writer.row_counts.get('users', 0)} users and "
+        f"{writer.row_counts.get('projects', 0)} projects."
     )
 
-    return response(
-        state=new_state,
-        schema=SCHEMA,
-        inserts={"users": users, "projects": projects},
-        deletes={},
-        hasMore=has_more,
+    with metrics.phase("serialize"):
+        return writer.finish(new_state, hasMore=has_more)
+
+
+def fetch_pages(
+    fetch_stream: Callable[..., StreamResult],
+    client: CasaClient,
+    state: Dict[str, Any],
+    page_size: AdaptivePageSize,
+    budget: Optional[TimeBudget],
+    page_cache: Optional[PageCache],
+    write_page: WritePage,
+    cancelled: threading.Event,
+) -> StreamResult:
+    """
+    Fetch pages of a stream until it is done or the time budget is used up.
+
+    Without a budget only a single page is fetched. Every page is passed to
+    `write_page` as soon as it has been fetched.
+    """
+    num_bytes = 0
+    while True:
+        start = time.monotonic()
+        result = fetch_stream(
+            client, state, page_size, page_cache, write_page, cancelled
+        )
+        num_bytes += result.num_bytes
+
+        if budget is None or not result.has_more:
+            break
+
+        budget.add_bytes(result.num_bytes)
+        if not budget.allows_another_page(time.monotonic() - start, result.num_bytes):
+            break
+        state = {**state, **result.state}
+
+    return StreamResult(
+        state=result.state,
+        has_more=result.has_more,
+        finished=result.finished,
+        num_bytes=num_bytes,
+    )
+
+
+def fetch_page(
+    client: CasaClient,
+    path: str,
+    request_params: Dict[str, Any],
+    cancelled: threading.Event,
+    limit: int,
+    page_cache: Optional[PageCache],
+) -> Page:
+    """Fetch a page, conditionally if a page cache is used."""
+    key = page_key({"path": path, **request_params, "limit": limit})
+    if page_cache is None:
+        payload = client.fetch(path, request_params, cancelled, limit)
+        return Page(key, payload=payload, validators={})
+    return page_cache.fetch(
+        key, partial(client.get, path, request_params, cancelled, limit)
     )
 
 
-def response(
+def fetch_projects(
+    client: CasaClient,
     state: Dict[str, Any],
-    schema: Dict[Any, Any],
-    inserts: Dict[Any, Any] = {},
-    deletes: Dict[Any, Any] = {},
-    hasMore: bool = False,
-):
-    """Creates the response JSON object that will be processed by Fivetran."""
-    return {
-        "state": state,
-        "schema": schema,
-        "insert": inserts,
-        "delete": deletes,
-        "hasMore": hasMore,
+    page_size: AdaptivePageSize,
+    page_cache: Optional[PageCache],
+    write_page: WritePage,
+    cancelled: threading.Event,
+) -> StreamResult:
+    """Fetch the next page of projects, which are paged by bookmark."""
+    num_bytes = 0
+    new_state: Dict[str, Any] = {
+        "fetch_more_projects": False,
+        "projects_bookmark": None,
     }
+
+    fetched = state.get("fetch_more_projects", True)
+    if fetched:
+        projects_bookmark = state.get("projects_bookmark")
+        request_params = {}
+        if projects_bookmark is not None:
+            request_params["bookmark"] = projects_bookmark
+
+        start = time.monotonic()
+        page = fetch_page(
+            client, PROJECTS_PATH, request_params, cancelled, page_size.size, page_cache
+        )
+
+        seconds = time.monotonic() - start
+
+        projects = []
+        if page.payload is not None:
+            projects = page.payload["data"]
+            metadata = page.payload["metadata"]
+
+            if "nextPage" in metadata:
+                new_state = {
+                    "fetch_more_projects": True,
+                    "projects_bookmark": metadata["nextPage"]["bookmark"],
+                }
+
+        if page.unchanged is not None:
+            new_state = page.unchanged["state"]
+            num_bytes = write_page([], page.unchanged["keys"])
+        else:
+            if page_cache is not None:
+                page_cache.put(page, [project["id"] for project in projects], new_state)
+            num_bytes = write_page(projects, [])
+        page_size.observe(len(projects), seconds, num_bytes)
+
+    return StreamResult(
+        state=new_state,
+        has_more=new_state["fetch_more_projects"],
+        finished=fetched and not new_state["fetch_more_projects"],
+        num_bytes=num_bytes,
+    )
+
+
+def fetch_users(
+    client: CasaClient,
+    state: Dict[str, Any],
+    page_size: AdaptivePageSize,
+    page_cache: Optional[PageCache],
+    write_page: WritePage,
+    cancelled: threading.Event,
+    prefetch: Optional[Prefetch] = None,
+) -> StreamResult:
+    """
+    Fetch the next page of users, which are paged by offset.
+
+    Offset pages don't depend on each other, so with `prefetch` the next pages are
+    requested at the same time. Pages after the first one that isn't full are dropped.
+    """
+    num_bytes = 0
+    new_state: Dict[str, Any] = {"fetch_more_users": False, "users_offset": 0}
+
+    fetched = state.get("fetch_more_users", True)
+    if fetched:
+        users_offset = state.get("users_offset", 0)
+        limit = page_size.size
+        width = prefetch.pages if prefetch is not None else 1
+        offsets = [users_offset + i * limit for i in range(width)]
+        start = time.monotonic()
+        pages = map_concurrent(
+            lambda offset: fetch_page(
+                client, USERS_PATH, {"offset": offset}, cancelled, limit, page_cache
+            ),
+            offsets,
+            max_workers=width,
+        )
+        seconds = time.monotonic() - start
+
+        used = 0
+        for offset, page in zip(offsets, pages):
+            used += 1
+            page_users = []
+            page_state = {"fetch_more_users": False, "users_offset": 0}
+            if page.payload is not None:
+                page_users = page.payload
+                if len(page_users) == limit:
+                    page_state = {
+                        "fetch_more_users": True,
+                        "users_offset": offset + limit,
+                    }
+
+            if page.unchanged is not None:
+                page_state = page.unchanged["state"]
+                page_bytes = write_page([], page.unchanged["keys"])
+            else:
+                if page_cache is not None:
+                    page_cache.put(
+                        page, [user["id"] for user in page_users], page_state
+                    )
+                page_bytes = write_page(page_users, [])
+            num_bytes += page_bytes
+            # pages of a round are fetched at the same time, each took about as long
+            # as the round
+            page_size.observe(len(page_users), seconds, page_bytes)
+
+            new_state = page_state
+            if not new_state["fetch_more_users"]:
+                break
+
+        if prefetch is not None:
+            prefetch.observe(width, used, not new_state["fetch_more_users"])
+
+    return StreamResult(
+        state=new_state,
+        has_more=new_state["fetch_more_users"],
+        finished=fetched and not new_state["fetch_more_users"],
+        num_bytes=num_bytes,
+    )
+
+
+def get_digest_store(config: Dict[str, Any], state: Dict[str, Any]):
+    """Return where row digests are kept, or None if change detection is disabled."""
+    change_detection = config.get("change_detection")
+    if change_detection is None:
+        return None
+    if change_detection == "state":
+        return StateDigestStore(state)
+    if change_detection == "local":
+        return LocalDigestStore(config.get("digest_directory", DIGEST_DIRECTORY), state)
+    raise ValueError(f"Unsupported change detection mode: {change_detection}")
+
+
+def get_page_store(config: Dict[str, Any], state: Dict[str, Any]):
+    """Return where page validators are kept, or None if pages are always fetched."""
+    page_cache = config.get("page_cache")
+    if page_cache is None:
+        return None
+    if page_cache == "state":
+        return StateDigestStore(state, key=PAGE_CACHE_STATE_KEY)
+    if page_cache == "local":
+        return LocalDigestStore(
+            config.get("page_cache_directory", PAGE_CACHE_DIRECTORY),
+            state,
+            key=PAGE_CACHE_STATE_KEY,
+        )
+    raise ValueError(f"Unsupported page cache mode: {page_cache}")
+
+
+# tables and the functions fetching them, every stream manages its own state keys
+STREAMS = {
+    "projects": fetch_projects,
+    "users": fetch_users,
+}
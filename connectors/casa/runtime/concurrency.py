@@ -0,0 +1,70 @@
+"""Helpers for running independent upstream requests concurrently."""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Iterable, List, Optional, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+DEFAULT_MAX_WORKERS = 8
+
+
+def map_concurrent(
+    func: Callable[[T], R], items: Iterable[T], max_workers: int = DEFAULT_MAX_WORKERS
+) -> List[R]:
+    """
+    Apply `func` to every item on a bounded thread pool.
+
+    Results are returned in the order of `items`, independent of the order in which
+    the calls finish. If a call raises, calls that haven't started yet are cancelled
+    and the exception is re-raised.
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        futures = [executor.submit(func, item) for item in items]
+        try:
+            return [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+class TaskCancelled(Exception):
+    """Raised by a task that stops early because another task has failed."""
+
+
+def run_concurrent(
+    tasks: Dict[str, Callable[[threading.Event], R]],
+    max_workers: Optional[int] = None,
+) -> Dict[str, R]:
+    """
+    Run independent named tasks concurrently and return their results by name.
+
+    Every task is passed a `threading.Event` that gets set as soon as any task fails.
+    Long-running tasks should check it between upstream requests and raise
+    `TaskCancelled` to stop cleanly. Tasks that haven't started yet are cancelled and
+    the error of the first failing task is re-raised once all running tasks stopped.
+    """
+    if not tasks:
+        return {}
+
+    cancelled = threading.Event()
+    with ThreadPoolExecutor(max_workers=max_workers or len(tasks)) as executor:
+        futures = {
+            executor.submit(task, cancelled): name for name, task in tasks.items()
+        }
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            cancelled.set()
+            for future in futures:
+                future.cancel()
+            raise
+
+    return {name: future.result() for future, name in futures.items()}
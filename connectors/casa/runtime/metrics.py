@@ -0,0 +1,195 @@
+"""
+Per-invocation metrics of connectors.
+
+A `Metrics` object collects phase timings, latencies of HTTP calls, retries and the
+rows and bytes synced per table during a single invocation. At the end of the
+invocation it is emitted as a single JSON line on stdout, which Cloud Logging parses
+into a structured log record, so slow syncs can be attributed to upstream latency,
+transforming data or serializing the response.
+
+Connectors wrap `main` with `instrumented`, which passes the `Metrics` object of the
+invocation to it. HTTP calls made through sessions from `runtime.session` are recorded
+automatically while a `Metrics` object is active.
+"""
+
+import functools
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional
+from urllib.parse import urlsplit
+
+from .profiling import profiled
+
+# common phases of an invocation, connectors may record others as well
+PHASES = ("auth", "discovery", "fetch", "transform", "serialize")
+
+# upper bounds in milliseconds of the buckets of HTTP latency histograms
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+STATE_KEY = "metrics"
+
+# an instance serves one invocation at a time, so there's at most one active object
+_active: Optional["Metrics"] = None
+
+
+class Metrics:
+    """Collects the metrics of a single connector invocation."""
+
+    def __init__(self, connector: str, clock: Callable[[], float] = time.perf_counter):
+        self.connector = connector
+        self.clock = clock
+        self.started = clock()
+        self.phases: Dict[str, float] = defaultdict(float)
+        self.requests: Dict[str, Dict[str, Any]] = {}
+        self.retries: Dict[str, int] = defaultdict(int)
+        self.tables: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Add the time spent within the block to phase `name`."""
+        start = self.clock()
+        try:
+            yield
+        finally:
+            seconds = self.clock() - start
+            with self._lock:
+                self.phases[name] += seconds
+
+    def record_request(self, endpoint: str, seconds: float, status: Optional[int]):
+        """Record an HTTP call to `endpoint` that took `seconds`."""
+        milliseconds = seconds * 1000
+        bucket = next(
+            (str(bound) for bound in LATENCY_BUCKETS if milliseconds <= bound), "+Inf"
+        )
+        with self._lock:
+            stats = self.requests.setdefault(
+                endpoint,
+                {"count": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0},
+            )
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            if status is None or status >= 400:
+                stats["errors"] += 1
+            buckets = stats.setdefault("buckets_ms", {})
+            buckets[bucket] = buckets.get(bucket, 0) + 1
+
+    def record_retry(self, endpoint: str, count: int = 1):
+        with self._lock:
+            self.retries[endpoint] += count
+
+    def add_rows(self, table: str, rows: int, num_bytes: int = 0):
+        """Add `rows` rows with a serialized size of `num_bytes` synced to `table`."""
+        with self._lock:
+            stats = self.tables.setdefault(table, {"rows": 0, "bytes": 0})
+            stats["rows"] += rows
+            stats["bytes"] += num_bytes
+
+    @property
+    def elapsed(self) -> float:
+        return self.clock() - self.started
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "connector": self.connector,
+                "seconds": round(self.elapsed, 3),
+                "phases": {name: round(s, 3) for name, s in self.phases.items()},
+                "http": {
+                    endpoint: {
+                        **stats,
+                        "seconds": round(stats["seconds"], 3),
+                        "max_seconds": round(stats["max_seconds"], 3),
+                    }
+                    for endpoint, stats in self.requests.items()
+                },
+                "retries": dict(self.retries),
+                "tables": {table: dict(stats) for table, stats in self.tables.items()},
+            }
+
+    def summary(self) -> Dict[str, Any]:
+        """Return a compact version of the metrics to include in the state."""
+        with self._lock:
+            return {
+                "seconds": round(self.elapsed, 2),
+                "phases": {name: round(s, 2) for name, s in self.phases.items()},
+                "requests": sum(stats["count"] for stats in self.requests.values()),
+                "retries": sum(self.retries.values()),
+                "rows": {table: stats["rows"] for table, stats in self.tables.items()},
+            }
+
+    def emit(self, stream=None, failed: bool = False):
+        """Write the metrics as a structured log record in a single line."""
+        record = {
+            "severity": "ERROR" if failed else "INFO",
+            "message": f"{self.connector} invocation "
+            + ("failed" if failed else "metrics"),
+            "metrics": self.to_dict(),
+        }
+        stream = stream or sys.stdout
+        stream.write(json.dumps(record) + "\n")
+        stream.flush()
+
+    def __enter__(self) -> "Metrics":
+        global _active
+        _active = self
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        _active = None
+
+
+def active() -> Optional[Metrics]:
+    """Return the metrics of the current invocation, if any are being collected."""
+    return _active
+
+
+def record_response(response, *args, **kwargs):
+    """`requests` response hook recording the latency of HTTP calls."""
+    metrics = _active
+    if metrics is None:
+        return
+    # IDs in paths, e.g. of `/rest/bug/<id>/history`, would make an endpoint per row
+    endpoint = "/".join(
+        "{id}" if segment.isdigit() else segment
+        for segment in urlsplit(response.url).path.split("/")
+    )
+    metrics.record_request(
+        endpoint, response.elapsed.total_seconds(), response.status_code
+    )
+    retries = getattr(getattr(response.raw, "retries", None), "history", None)
+    if retries:
+        metrics.record_retry(endpoint, len(retries))
+
+
+def instrumented(connector: str):
+    """
+    Decorate a connector's `main(request, metrics)` to collect and emit its metrics.
+
+    The decorated function takes just the request, like Cloud Functions expect.
+    Metrics are emitted after failed invocations as well. Invocations are profiled if
+    configured, see `runtime.profiling`.
+    """
+
+    def decorator(main: Callable[[Any, Metrics], Any]) -> Callable[[Any], Any]:
+        @functools.wraps(main)
+        def wrapper(request):
+            secrets = (request.json or {}).get("secrets")
+            with Metrics(connector) as metrics, profiled(connector, secrets):
+                try:
+                    result = main(request, metrics)
+                except Exception:
+                    metrics.emit(failed=True)
+                    raise
+                metrics.emit()
+                return result
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,273 @@
+"""
+Sampled profiling of connector invocations.
+
+Profiling is opt-in: it is configured with a `profiling` entry in the secrets or, for
+all connectors of a deployment, with the same JSON in the `CONNECTOR_PROFILING`
+environment variable. A fraction `sample_rate` of invocations then runs under cProfile
+and tracemalloc, and every profiled invocation writes a gzip-compressed JSON artifact
+with the time spent per function and the top allocation sites to a sink: a local
+directory, or a bucket of an object store such as Cloud Storage.
+
+`fivetran profile show` merges the artifacts of many invocations into a report.
+
+cProfile only profiles the thread it is enabled in, so threads started during the
+invocation, e.g. by `runtime.concurrency`, get their own profiler, and the results
+are merged. Threads started before the invocation aren't profiled.
+"""
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+# cProfile, tracemalloc, gzip and uuid are imported where they're used, which keeps them
+# out of cold starts while profiling is disabled
+
+ENV_VAR = "CONNECTOR_PROFILING"
+
+DEFAULT_SAMPLE_RATE = 0.01
+DEFAULT_DIRECTORY = "/tmp/connector_profiles"
+# number of allocation sites kept per invocation
+DEFAULT_TOP_ALLOCATIONS = 50
+
+ARTIFACT_SUFFIX = ".profile.json.gz"
+
+
+class DirectorySink:
+    """Writes profile artifacts to a local directory."""
+
+    def __init__(self, directory: str = DEFAULT_DIRECTORY):
+        self.directory = Path(directory)
+
+    def write(self, name: str, data: bytes):
+        path = self.directory / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+    def names(self) -> List[str]:
+        return sorted(
+            str(path.relative_to(self.directory))
+            for path in self.directory.rglob(f"*{ARTIFACT_SUFFIX}")
+        )
+
+    def read(self, name: str) -> bytes:
+        return (self.directory / name).read_bytes()
+
+
+class ObjectStoreSink:
+    """
+    Writes profile artifacts to a bucket of Cloud Storage, or of a local stand-in.
+
+    `client` is a `google.cloud.storage.Client` or an object with the same methods.
+    Without it, a client is created on first use, for the emulator at `endpoint` if
+    given. google-cloud-storage is only imported then, so connectors that write to
+    an object store need to add it to their requirements.
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "",
+        client: Any = None,
+        endpoint: Optional[str] = None,
+    ):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = client
+        self.endpoint = endpoint
+
+    def _client(self):
+        if self.client is None:
+            from google.cloud import storage
+
+            if self.endpoint is None:
+                self.client = storage.Client()
+            else:
+                from google.auth.credentials import AnonymousCredentials
+
+                self.client = storage.Client(
+                    project="local",
+                    credentials=AnonymousCredentials(),
+                    client_options={"api_endpoint": self.endpoint},
+                )
+        return self.client
+
+    def write(self, name: str, data: bytes):
+        blob = self._client().bucket(self.bucket).blob(self.prefix + name)
+        blob.upload_from_string(data, content_type="application/gzip")
+
+    def names(self) -> List[str]:
+        return sorted(
+            blob.name[len(self.prefix) :]
+            for blob in self._client().list_blobs(self.bucket, prefix=self.prefix)
+            if blob.name.endswith(ARTIFACT_SUFFIX)
+        )
+
+    def read(self, name: str) -> bytes:
+        blob = self._client().bucket(self.bucket).blob(self.prefix + name)
+        return blob.download_as_bytes()
+
+
+def sink_from_config(config: Dict[str, Any]):
+    """Return the sink configured in a `profiling` config."""
+    sink = config.get("sink", "directory")
+    if sink == "directory":
+        return DirectorySink(config.get("directory", DEFAULT_DIRECTORY))
+    if sink == "object_store":
+        return ObjectStoreSink(
+            config["bucket"], config.get("prefix", ""), endpoint=config.get("endpoint")
+        )
+    raise ValueError(f"Unsupported profile sink: {sink}")
+
+
+def profiling_config(secrets: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Return the profiling config of the secrets or the environment, if any."""
+    config = (secrets or {}).get("profiling")
+    if config is None and os.environ.get(ENV_VAR):
+        config = json.loads(os.environ[ENV_VAR])
+    return config
+
+
+class _ThreadProfiles:
+    """Profile hook of new threads, which enables a profiler per thread."""
+
+    def __init__(self):
+        self.profiles: List[Any] = []
+        self._lock = threading.Lock()
+
+    def __call__(self, frame, event, arg):
+        import cProfile
+
+        profile = cProfile.Profile()
+        with self._lock:
+            self.profiles.append(profile)
+        # replaces this hook in the calling thread
+        profile.enable()
+
+
+class InvocationProfiler:
+    """Profiles time per function and allocation sites of a single invocation."""
+
+    def __init__(self, connector: str, top_allocations: int = DEFAULT_TOP_ALLOCATIONS):
+        import cProfile
+
+        self.connector = connector
+        self.top_allocations = top_allocations
+        self.profile = cProfile.Profile()
+        self.threads = _ThreadProfiles()
+        self.started_at = datetime.now(timezone.utc)
+        self._started = 0.0
+        # tracemalloc may be tracing already, e.g. while benchmarking
+        self._tracing = False
+
+    def start(self):
+        import tracemalloc
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        self._started = time.perf_counter()
+        threading.setprofile(self.threads)
+        self.profile.enable()
+
+    def stop(self, failed: bool = False) -> Dict[str, Any]:
+        """Stop profiling and return the results."""
+        import tracemalloc
+
+        self.profile.disable()
+        threading.setprofile(None)
+        seconds = time.perf_counter() - self._started
+
+        # allocation sites of the memory that is still held, e.g. by the response
+        allocations = []
+        peak_bytes = None
+        if self._tracing:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            allocations = [
+                [frame.filename, frame.lineno, stat.size, stat.count]
+                for stat in snapshot.statistics("lineno")[: self.top_allocations]
+                for frame in stat.traceback[:1]
+            ]
+
+        functions: Dict[tuple, List[float]] = {}
+        for profile in [self.profile, *self.threads.profiles]:
+            profile.create_stats()
+            for function, (cc, nc, tt, ct, _) in profile.stats.items():
+                totals = functions.setdefault(function, [0, 0, 0.0, 0.0])
+                for i, value in enumerate((cc, nc, tt, ct)):
+                    totals[i] += value
+
+        return {
+            "connector": self.connector,
+            "started_at": self.started_at.isoformat(),
+            "seconds": seconds,
+            "failed": failed,
+            "threads": 1 + len(self.threads.profiles),
+            "functions": [
+                [*function, *totals] for function, totals in functions.items()
+            ],
+            "peak_bytes": peak_bytes,
+            "allocations": allocations,
+        }
+
+
+def artifact_name(connector: str, started_at: datetime) -> str:
+    import uuid
+
+    timestamp = started_at.strftime("%Y%m%dT%H%M%S")
+    return f"{connector}/{timestamp}-{uuid.uuid4().hex[:8]}{ARTIFACT_SUFFIX}"
+
+
+def encode_artifact(results: Dict[str, Any]) -> bytes:
+    import gzip
+
+    return gzip.compress(json.dumps(results, separators=(",", ":")).encode("utf-8"))
+
+
+def decode_artifact(data: bytes) -> Dict[str, Any]:
+    import gzip
+
+    return json.loads(gzip.decompress(data))
+
+
+@contextmanager
+def profiled(
+    connector: str, secrets: Optional[Dict[str, Any]] = None
+) -> Iterator[Optional[InvocationProfiler]]:
+    """
+    Profile the block if profiling is configured and the invocation is sampled.
+
+    Failing to write the artifact is logged, but doesn't fail the invocation.
+    """
+    config = profiling_config(secrets)
+    sample_rate = float((config or {}).get("sample_rate", DEFAULT_SAMPLE_RATE))
+    if config is None or random.random() >= sample_rate:
+        yield None
+        return
+
+    profiler = InvocationProfiler(
+        connector, int(config.get("top_allocations", DEFAULT_TOP_ALLOCATIONS))
+    )
+    profiler.start()
+    failed = True
+    try:
+        yield profiler
+        failed = False
+    finally:
+        results = profiler.stop(failed)
+        try:
+            sink_from_config(config).write(
+                artifact_name(connector, profiler.started_at), encode_artifact(results)
+            )
+        except Exception:
+            logging.exception("Failed to write profile of %s invocation", connector)
@@ -0,0 +1,127 @@
+from itertools import islice
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+from .serialization import CONTENT_TYPE, dumps, serialized_response
+
+# number of rows that are serialized at once by `ResponseWriter`
+CHUNK_ROWS = 1000
+
+
+def response(
+    state: Dict[str, Any],
+    schema: Dict[Any, Any],
+    inserts: Optional[Dict[Any, Any]] = None,
+    deletes: Optional[Dict[Any, Any]] = None,
+    hasMore: bool = False,
+    serialize: bool = False,
+):
+    """
+    Creates the response JSON object that will be processed by Fivetran.
+
+    With `serialize`, the response is returned as pre-serialized JSON bytes, which is
+    faster for large responses than letting the Functions framework serialize it.
+    """
+    body = {
+        "state": state,
+        "schema": schema,
+        "insert": inserts or {},
+        "delete": deletes or {},
+        "hasMore": hasMore,
+    }
+    if serialize:
+        return serialized_response(body)
+    return body
+
+
+class ResponseWriter:
+    """
+    Builds a response from rows that are written incrementally, e.g. page by page.
+
+    With `serialize`, rows are serialized in chunks of `chunk_rows` as they are written
+    and only their JSON is kept, so memory doesn't hold every row as a dict in addition
+    to the serialized response. Otherwise rows are collected for `response()` and
+    serialized by the Functions framework, so their size isn't known while writing.
+    """
+
+    def __init__(
+        self,
+        schema: Dict[Any, Any],
+        serialize: bool = False,
+        chunk_rows: int = CHUNK_ROWS,
+    ):
+        self.schema = schema
+        self.serialize = serialize
+        self.chunk_rows = chunk_rows
+        # number of inserted rows per table
+        self.row_counts: Dict[str, int] = {}
+        self._inserts: Dict[str, Any] = {}
+        self._deletes: Dict[str, Any] = {}
+
+    def write_rows(self, table: str, rows: Iterable[Dict[str, Any]]) -> int:
+        """
+        Add `rows` to the inserts of `table` and return their serialized size.
+
+        The size is only measured with `serialize`, otherwise it is 0.
+        """
+        return self._write(self._inserts, table, rows)
+
+    def write_records(
+        self, table: str, columns: Sequence[str], records: Iterable[Sequence[Any]]
+    ) -> int:
+        """Add rows given as tuples of the values of `columns` to `table`."""
+        return self.write_rows(
+            table, (dict(zip(columns, record)) for record in records)
+        )
+
+    def write_deletes(self, table: str, rows: Iterable[Dict[str, Any]]) -> int:
+        return self._write(self._deletes, table, rows)
+
+    def _write(self, target: Dict[str, Any], table: str, rows: Iterable) -> int:
+        buffer = target.setdefault(table, bytearray() if self.serialize else [])
+        num_bytes = 0
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, self.chunk_rows))
+            if not chunk:
+                return num_bytes
+            if target is self._inserts:
+                self.row_counts[table] = self.row_counts.get(table, 0) + len(chunk)
+            if not self.serialize:
+                buffer.extend(chunk)
+                continue
+            data = dumps(chunk)
+            num_bytes += len(data)
+            # append the rows without the surrounding brackets of the chunk
+            if buffer:
+                buffer += b","
+            buffer += memoryview(data)[1:-1]
+
+    def finish(self, state: Dict[str, Any], hasMore: bool = False):
+        """Return the response with all rows written so far."""
+        if not self.serialize:
+            return response(
+                state,
+                self.schema,
+                inserts=self._inserts,
+                deletes=self._deletes,
+                hasMore=hasMore,
+            )
+
+        # same layout as `response()`, joined without copying the row buffers first
+        parts: List[Any] = [
+            b'{"state":',
+            dumps(state),
+            b',"schema":',
+            dumps(self.schema),
+        ]
+        for key, tables in ((b"insert", self._inserts), (b"delete", self._deletes)):
+            parts.append(b',"' + key + b'":{')
+            for i, (table, buffer) in enumerate(tables.items()):
+                prefix = b"," if i else b""
+                parts += [prefix, dumps(table), b":[", buffer, b"]"]
+            parts.append(b"}")
+        parts.append(b',"hasMore":' + (b"true" if hasMore else b"false") + b"}")
+        body = b"".join(parts)
+        self._inserts.clear()
+        self._deletes.clear()
+        return body, 200, dict(CONTENT_TYPE)
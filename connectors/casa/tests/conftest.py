@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# Cloud Functions import `main` with the connector directory on the path, which is
+# what makes the vendored `runtime` package importable. Mirror that for tests.
+sys.path.insert(0, str(Path(__file__).parent.parent))
@@ -0,0 +1,61 @@
+import os
+from dataclasses import dataclass
+from pathlib import Path
+
+import casa.main as connector
+import pytest
+
+BASELINE = Path(__file__).parent / "benchmarks" / "baseline.json"
+SIZES = [
+    int(size)
+    for size in os.environ.get("BENCHMARK_SIZES", "1000,10000,100000").split(",")
+]
+
+pytestmark = pytest.mark.skipif(
+    not os.environ.get("RUN_BENCHMARKS"), reason="set RUN_BENCHMARKS=1 to run"
+)
+
+
+@dataclass
+class FivetranRequest:
+    json: dict
+
+
+def synthetic_responder(rows):
+    def respond(url, params):
+        if url == connector.PROJECTS_URL:
+            return {
+                "data": [
+                    {"id": i, "name": f"project_{i}", "status": "active"}
+                    for i in range(rows)
+                ],
+                "metadata": {"totalCount": rows},
+            }
+        return [
+            {"id": i, "name": f"user_{i}", "email": f"user_{i}@mozilla.com"}
+            for i in range(rows)
+        ]
+
+    return respond
+
+
+class TestBenchmark:
+    @pytest.mark.parametrize("rows", SIZES)
+    def test_main(self, rows):
+        # the harness is part of the tools, installed by `./fivetran bootstrap`
+        from tools.benchmark_harness import compare_to_baseline, run_benchmark
+
+        # fetch all rows of a table in a single page
+        config = {
+            "access_token": "token",
+            "page_size": {"min": rows, "max": rows, "initial": rows},
+        }
+        fivetran_request = FivetranRequest(json={"secrets": config, "state": {}})
+        results = run_benchmark(connector, fivetran_request, synthetic_responder(rows))
+        regressions = compare_to_baseline(
+            f"main_{rows}",
+            results,
+            BASELINE,
+            update=bool(os.environ.get("UPDATE_BENCHMARK_BASELINE")),
+        )
+        assert not regressions, regressions
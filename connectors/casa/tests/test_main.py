@@ -1,9 +1,13 @@
+import gzip
+import io
+import json
 from dataclasses import dataclass
 from typing import Union
 from unittest import mock
 
 import pytest
-from casa.main import QUERY_RESULT_LIMIT, main
+import requests
+from casa.main import PROJECTS_URL, QUERY_RESULT_LIMIT, USERS_URL, main
 
 
 @dataclass
@@ -20,8 +24,21 @@ class FivetranRequest:
     json: dict
 
 
+def http_response(status_code, json_data=None, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.raw = io.BytesIO(json.dumps(json_data).encode("utf-8"))
+    response.headers.update(headers or {})
+    return response
+
+
+def respond_by_url(responses):
+    # streams are fetched concurrently, so requests can happen in any order
+    return lambda url, **kwargs: responses[url]
+
+
 class TestMain:
-    @mock.patch("casa.main.requests.get")
+    @mock.patch("requests.Session.get")
     def test_exception_if_unable_to_connect(self, mock_get):
         state = {}
         mock_get.return_value = MockResponse(json_data={}, status_code=401)
@@ -31,7 +48,7 @@ class TestMain:
         with pytest.raises(Exception):
             main(fivetran_request)
 
-    @mock.patch("casa.main.requests.get")
+    @mock.patch("requests.Session.get")
     def test_should_get_more_users_and_projects_null_state(self, mock_get):
         state = {}
         valid_projects = {
@@ -49,7 +66,9 @@ class TestMain:
 
         projects_response = MockResponse(json_data=valid_projects, status_code=200)
         users_response = MockResponse(json_data=valid_users, status_code=200)
-        mock_get.side_effect = [projects_response, users_response]
+        mock_get.side_effect = respond_by_url(
+            {PROJECTS_URL: projects_response, USERS_URL: users_response}
+        )
 
         fivetran_request = FivetranRequest(
             json={"secrets": {"access_token": "valid_key"}, "state": state}
@@ -63,7 +82,7 @@ class TestMain:
         assert valid_projects["data"] == response["insert"]["projects"]
         assert valid_users == response["insert"]["users"]
 
-    @mock.patch("casa.main.requests.get")
+    @mock.patch("requests.Session.get")
     def test_should_get_more_users_but_not_projects_previous_state(self, mock_get):
         state = {
             "users_offset": QUERY_RESULT_LIMIT,
@@ -81,7 +100,9 @@ class TestMain:
 
         projects_response = MockResponse(json_data=valid_projects, status_code=200)
         users_response = MockResponse(json_data=valid_users, status_code=200)
-        mock_get.side_effect = [projects_response, users_response]
+        mock_get.side_effect = respond_by_url(
+            {PROJECTS_URL: projects_response, USERS_URL: users_response}
+        )
 
         fivetran_request = FivetranRequest(
             json={"secrets": {"access_token": "valid_key"}, "state": state}
@@ -97,7 +118,7 @@ class TestMain:
         assert valid_projects["data"] == response["insert"]["projects"]
         assert valid_users == response["insert"]["users"]
 
-    @mock.patch("casa.main.requests.get")
+    @mock.patch("requests.Session.get")
     def test_dont_fetch_projects_if_dont_need_to(self, mock_get):
         state = {
             "users_offset": QUERY_RESULT_LIMIT,
@@ -122,7 +143,7 @@ class TestMain:
         assert [] == response["insert"]["projects"]
         assert valid_users == response["insert"]["users"]
 
-    @mock.patch("casa.main.requests.get")
+    @mock.patch("requests.Session.get")
     def test_reset_state_if_no_more_to_fetch(self, mock_get):
         state = {
             "users_offset": QUERY_RESULT_LIMIT,
@@ -142,7 +163,9 @@ class TestMain:
         ]
         projects_response = MockResponse(json_data=valid_projects, status_code=200)
         users_response = MockResponse(json_data=valid_users, status_code=200)
-        mock_get.side_effect = [projects_response, users_response]
+        mock_get.side_effect = respond_by_url(
+            {PROJECTS_URL: projects_response, USERS_URL: users_response}
+        )
 
         fivetran_request = FivetranRequest(
             json={"secrets": {"access_token": "valid_key"}, "state": state}
@@ -156,3 +179,393 @@ class TestMain:
         assert None is response["state"]["projects_bookmark"]
         assert valid_projects["data"] == response["insert"]["projects"]
         assert valid_users == response["insert"]["users"]
+
+    @mock.patch("requests.Session.get")
+    def test_failing_stream_fails_request(self, mock_get):
+        valid_users = [{"id": i, "name": f"user_{i}"} for i in range(100)]
+        mock_get.side_effect = respond_by_url(
+            {
+                PROJECTS_URL: MockResponse(json_data={}, status_code=503),
+                USERS_URL: MockResponse(json_data=valid_users, status_code=200),
+            }
+        )
+        fivetran_request = FivetranRequest(
+            json={"secrets": {"access_token": "valid_key"}, "state": {}}
+        )
+        with pytest.raises(Exception, match="Error connecting to Biztera API"):
+            main(fivetran_request)
+
+    @mock.patch("requests.Session.get")
+    def test_change_detection_only_sends_changes(self, mock_get):
+        def sync(state, projects, users):
+            mock_get.side_effect = respond_by_url(
+                {
+                    PROJECTS_URL: MockResponse(
+                        json_data={"data": projects, "metadata": {}}, status_code=200
+                    ),
+                    USERS_URL: MockResponse(json_data=users, status_code=200),
+                }
+            )
+            return main(
+                FivetranRequest(
+                    json={
+                        "secrets": {
+                            "access_token": "valid_key",
+                            "change_detection": "state",
+                        },
+                        "state": state,
+                    }
+                )
+            )
+
+        projects = [{"id": i, "name": f"project_{i}"} for i in range(3)]
+        users = [{"id": i, "name": f"user_{i}"} for i in range(3)]
+        first = sync({}, projects, users)
+
+        assert projects == first["insert"]["projects"]
+        assert users == first["insert"]["users"]
+        assert {"projects": [], "users": []} == first["delete"]
+
+        users = [{"id": 0, "name": "renamed"}, users[1], {"id": 5, "name": "user_5"}]
+        second = sync(first["state"], projects, users)
+
+        assert [] == second["insert"]["projects"]
+        assert [users[0], users[2]] == second["insert"]["users"]
+        assert [{"id": 2}] == second["delete"]["users"]
+        assert [] == second["delete"]["projects"]
+        assert False is second["hasMore"]
+        assert 0 == second["state"]["users_offset"]
+
+    @mock.patch("requests.Session.get")
+    def test_local_digests_only_used_once_acknowledged(self, mock_get, tmp_path):
+        projects = [{"id": 1, "name": "project_1"}]
+        users = [{"id": i, "name": f"user_{i}"} for i in range(3)]
+        mock_get.side_effect = respond_by_url(
+            {
+                PROJECTS_URL: MockResponse(
+                    json_data={"data": projects, "metadata": {}}, status_code=200
+                ),
+                USERS_URL: MockResponse(json_data=users, status_code=200),
+            }
+        )
+
+        def sync(state):
+            secrets = {
+                "access_token": "valid_key",
+                "change_detection": "local",
+                "digest_directory": str(tmp_path),
+            }
+            return main(FivetranRequest(json={"secrets": secrets, "state": state}))
+
+        first = sync({})
+        assert users == first["insert"]["users"]
+
+        # Fivetran retries with the old state if the response wasn't committed
+        retried = sync({})
+        assert projects == retried["insert"]["projects"]
+        assert users == retried["insert"]["users"]
+
+        second = sync(retried["state"])
+        assert [] == second["insert"]["projects"]
+        assert [] == second["insert"]["users"]
+
+    @mock.patch("requests.Session.get")
+    def test_time_budget_fetches_several_pages(self, mock_get):
+        all_users = [{"id": i, "name": f"user_{i}"} for i in range(250)]
+
+        def get(url, params, **kwargs):
+            if url == PROJECTS_URL:
+                return MockResponse(
+                    json_data={"data": [{"id": 1}], "metadata": {}}, status_code=200
+                )
+            offset = params["offset"]
+            return MockResponse(
+                json_data=all_users[offset : offset + params["limit"]], status_code=200
+            )
+
+        mock_get.side_effect = get
+        fivetran_request = FivetranRequest(
+            json={
+                "secrets": {
+                    "access_token": "valid_key",
+                    "time_budget": {"fraction": 0.5},
+                },
+                "state": {},
+            }
+        )
+        # budgets need the size of the rows, so the response is serialized
+        body, _, _ = main(fivetran_request)
+        response = json.loads(body)
+
+        assert 4 == mock_get.call_count
+        assert all_users == response["insert"]["users"]
+        assert False is response["hasMore"]
+        assert 0 == response["state"]["users_offset"]
+
+    @mock.patch("requests.Session.get")
+    def test_users_pages_prefetched(self, mock_get):
+        all_users = [{"id": i, "name": f"user_{i}"} for i in range(550)]
+
+        def get(url, params, **kwargs):
+            if url == PROJECTS_URL:
+                return MockResponse(
+                    json_data={"data": [{"id": 1}], "metadata": {}}, status_code=200
+                )
+            offset = params["offset"]
+            return MockResponse(
+                json_data=all_users[offset : offset + params["limit"]], status_code=200
+            )
+
+        mock_get.side_effect = get
+        secrets = {
+            "access_token": "valid_key",
+            "users_prefetch": {"initial_pages": 2, "max_pages": 4},
+        }
+        first = main(FivetranRequest(json={"secrets": secrets, "state": {}}))
+
+        assert all_users[:200] == first["insert"]["users"]
+        assert True is first["hasMore"]
+        assert 200 == first["state"]["users_offset"]
+        assert {"pages": 4} == first["state"]["users_prefetch"]
+
+        mock_get.reset_mock()
+        second = main(
+            FivetranRequest(json={"secrets": secrets, "state": first["state"]})
+        )
+
+        user_offsets = sorted(
+            call.kwargs["params"]["offset"]
+            for call in mock_get.call_args_list
+            if call.kwargs["url"] == USERS_URL
+        )
+        assert [200, 300, 400, 500] == user_offsets
+        assert all_users[200:] == second["insert"]["users"]
+        assert False is second["hasMore"]
+        assert 0 == second["state"]["users_offset"]
+        assert {"pages": 4} == second["state"]["users_prefetch"]
+
+    @mock.patch("requests.Session.get")
+    def test_serialized_response(self, mock_get):
+        valid_users = [{"id": i, "name": f"user_{i}"} for i in range(10)]
+        mock_get.side_effect = respond_by_url(
+            {
+                PROJECTS_URL: MockResponse(
+                    json_data={"data": [], "metadata": {}}, status_code=200
+                ),
+                USERS_URL: MockResponse(json_data=valid_users, status_code=200),
+            }
+        )
+        fivetran_request = FivetranRequest(
+            json={
+                "secrets": {"access_token": "valid_key", "serialize_response": True},
+                "state": {},
+            }
+        )
+        body, status, headers = main(fivetran_request)
+
+        assert 200 == status
+        assert "application/json" == headers["Content-Type"]
+        assert valid_users == json.loads(body)["insert"]["users"]
+
+    @mock.patch("requests.Session.get")
+    def test_metrics_emitted_and_added_to_state(self, mock_get, capsys):
+        valid_users = [{"id": i, "name": f"user_{i}"} for i in range(10)]
+        mock_get.side_effect = respond_by_url(
+            {
+                PROJECTS_URL: MockResponse(
+                    json_data={"data": [], "metadata": {}}, status_code=200
+                ),
+                USERS_URL: MockResponse(json_data=valid_users, status_code=200),
+            }
+        )
+        fivetran_request = FivetranRequest(
+            json={
+                "secrets": {
+                    "access_token": "valid_key",
+                    "metrics_in_state": True,
+                    # sizes of rows are only known if the response is serialized
+                    "serialize_response": True,
+                },
+                "state": {},
+            }
+        )
+        body, _, _ = main(fivetran_request)
+        response = json.loads(body)
+
+        summary = response["state"]["metrics"]
+        assert {"projects": 0, "users": 10} == summary["rows"]
+        assert "fetch" in summary["phases"]
+
+        record = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+        assert "INFO" == record["severity"]
+        assert "casa" == record["metrics"]["connector"]
+        assert 10 == record["metrics"]["tables"]["users"]["rows"]
+        assert record["metrics"]["tables"]["users"]["bytes"] > 0
+
+    @mock.patch("requests.adapters.HTTPAdapter.send")
+    def test_throttled_requests_retried(self, mock_send):
+        responses = {
+            "projects": [
+                http_response(429, {}, {"Retry-After": "0"}),
+                http_response(200, {"data": [{"id": 1}], "metadata": {}}),
+            ],
+            "users": [
+                http_response(503, {}),
+                http_response(200, [{"id": 1}]),
+            ],
+        }
+
+        def send(request, **kwargs):
+            table = request.path_url.split("?")[0].rsplit("/", 1)[-1]
+            response = responses[table].pop(0)
+            response.url = request.url
+            return response
+
+        mock_send.side_effect = send
+        config = {
+            "access_token": "valid_key",
+            "url": "https://casa.example.com/api/v1",
+            "rate_limit": {"base_backoff": 0.01},
+        }
+        response = main(FivetranRequest(json={"secrets": config, "state": {}}))
+
+        assert 4 == mock_send.call_count
+        assert [{"id": 1}] == response["insert"]["projects"]
+        assert [{"id": 1}] == response["insert"]["users"]
+
+    @mock.patch("requests.adapters.HTTPAdapter.send")
+    def test_throttled_requests_retried_without_config(self, mock_send):
+        sent = []
+        throttled = set()
+
+        def send(request, **kwargs):
+            table = request.path_url.split("?")[0].rsplit("/", 1)[-1]
+            sent.append(table)
+            if table in throttled:
+                throttled.remove(table)
+                response = http_response(429, {}, {"Retry-After": "0"})
+            elif table == "projects":
+                response = http_response(200, {"data": [{"id": 1}], "metadata": {}})
+            else:
+                response = http_response(200, [])
+            response.url = request.url
+            return response
+
+        mock_send.side_effect = send
+        config = {"access_token": "valid_key", "url": "https://casa.example.com/api/v1"}
+        # a limiter configured by an earlier invocation is removed with its config,
+        # requests are still retried without pacing them
+        main(
+            FivetranRequest(json={"secrets": {**config, "rate_limit": {}}, "state": {}})
+        )
+        sent.clear()
+        throttled.add("projects")
+        response = main(FivetranRequest(json={"secrets": config, "state": {}}))
+
+        assert 2 == sent.count("projects")
+        assert [{"id": 1}] == response["insert"]["projects"]
+
+    @mock.patch("requests.Session.get")
+    def test_unchanged_pages_skipped(self, mock_get):
+        projects = {"data": [{"id": 1, "name": "project_1"}], "metadata": {}}
+        users = [{"id": i, "name": f"user_{i}"} for i in range(3)]
+
+        def get(url, params, headers, **kwargs):
+            # projects support ETags, users don't send validators
+            if url == PROJECTS_URL:
+                if headers.get("If-None-Match") == '"v1"':
+                    return http_response(304)
+                return http_response(200, projects, {"ETag": '"v1"'})
+            return http_response(200, users)
+
+        def sync(state):
+            secrets = {
+                "access_token": "valid_key",
+                "change_detection": "state",
+                "page_cache": "state",
+            }
+            return main(FivetranRequest(json={"secrets": secrets, "state": state}))
+
+        mock_get.side_effect = get
+        first = sync({})
+        assert projects["data"] == first["insert"]["projects"]
+        assert users == first["insert"]["users"]
+
+        second = sync(first["state"])
+        assert [] == second["insert"]["projects"]
+        assert [] == second["insert"]["users"]
+        # rows of unchanged pages still exist
+        assert {"projects": [], "users": []} == second["delete"]
+        assert False is second["hasMore"]
+
+        users = users[:2] + [{"id": 3, "name": "user_3"}]
+        third = sync(second["state"])
+        assert [] == third["insert"]["projects"]
+        assert [users[2]] == third["insert"]["users"]
+        assert [{"id": 2}] == third["delete"]["users"]
+
+    @mock.patch("requests.Session.get")
+    def test_local_page_cache_not_used_on_retry(self, mock_get, tmp_path):
+        projects = {"data": [{"id": 1, "name": "project_1"}], "metadata": {}}
+
+        def get(url, params, headers, **kwargs):
+            if url == PROJECTS_URL:
+                if headers.get("If-None-Match") == '"v1"':
+                    return http_response(304)
+                return http_response(200, projects, {"ETag": '"v1"'})
+            return http_response(200, [])
+
+        def sync(state):
+            secrets = {
+                "access_token": "valid_key",
+                "page_cache": "local",
+                "page_cache_directory": str(tmp_path),
+            }
+            return main(FivetranRequest(json={"secrets": secrets, "state": state}))
+
+        mock_get.side_effect = get
+        sync({})
+        # the first response wasn't committed, so its page must be sent again
+        retried = sync({})
+        assert projects["data"] == retried["insert"]["projects"]
+
+        second = sync(retried["state"])
+        assert [] == second["insert"]["projects"]
+
+    @mock.patch("requests.Session.get")
+    def test_sampled_invocation_profiled(self, mock_get, tmp_path):
+        mock_get.side_effect = respond_by_url(
+            {
+                PROJECTS_URL: MockResponse(
+                    json_data={"data": [], "metadata": {}}, status_code=200
+                ),
+                USERS_URL: MockResponse(json_data=[{"id": 1}], status_code=200),
+            }
+        )
+        profiling = {"sample_rate": 1, "directory": str(tmp_path)}
+        fivetran_request = FivetranRequest(
+            json={
+                "secrets": {"access_token": "valid_key", "profiling": profiling},
+                "state": {},
+            }
+        )
+        main(fivetran_request)
+        main(
+            FivetranRequest(
+                json={
+                    "secrets": {
+                        "access_token": "valid_key",
+                        "profiling": {**profiling, "sample_rate": 0},
+                    },
+                    "state": {},
+                }
+            )
+        )
+
+        (artifact,) = (tmp_path / "casa").iterdir()
+        profile = json.loads(gzip.decompress(artifact.read_bytes()))
+        assert False is profile["failed"]
+        # streams are fetched on worker threads, which are profiled as well
+        assert profile["threads"] > 1
+        assert any(name == "fetch_users" for _, _, name, *_ in profile["functions"])
+        assert profile["allocations"]
@@ -0,0 +1,314 @@
+"""
+Offline bulk backfills of connectors.
+
+A Fivetran sync gets a single response per invocation, within the size and timeout
+limits of the function, which makes loading years of history slow. A backfill drives
+the connector's `main` locally instead, the way Fivetran would, and streams the rows
+into files that can be bulk-loaded into the warehouse. Only the incremental syncs after
+the backfill are left to Fivetran.
+
+Connectors that support it split the backfill into independent partitions with a
+`backfill_partitions(secrets, count)` function in their `main` module, which returns
+the initial state of every partition, e.g. one per time range. Partitions are synced
+in a pool of processes. Tables that aren't split by partition, e.g. metadata, should
+only be returned by one partition, so the states of the others are expected to mark
+them as sent already. Connectors without it are backfilled as a single partition that
+pages with the connector's own cursor.
+
+Rows are written to `<output>/<table>/partition=<n>/part-<seq>.<format>`, as NDJSON or
+Parquet. After every file the state of the partition is checkpointed, and a backfill
+that is started again with the same output directory resumes from the checkpoints.
+Once all partitions are done, the state to start incremental syncs from is written to
+`<output>/state.json`: the result of the connector's `backfill_state(states)`, or the
+final state of the single partition.
+"""
+
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from .runtime.serialization import dumps
+from .simulator import FivetranRequest, decode_response, load_connector_module
+
+FORMATS = ("ndjson", "parquet")
+
+MANIFEST = "_backfill.json"
+CHECKPOINTS_DIR = "_checkpoints"
+SCHEMA_FILE = "_schema.json"
+STATE_FILE = "state.json"
+
+DEFAULT_ROWS_PER_FILE = 100000
+
+
+def _write_atomic(path: Path, data: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
+def write_ndjson(path: Path, rows: List[Dict[str, Any]]):
+    _write_atomic(path, b"".join(dumps(row) + b"\n" for row in rows))
+
+
+def _import_pyarrow():
+    # pyarrow is large and only needed for Parquet output
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Writing Parquet files requires pyarrow to be installed")
+    return pyarrow, pyarrow.parquet
+
+
+def write_parquet(path: Path, rows: List[Dict[str, Any]]):
+    pa, pq = _import_pyarrow()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    pq.write_table(pa.Table.from_pylist(rows), tmp_path)
+    os.replace(tmp_path, path)
+
+
+WRITERS = {"ndjson": write_ndjson, "parquet": write_parquet}
+
+
+@dataclass
+class Checkpoint:
+    """Progress of a partition, as of the last file written."""
+
+    state: Dict[str, Any]
+    # number of the next file of the partition
+    files: int = 0
+    invocations: int = 0
+    rows: Dict[str, int] = field(default_factory=dict)
+    done: bool = False
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["Checkpoint"]:
+        try:
+            return cls(**json.loads(path.read_text()))
+        except FileNotFoundError:
+            return None
+
+    def save(self, path: Path):
+        _write_atomic(path, json.dumps(self.__dict__).encode("utf-8"))
+
+
+def backfill_partition(
+    connector_path: str,
+    secrets: Dict[str, Any],
+    partition: int,
+    output: str,
+    file_format: str,
+    rows_per_file: int,
+    max_retries: int = 3,
+) -> Checkpoint:
+    """
+    Sync a single partition, starting from its checkpoint, and return the last one.
+
+    Runs in a worker process. Rows are buffered until `rows_per_file` are reached, then
+    written to one file per table, and the state after them is checkpointed. A failed
+    invocation is retried with the last state returned, like Fivetran does.
+    """
+    main = load_connector_module(Path(connector_path)).main
+    output_dir = Path(output)
+    checkpoint_path = output_dir / CHECKPOINTS_DIR / f"{partition}.json"
+    checkpoint = Checkpoint.load(checkpoint_path)
+    write = WRITERS[file_format]
+
+    state = checkpoint.state
+    buffer: Dict[str, List[Dict[str, Any]]] = {}
+    buffered = 0
+    retries = 0
+    rows = Counter(checkpoint.rows)
+    while not checkpoint.done:
+        request = FivetranRequest(
+            json={
+                "agent": "fivetran-connectors backfill",
+                "state": state,
+                "secrets": secrets,
+            }
+        )
+        try:
+            response, _ = decode_response(main(request))
+        except Exception as e:
+            retries += 1
+            print(f"Partition {partition} invocation failed: {e}", file=sys.stderr)
+            if retries > max_retries:
+                raise
+            continue
+
+        retries = 0
+        if not (output_dir / SCHEMA_FILE).exists():
+            _write_atomic(
+                output_dir / SCHEMA_FILE,
+                json.dumps(response.get("schema", {})).encode("utf-8"),
+            )
+        for table, table_rows in response.get("insert", {}).items():
+            buffer.setdefault(table, []).extend(table_rows)
+            buffered += len(table_rows)
+            rows[table] += len(table_rows)
+        state = response["state"]
+        checkpoint.invocations += 1
+        done = not response.get("hasMore")
+
+        if buffered >= rows_per_file or done:
+            for table, table_rows in buffer.items():
+                if table_rows:
+                    path = (
+                        output_dir
+                        / table
+                        / f"partition={partition}"
+                        / f"part-{checkpoint.files:05d}.{file_format}"
+                    )
+                    write(path, table_rows)
+            # a file number is only used once, so a resumed partition overwrites the
+            # files written after its last checkpoint
+            checkpoint.files += 1
+            checkpoint.state = state
+            checkpoint.rows = dict(rows)
+            checkpoint.done = done
+            checkpoint.save(checkpoint_path)
+            buffer = {}
+            buffered = 0
+
+    return checkpoint
+
+
+@dataclass
+class BackfillReport:
+    """Progress of a backfill across its partitions."""
+
+    partitions: int = 0
+    done: int = 0
+    failed: List[int] = field(default_factory=list)
+    invocations: int = 0
+    rows: Counter = field(default_factory=Counter)
+    wall_time: float = 0.0
+    state_path: Optional[Path] = None
+
+    def summary(self) -> str:
+        total_rows = sum(self.rows.values())
+        rows_per_second = total_rows / self.wall_time if self.wall_time else 0.0
+        lines = [
+            f"partitions:     {self.done}/{self.partitions} done"
+            + (f", failed: {self.failed}" if self.failed else ""),
+            f"invocations:    {self.invocations}",
+            f"wall time:      {self.wall_time:.2f}s",
+            f"rows:           {total_rows} ({rows_per_second:.0f} rows/s)",
+        ]
+        lines += [
+            f"  {table}: {count} rows" for table, count in sorted(self.rows.items())
+        ]
+        if self.state_path is not None:
+            lines.append(f"state for incremental syncs: {self.state_path}")
+        return "\n".join(lines)
+
+
+def plan_backfill(
+    connector_path: Path,
+    secrets: Dict[str, Any],
+    output_dir: Path,
+    partitions: int,
+    file_format: str,
+) -> Dict[str, Any]:
+    """Return the manifest of the backfill, creating it unless it is resumed."""
+    manifest_path = output_dir / MANIFEST
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+        if manifest["format"] != file_format:
+            raise ValueError(
+                f"{output_dir} contains a {manifest['format']} backfill, "
+                f"it can't be resumed as {file_format}"
+            )
+        return manifest
+
+    module = load_connector_module(connector_path)
+    states = [{}]
+    if hasattr(module, "backfill_partitions"):
+        states = module.backfill_partitions(secrets, partitions)
+    manifest = {
+        "connector": connector_path.name,
+        "format": file_format,
+        "partitions": states,
+    }
+    for partition, state in enumerate(states):
+        Checkpoint(state=state).save(output_dir / CHECKPOINTS_DIR / f"{partition}.json")
+    # written last, a backfill is only resumed once all checkpoints exist
+    _write_atomic(manifest_path, json.dumps(manifest).encode("utf-8"))
+    return manifest
+
+
+def run_backfill(
+    connector_path: Path,
+    secrets: Dict[str, Any],
+    output: Path,
+    partitions: int = 8,
+    processes: int = 4,
+    file_format: str = "ndjson",
+    rows_per_file: int = DEFAULT_ROWS_PER_FILE,
+) -> BackfillReport:
+    """Backfill the connector in `connector_path` into files in `output`."""
+    if file_format not in FORMATS:
+        raise ValueError(f"Unsupported format: {file_format}")
+    if file_format == "parquet":
+        _import_pyarrow()
+    output_dir = Path(output)
+    manifest = plan_backfill(
+        connector_path, secrets, output_dir, partitions, file_format
+    )
+
+    report = BackfillReport(partitions=len(manifest["partitions"]))
+    checkpoints: Dict[int, Checkpoint] = {}
+    start = time.perf_counter()
+    # connectors start threads, e.g. for concurrent requests, which don't mix with fork
+    with ProcessPoolExecutor(
+        max_workers=processes, mp_context=get_context("spawn")
+    ) as executor:
+        futures = {
+            executor.submit(
+                backfill_partition,
+                str(connector_path),
+                secrets,
+                partition,
+                str(output_dir),
+                file_format,
+                rows_per_file,
+            ): partition
+            for partition in range(report.partitions)
+        }
+        for future in as_completed(futures):
+            partition = futures[future]
+            try:
+                checkpoints[partition] = future.result()
+            except Exception as e:
+                print(f"Partition {partition} failed: {e}", file=sys.stderr)
+                report.failed.append(partition)
+    report.wall_time = time.perf_counter() - start
+
+    for checkpoint in checkpoints.values():
+        report.done += checkpoint.done
+        report.invocations += checkpoint.invocations
+        report.rows.update(checkpoint.rows)
+    report.failed.sort()
+
+    if report.done == report.partitions:
+        states = [checkpoints[partition].state for partition in sorted(checkpoints)]
+        module = load_connector_module(connector_path)
+        if hasattr(module, "backfill_state"):
+            state = module.backfill_state(states)
+        elif len(states) == 1:
+            state = states[0]
+        else:
+            state = None
+        if state is not None:
+            report.state_path = output_dir / STATE_FILE
+            _write_atomic(report.state_path, json.dumps(state).encode("utf-8"))
+    return report
@@ -0,0 +1,104 @@
+import random
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import click
+
+from .runtime import serialization
+
+DEFAULT_ROWS = [1000, 10000, 50000]
+
+
+def synthetic_bugs(num_rows: int, seed: int = 42):
+    """Return rows resembling the `bugs` table of the Bugzilla connector."""
+    rng = random.Random(seed)
+    start = datetime(2014, 9, 1, 19, 12, 17)
+    statuses = ["NEW", "ASSIGNED", "RESOLVED", "VERIFIED", "UNCONFIRMED"]
+    components = ["DOM: Core & HTML", "Layout", "Networking", "General", "Graphics"]
+    rows = []
+    for i in range(num_rows):
+        created = start + timedelta(seconds=rng.randint(0, 300_000_000))
+        rows.append(
+            {
+                "id": 1_000_000 + i,
+                "summary": " ".join(
+                    rng.choice(["crash", "when", "loading", "page", "Intermittent"])
+                    for _ in range(rng.randint(4, 14))
+                ),
+                "assigned_to": f"user{rng.randint(0, 5000)}@mozilla.com",
+                "creation_time": created,
+                "status": rng.choice(statuses),
+                "last_change_time": created
+                + timedelta(seconds=rng.randint(0, 10_000_000)),
+                "creator": f"user{rng.randint(0, 5000)}@mozilla.com",
+                "product": "Core",
+                "component": rng.choice(components),
+            }
+        )
+    return rows
+
+
+def measure(dumps, payload, repeat: int):
+    """Return the best time, peak memory and output size of serializing `payload`."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        dumps(payload)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    output = dumps(payload)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, output
+
+
+@click.group(help="Commands for benchmarking connector code paths.")
+def benchmark():
+    """Create the CLI group for the benchmark command."""
+    pass
+
+
+@benchmark.command(
+    name="serialization",
+    help="""Compare stdlib and orjson response serialization.""",
+)
+@click.option(
+    "--rows",
+    "-n",
+    multiple=True,
+    type=int,
+    help="Number of rows in the benchmarked responses",
+)
+@click.option("--repeat", "-r", default=5, help="Number of repetitions")
+def serialization_command(rows, repeat: int):
+    if serialization.orjson is None:
+        click.echo("orjson is not installed, only the stdlib encoder is available.")
+
+    encoders = {"stdlib": serialization.dumps_stdlib}
+    if serialization.orjson is not None:
+        encoders["orjson"] = serialization.dumps_orjson
+
+    click.echo(
+        f"{'rows':>8} {'encoder':>8} {'time (ms)':>10} {'peak (MB)':>10} {'size (MB)':>10}"
+    )
+    for num_rows in rows or DEFAULT_ROWS:
+        payload = {
+            "state": {"since_id": "2021-01-01T00:00:00Z"},
+            "schema": {"bugs": {"primary_key": ["id"]}},
+            "insert": {"bugs": synthetic_bugs(num_rows)},
+            "delete": {},
+            "hasMore": True,
+        }
+        outputs = []
+        for name, dumps in encoders.items():
+            seconds, peak, output = measure(dumps, payload, repeat)
+            outputs.append(output)
+            click.echo(
+                f"{num_rows:>8} {name:>8} {seconds * 1000:>10.1f} "
+                f"{peak / 2**20:>10.1f} {len(output) / 2**20:>10.1f}"
+            )
+
+        if any(output != outputs[0] for output in outputs):
+            raise click.ClickException("Encoders produced different output.")
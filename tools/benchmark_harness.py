@@ -0,0 +1,253 @@
+"""
+Benchmark harness for connector hot paths.
+
+The harness is part of the tooling rather than the shared runtime, so it isn't deployed
+with connectors. Their `tests/test_benchmark.py` import it from the installed tools.
+
+Upstream responses are replayed from recordings or synthetic generators through a
+connector's `main`. Time, peak memory and allocated memory blocks are tracked per phase:
+
+* `fetch`: upstream requests, including decoding the JSON payloads
+* `response`: building and serializing the response, except for rows that a
+  `ResponseWriter` serializes while they are written, which count towards `transform`
+* `transform`: everything else, i.e. turning upstream data into rows
+
+Results are compared against a baseline committed with the connector's tests, which is
+only written when asked to, e.g. with `UPDATE_BENCHMARK_BASELINE=1`. Phases of
+requests made concurrently overlap, so for connectors fetching concurrently the split
+between phases is approximate.
+"""
+
+import copy
+import json
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+from unittest import mock
+
+import pytest
+
+PHASES = ("fetch", "transform", "response")
+
+# results may be worse than the baseline by these factors before counting as regression
+DEFAULT_TOLERANCE = {"seconds": 1.5, "peak_bytes": 1.25, "allocated_blocks": 1.25}
+# and by these amounts, so noise in phases that take next to nothing doesn't fail runs
+NOISE_FLOOR = {"seconds": 0.05, "peak_bytes": 1 << 20, "allocated_blocks": 1000}
+
+# a responder maps request URL and params to the JSON payload of the response
+Responder = Callable[[str, Dict[str, Any]], Any]
+
+
+class PhaseRecorder:
+    """Attributes time, peak memory and allocated blocks to phases."""
+
+    def __init__(self, default_phase: str = "transform"):
+        self.default_phase = default_phase
+        self.results = {
+            phase: {"seconds": 0.0, "peak_bytes": 0, "allocated_blocks": 0}
+            for phase in PHASES
+        }
+        self._phase = default_phase
+        self._started = 0.0
+        self._blocks = 0
+        self._lock = threading.RLock()
+
+    def _switch(self, phase: str):
+        now = time.perf_counter()
+        blocks = sys.getallocatedblocks()
+        _, peak = tracemalloc.get_traced_memory()
+        result = self.results[self._phase]
+        result["seconds"] += now - self._started
+        result["peak_bytes"] = max(result["peak_bytes"], peak)
+        result["allocated_blocks"] += max(0, blocks - self._blocks)
+        tracemalloc.reset_peak()
+        self._phase = phase
+        self._started = now
+        self._blocks = blocks
+
+    def start(self):
+        tracemalloc.start()
+        self._started = time.perf_counter()
+        self._blocks = sys.getallocatedblocks()
+
+    def stop(self):
+        with self._lock:
+            self._switch(self.default_phase)
+        tracemalloc.stop()
+
+    @contextmanager
+    def phase(self, name: str):
+        """Attribute everything that happens within the block to phase `name`."""
+        with self._lock:
+            previous = self._phase
+            self._switch(name)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._switch(previous)
+
+
+class ReplayResponse:
+    """Minimal stand-in for `requests.Response` holding a replayed payload."""
+
+    def __init__(self, payload: Any, status_code: int = 200):
+        self.content = json.dumps(payload).encode("utf-8")
+        self.status_code = status_code
+        self.headers: Dict[str, str] = {"Content-Type": "application/json"}
+        # payload decoded when the response was received
+        self.decoded: Any = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8")
+
+    def json(self):
+        if self.decoded is not None:
+            return self.decoded
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception(f"HTTP {self.status_code}")
+
+
+def recorded(path: Path) -> Responder:
+    """Return a responder replaying the payloads recorded in a JSON list, in order."""
+    payloads = iter(json.loads(Path(path).read_text()))
+    return lambda url, params: next(payloads)
+
+
+def run_benchmark(
+    module: Any,
+    request: Any,
+    respond: Responder,
+    patches: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Dict[str, float]]:
+    """
+    Run `module.main(request)` with replayed upstream responses and return the results.
+
+    Requests made via `requests.Session.get` are answered by `respond`. The payloads are
+    serialized before the run, so decoding them is part of the `fetch` phase just like
+    for real responses. `patches` maps additional objects to patch to their
+    replacements, e.g. API clients that don't use `requests.Session.get`.
+    """
+    recorder = PhaseRecorder()
+    prepared: Dict[str, List[ReplayResponse]] = {}
+
+    def get(url, params=None, **kwargs):
+        with recorder.phase("fetch"):
+            # decode here, connectors call `json()` outside of the request, and on a
+            # copy, so that the decoded payload isn't kept alive by `replayed`
+            response = copy.copy(prepared[url].pop(0))
+            response.decoded = json.loads(response.content)
+            return response
+
+    # serialize payloads up front, so that it doesn't count towards the results
+    def prefetch(url, params=None, **kwargs):
+        response = ReplayResponse(respond(url, dict(params or {})))
+        prepared.setdefault(url, []).append(response)
+        return response
+
+    def timed(func):
+        def wrapper(*args, **kwargs):
+            with recorder.phase("response"):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    with _patched(patches or {}):
+        # dry run to record the requests made by `main`
+        with mock.patch("requests.Session.get", side_effect=prefetch):
+            module.main(request)
+        replayed = {url: list(responses) for url, responses in prepared.items()}
+
+        prepared.clear()
+        prepared.update({url: list(responses) for url, responses in replayed.items()})
+        with ExitStack() as stack:
+            stack.enter_context(mock.patch("requests.Session.get", side_effect=get))
+            # connectors build responses with `response()` or a `ResponseWriter`,
+            # which is the class of the runtime vendored into the connector
+            if hasattr(module, "ResponseWriter"):
+                writer_class = module.ResponseWriter
+                stack.enter_context(
+                    mock.patch.object(
+                        writer_class, "finish", timed(writer_class.finish)
+                    )
+                )
+            if hasattr(module, "response"):
+                stack.enter_context(
+                    mock.patch.object(module, "response", timed(module.response))
+                )
+            recorder.start()
+            try:
+                module.main(request)
+            finally:
+                recorder.stop()
+
+    return recorder.results
+
+
+@contextmanager
+def _patched(patches: Dict[str, Any]):
+    patchers = [mock.patch(target, new) for target, new in patches.items()]
+    for patcher in patchers:
+        patcher.start()
+    try:
+        yield
+    finally:
+        for patcher in reversed(patchers):
+            patcher.stop()
+
+
+def compare_to_baseline(
+    name: str,
+    results: Dict[str, Dict[str, float]],
+    baseline_path: Path,
+    tolerance: Optional[Dict[str, float]] = None,
+    update: bool = False,
+) -> List[str]:
+    """
+    Compare `results` to the baseline saved under `name` and return the regressions.
+
+    With `update`, the results are saved as the new baseline instead. Without a baseline
+    saved under `name` the benchmark is skipped, as there is nothing to compare to.
+    """
+    tolerance = tolerance or DEFAULT_TOLERANCE
+    baseline_path = Path(baseline_path)
+    baselines = {}
+    if baseline_path.exists():
+        baselines = json.loads(baseline_path.read_text())
+
+    if update:
+        baselines[name] = results
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        baseline_path.write_text(json.dumps(baselines, indent=2, sort_keys=True) + "\n")
+        return []
+    if name not in baselines:
+        pytest.skip(
+            f"no baseline for {name} in {baseline_path}, "
+            "set UPDATE_BENCHMARK_BASELINE=1 to record it"
+        )
+
+    regressions = []
+    for phase, metrics in results.items():
+        for metric, value in metrics.items():
+            expected = baselines[name].get(phase, {}).get(metric)
+            if not expected or metric not in tolerance:
+                continue
+            if value > expected * tolerance[
+                metric
+            ] and value - expected > NOISE_FLOOR.get(metric, 0):
+                regressions.append(
+                    f"{name} {phase} {metric}: {value:.4g} (baseline {expected:.4g})"
+                )
+    return regressions
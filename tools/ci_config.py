@@ -12,6 +12,8 @@ CI_CONFIG_TEMPLATE = "config.template.yml"
 CI_WORKFLOW_TEMPLATE_NAME = "ci_workflow.yaml"
 DEPLOY_CONFIG = "deploy.yaml"
 CONNECTORS_DIR = "connectors"
+# bundles of grouped deployments are built here
+BUILD_DIR = "build"
 
 CI_CONFIG_HEADER = """###
 # This config.yml was generated by tools/ci_config.py.
@@ -24,15 +26,34 @@ class DeployConfig:
         # parse deploy configs from file
         with open(file) as f:
             self.config = yaml.safe_load(f)
-    
+
+    def connectors(self, connector_name):
+        """Return the connectors served by a deployment."""
+        connector_config = self.config[connector_name]
+        if "connectors" in connector_config:
+            if "connector" in connector_config:
+                raise ValueError(f"{connector_name} sets both connector and connectors")
+            return list(connector_config["connectors"])
+        return [connector_config["connector"]]
+
     def to_dict(self):
         config = []
-        for (connector_name, connector_config) in self.config.items():
+        for connector_name, connector_config in self.config.items():
+            connectors = self.connectors(connector_name)
+            grouped = "connectors" in connector_config
             config.append(
                 {
                     "connector_name": connector_name,
-                    "connector": connector_config['connector'],
-                    "environment": connector_config['environment']
+                    # grouped deployments are deployed from a bundle with a router
+                    "connector": None if grouped else connectors[0],
+                    "connectors": connectors,
+                    "grouped": grouped,
+                    "source": (
+                        f"{BUILD_DIR}/{connector_name}"
+                        if grouped
+                        else f"{CONNECTORS_DIR}/{connectors[0]}"
+                    ),
+                    "environment": connector_config["environment"],
                 }
             )
 
@@ -83,9 +104,7 @@ def update_config(dry_run: bool = False, root: str = ROOT_DIR) -> str:
 
     config_text = config_template.render(
         config_header=CI_CONFIG_HEADER,
-        workflows="\n".join(
-            [file_path.read_text() for file_path in workflow_configs]
-        ),
+        workflows="\n".join([file_path.read_text() for file_path in workflow_configs]),
         connectors=connectors,
         deployments=deploy_config.to_dict(),
     )
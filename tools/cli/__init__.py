@@ -3,8 +3,10 @@
 import click
 
 from .._version import __version__
-from ..connector import connector
+from ..benchmark import benchmark
 from ..ci_config import ci_config
+from ..connector import connector
+from ..profile import profile
 
 
 def cli(prog_name=None):
@@ -12,6 +14,8 @@ def cli(prog_name=None):
     commands = {
         "connector": connector,
         "ci_config": ci_config,
+        "benchmark": benchmark,
+        "profile": profile,
     }
 
     @click.group(commands=commands)
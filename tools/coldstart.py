@@ -0,0 +1,153 @@
+"""
+Cold-start measurements of connectors.
+
+A cold start of a Cloud Function imports the connector's `main` module in a fresh
+interpreter and then serves the first invocation. Both are measured in a subprocess
+started with `-X importtime`, which also reports the time spent importing every module,
+split into imports at module load and imports deferred to the first invocation.
+"""
+
+import json
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+# written to stderr by the child process between importing `main` and invoking it
+INVOCATION_MARKER = "--- coldstart: first invocation"
+
+CHILD_SCRIPT = f"""
+import json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+sys.stderr.write({INVOCATION_MARKER!r} + "\\n")
+sys.stderr.flush()
+
+class Request:
+    json = json.loads(sys.stdin.read())
+
+main.main(Request)
+first = time.perf_counter()
+main.main(Request)
+second = time.perf_counter()
+sys.stdout.write("\\n" + json.dumps(
+    {{"import": imported - start, "first": first - imported, "warm": second - first}}
+) + "\\n")
+"""
+
+
+@dataclass
+class ImportTime:
+    """Time spent importing a single module, in seconds."""
+
+    module: str
+    self_seconds: float
+    cumulative_seconds: float
+    depth: int
+
+
+@dataclass
+class ColdStartReport:
+    """Timings of the import of `main` and of the first and a warm invocation."""
+
+    import_seconds: float
+    first_invocation_seconds: float
+    warm_invocation_seconds: float
+    process_seconds: float
+    module_imports: List[ImportTime] = field(default_factory=list)
+    deferred_imports: List[ImportTime] = field(default_factory=list)
+
+    @property
+    def cold_start_seconds(self) -> float:
+        return self.import_seconds + self.first_invocation_seconds
+
+    def summary(self, top: int = 15) -> str:
+        lines = [
+            f"process:          {self.process_seconds * 1000:8.1f} ms",
+            f"import main:      {self.import_seconds * 1000:8.1f} ms",
+            f"first invocation: {self.first_invocation_seconds * 1000:8.1f} ms",
+            f"warm invocation:  {self.warm_invocation_seconds * 1000:8.1f} ms",
+        ]
+        for title, imports in (
+            ("slowest imports at module load", self.module_imports),
+            ("slowest imports during the first invocation", self.deferred_imports),
+        ):
+            if not imports:
+                continue
+            lines += ["", f"{title} (cumulative / self):"]
+            slowest = sorted(imports, key=lambda i: i.cumulative_seconds, reverse=True)
+            lines += [
+                f"  {i.cumulative_seconds * 1000:8.1f} ms {i.self_seconds * 1000:8.1f} ms"
+                f"  {'  ' * i.depth}{i.module}"
+                for i in slowest[:top]
+            ]
+        return "\n".join(lines)
+
+
+def parse_importtime(output: str) -> Tuple[List[ImportTime], List[ImportTime]]:
+    """
+    Parse `-X importtime` output into imports before and after the invocation marker.
+
+    Lines look like `import time:       548 |     187605 |   bugzilla` with times in
+    microseconds and the nesting depth given by the indentation of the module name.
+    """
+    module_imports: List[ImportTime] = []
+    deferred_imports: List[ImportTime] = []
+    imports = module_imports
+    for line in output.splitlines():
+        if line.startswith(INVOCATION_MARKER):
+            imports = deferred_imports
+            continue
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|", 2)
+        module = name.strip()
+        imports.append(
+            ImportTime(
+                module=module,
+                self_seconds=int(self_us) / 1e6,
+                cumulative_seconds=int(cumulative_us) / 1e6,
+                depth=(len(name) - len(name.lstrip()) - 1) // 2,
+            )
+        )
+    return module_imports, deferred_imports
+
+
+def measure_coldstart(
+    connector_path: Path,
+    secrets: Dict[str, Any],
+    state: Optional[Dict[str, Any]] = None,
+    python: str = sys.executable,
+    timeout: float = 300,
+) -> ColdStartReport:
+    """Import and invoke the connector's `main` in a fresh interpreter."""
+    request = {"agent": "fivetran-connectors coldstart", "secrets": secrets}
+    request["state"] = state or {}
+    start = time.perf_counter()
+    process = subprocess.run(
+        [python, "-X", "importtime", "-c", CHILD_SCRIPT],
+        cwd=connector_path,
+        input=json.dumps(request),
+        capture_output=True,
+        text=True,
+        timeout=timeout,
+    )
+    process_seconds = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError(
+            f"Connector failed during cold start:\n{process.stderr[-4000:]}"
+        )
+
+    timings = json.loads(process.stdout.strip().splitlines()[-1])
+    module_imports, deferred_imports = parse_importtime(process.stderr)
+    return ColdStartReport(
+        import_seconds=timings["import"],
+        first_invocation_seconds=timings["first"],
+        warm_invocation_seconds=timings["warm"],
+        process_seconds=process_seconds,
+        module_imports=module_imports,
+        deferred_imports=deferred_imports,
+    )
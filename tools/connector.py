@@ -1,13 +1,111 @@
+import json
 import shutil
+import sys
 from pathlib import Path
 
 import click
 import jinja2
 
+from .backfill import DEFAULT_ROWS_PER_FILE, FORMATS, run_backfill
+from .ci_config import BUILD_DIR, DEPLOY_CONFIG, DeployConfig
+from .coldstart import measure_coldstart
+from .mock_upstreams import MOCK_UPSTREAMS
+from .simulator import load_connector_main, run_sync
+
 ROOT_DIR = (Path(__file__).parent / "..").resolve()
 TEMPLATES_DIR = ROOT_DIR / "tools" / "templates"
+RUNTIME_DIR = ROOT_DIR / "tools" / "runtime"
 CONNECTOR_DIR = ROOT_DIR / "connectors"
 CI_WORKFLOW_TEMPLATE_NAME = "ci_workflow.yaml"
+RUNTIME_PACKAGE_NAME = "runtime"
+
+# entry point of grouped deployments, see runtime/router.py
+ROUTER_MAIN = '''"""
+Entry point of the grouped deployment {deployment}, generated by
+`fivetran connector bundle`. Requests are dispatched to the connector named by the
+`connector` key of the secrets.
+"""
+
+from pathlib import Path
+
+from runtime.router import Router
+
+main = Router(Path(__file__).parent, {connectors!r})
+'''
+
+
+def vendor_runtime(connector_path: Path):
+    """Copy the shared connector runtime into the connector directory."""
+    target = connector_path / RUNTIME_PACKAGE_NAME
+    if target.exists():
+        shutil.rmtree(target)
+    shutil.copytree(
+        src=RUNTIME_DIR,
+        dst=target,
+        ignore=shutil.ignore_patterns("__pycache__", "*.pyc"),
+    )
+
+
+def runtime_is_current(connector_path: Path) -> bool:
+    """Check whether the vendored runtime of a connector matches tools/runtime."""
+    target = connector_path / RUNTIME_PACKAGE_NAME
+    expected = sorted(p.relative_to(RUNTIME_DIR) for p in RUNTIME_DIR.rglob("*.py"))
+    actual = sorted(p.relative_to(target) for p in target.rglob("*.py"))
+    if expected != actual:
+        return False
+    return all(
+        (RUNTIME_DIR / path).read_bytes() == (target / path).read_bytes()
+        for path in expected
+    )
+
+
+def bundle_deployment(deployment: str, connectors, destination: Path) -> Path:
+    """
+    Build the source of a deployment that serves several connectors with a router.
+
+    The bundle contains the connectors under `connectors/`, a single copy of the
+    runtime, the router entry point as `main.py` and the requirements of all
+    connectors.
+    """
+    target = Path(destination) / deployment
+    if target.exists():
+        shutil.rmtree(target)
+    shutil.copytree(
+        src=RUNTIME_DIR,
+        dst=target / RUNTIME_PACKAGE_NAME,
+        ignore=shutil.ignore_patterns("__pycache__", "*.pyc"),
+    )
+
+    requirements = []
+    for connector_name in connectors:
+        connector_path = CONNECTOR_DIR / connector_name
+        if not (connector_path / "main.py").is_file():
+            raise ValueError(f"Connector {connector_name} doesn't exist.")
+        shutil.copytree(
+            src=connector_path,
+            dst=target / "connectors" / connector_name,
+            ignore=shutil.ignore_patterns(
+                RUNTIME_PACKAGE_NAME,
+                "tests",
+                ".pytest_cache",
+                "__pycache__",
+                "*.pyc",
+                CI_WORKFLOW_TEMPLATE_NAME,
+                "pytest.ini",
+                "README.md",
+            ),
+        )
+        requirements_path = connector_path / "requirements.txt"
+        if requirements_path.exists():
+            for line in requirements_path.read_text().splitlines():
+                if line.strip() and line not in requirements:
+                    requirements.append(line)
+
+    (target / "requirements.txt").write_text("\n".join(requirements) + "\n")
+    (target / "main.py").write_text(
+        ROUTER_MAIN.format(deployment=deployment, connectors=list(connectors))
+    )
+    return target
 
 
 def copy_connector_template(connector_name: str, destination: str):
@@ -20,6 +118,8 @@ def copy_connector_template(connector_name: str, destination: str):
     except FileExistsError:
         raise ValueError(f"Connector with name {connector_name} already exists.")
 
+    vendor_runtime(Path(destination) / connector_name)
+
     # generate CI config for connector
     template_loader = jinja2.FileSystemLoader(TEMPLATES_DIR)
     template_env = jinja2.Environment(loader=template_loader)
@@ -49,3 +149,231 @@ def connector():
 )
 def create(connector_name: str, destination: str):
     copy_connector_template(connector_name, destination)
+
+
+@connector.command(
+    name="vendor_runtime",
+    help="""Copy the shared runtime in tools/runtime into connectors.""",
+)
+@click.argument("connector_names", nargs=-1)
+@click.option("--destination", "-d", help="Connectors directory", default=CONNECTOR_DIR)
+@click.option(
+    "--check/--no-check",
+    default=False,
+    help="Only check that the vendored runtime is up to date",
+)
+def vendor_runtime_command(connector_names, destination: str, check: bool):
+    connector_paths = [
+        path
+        for path in sorted(Path(destination).iterdir())
+        if path.is_dir() and (not connector_names or path.name in connector_names)
+    ]
+    outdated = []
+    for connector_path in connector_paths:
+        if check:
+            if not runtime_is_current(connector_path):
+                outdated.append(connector_path.name)
+        else:
+            vendor_runtime(connector_path)
+            click.echo(f"Vendored runtime into {connector_path}")
+
+    if outdated:
+        click.echo(f"Outdated runtime in: {', '.join(outdated)}", err=True)
+        sys.exit(1)
+
+
+@connector.command(
+    help="""Bundle the connectors of a grouped deployment in deploy.yaml into a
+    single function source with a router entry point."""
+)
+@click.argument("deployment")
+@click.option(
+    "--destination", "-d", help="Build directory", default=ROOT_DIR / BUILD_DIR
+)
+def bundle(deployment: str, destination: str):
+    deploy_config = DeployConfig(ROOT_DIR / DEPLOY_CONFIG)
+    if deployment not in deploy_config.config:
+        raise click.ClickException(f"No deployment {deployment} in {DEPLOY_CONFIG}")
+    target = bundle_deployment(
+        deployment, deploy_config.connectors(deployment), Path(destination)
+    )
+    click.echo(f"Bundled {deployment} into {target}")
+
+
+@connector.command(help="""Run a complete sync of a connector locally.""")
+@click.argument("connector_name")
+@click.option("--destination", "-d", help="Connectors directory", default=CONNECTOR_DIR)
+@click.option(
+    "--secrets",
+    default="{}",
+    help="JSON object with secrets, merged into the secrets of the mock upstream",
+)
+@click.option("--state", default="{}", help="JSON object with the initial state")
+@click.option(
+    "--mock/--no-mock",
+    default=True,
+    help="Run against a local stand-in of the upstream API",
+)
+@click.option("--rows", default=1000, help="Number of rows served by the mock upstream")
+@click.option("--latency", default=0.0, help="Latency of the mock upstream in seconds")
+@click.option(
+    "--error-rate",
+    default=0.0,
+    help="Fraction of mock upstream requests that fail with a 503",
+)
+@click.option("--max-invocations", default=10000, help="Max. number of invocations")
+def run(
+    connector_name: str,
+    destination: str,
+    secrets: str,
+    state: str,
+    mock: bool,
+    rows: int,
+    latency: float,
+    error_rate: float,
+    max_invocations: int,
+):
+    connector_path = Path(destination) / connector_name
+    main = load_connector_main(connector_path)
+
+    if not mock:
+        report = run_sync(main, json.loads(secrets), json.loads(state), max_invocations)
+        click.echo(report.summary())
+        return
+
+    if connector_name not in MOCK_UPSTREAMS:
+        raise click.ClickException(f"No mock upstream for {connector_name}")
+
+    with MOCK_UPSTREAMS[connector_name](
+        rows=rows, latency=latency, error_rate=error_rate
+    ) as upstream:
+        sync_secrets = {**upstream.secrets(), **json.loads(secrets)}
+        report = run_sync(main, sync_secrets, json.loads(state), max_invocations)
+        click.echo(report.summary())
+        click.echo(f"upstream requests: {upstream.requests} ({upstream.errors} errors)")
+
+
+@connector.command(help="""Measure the cold start of a connector in a fresh interpreter.
+
+    Reports the time it takes to import the connector's main module and to serve the
+    first invocation, as well as the slowest imports.""")
+@click.argument("connector_name")
+@click.option("--destination", "-d", help="Connectors directory", default=CONNECTOR_DIR)
+@click.option(
+    "--secrets",
+    default="{}",
+    help="JSON object with secrets, merged into the secrets of the mock upstream",
+)
+@click.option("--state", default="{}", help="JSON object with the state")
+@click.option(
+    "--mock/--no-mock",
+    default=True,
+    help="Invoke the connector against a local stand-in of the upstream API",
+)
+@click.option("--rows", default=1000, help="Number of rows served by the mock upstream")
+@click.option("--top", default=15, help="Number of slowest imports to show")
+def coldstart(
+    connector_name: str,
+    destination: str,
+    secrets: str,
+    state: str,
+    mock: bool,
+    rows: int,
+    top: int,
+):
+    connector_path = Path(destination) / connector_name
+
+    if not mock:
+        report = measure_coldstart(
+            connector_path, json.loads(secrets), json.loads(state)
+        )
+        click.echo(report.summary(top))
+        return
+
+    if connector_name not in MOCK_UPSTREAMS:
+        raise click.ClickException(f"No mock upstream for {connector_name}")
+
+    with MOCK_UPSTREAMS[connector_name](rows=rows) as upstream:
+        report = measure_coldstart(
+            connector_path,
+            {**upstream.secrets(), **json.loads(secrets)},
+            json.loads(state),
+        )
+        click.echo(report.summary(top))
+
+
+@connector.command(
+    help="""Backfill a connector into partitioned NDJSON or Parquet files in OUTPUT.
+
+    Partitions of the backfill are synced locally in a pool of processes, without the
+    limits of Fivetran invocations. Running the command again with the same OUTPUT
+    resumes the backfill from its checkpoints."""
+)
+@click.argument("connector_name")
+@click.argument("output")
+@click.option("--destination", "-d", help="Connectors directory", default=CONNECTOR_DIR)
+@click.option(
+    "--secrets",
+    default="{}",
+    help="JSON object with secrets, merged into the secrets of the mock upstream",
+)
+@click.option("--partitions", default=8, help="Number of partitions, if supported")
+@click.option("--processes", default=4, help="Number of partitions synced at a time")
+@click.option(
+    "--format",
+    "file_format",
+    type=click.Choice(FORMATS),
+    default="ndjson",
+    help="Format of the files",
+)
+@click.option(
+    "--rows-per-file",
+    default=DEFAULT_ROWS_PER_FILE,
+    help="Rows buffered per partition before files are written and checkpointed",
+)
+@click.option(
+    "--mock/--no-mock",
+    default=False,
+    help="Backfill from a local stand-in of the upstream API",
+)
+@click.option("--rows", default=1000, help="Number of rows served by the mock upstream")
+def backfill(
+    connector_name: str,
+    output: str,
+    destination: str,
+    secrets: str,
+    partitions: int,
+    processes: int,
+    file_format: str,
+    rows_per_file: int,
+    mock: bool,
+    rows: int,
+):
+    connector_path = (Path(destination) / connector_name).resolve()
+
+    def backfill_from(sync_secrets):
+        try:
+            report = run_backfill(
+                connector_path,
+                sync_secrets,
+                Path(output),
+                partitions,
+                processes,
+                file_format,
+                rows_per_file,
+            )
+        except (RuntimeError, ValueError) as e:
+            raise click.ClickException(str(e))
+        click.echo(report.summary())
+        if report.done < report.partitions:
+            sys.exit(1)
+
+    if not mock:
+        backfill_from(json.loads(secrets))
+        return
+
+    if connector_name not in MOCK_UPSTREAMS:
+        raise click.ClickException(f"No mock upstream for {connector_name}")
+
+    with MOCK_UPSTREAMS[connector_name](rows=rows) as upstream:
+        backfill_from({**upstream.secrets(), **json.loads(secrets)})
@@ -0,0 +1,418 @@
+"""
+Local stand-ins for the upstream APIs used by connectors.
+
+The servers generate deterministic synthetic data and can simulate latency and
+transient errors, which makes it possible to run complete syncs locally.
+"""
+
+import abc
+import hashlib
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class MockUpstream(abc.ABC):
+    """
+    Base class of stand-in HTTP servers.
+
+    Subclasses implement `secrets()` and `handle()`, which returns the status code and
+    the JSON body of the response for a GET request.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 42,
+        etags: bool = False,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.seed = seed
+        # send ETags and answer matching conditional requests with 304
+        self.etags = etags
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        if self._server is None:
+            raise RuntimeError("Server isn't running")
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @abc.abstractmethod
+    def secrets(self) -> Dict[str, Any]:
+        """Return connector secrets pointing the connector to this server."""
+
+    @abc.abstractmethod
+    def handle(self, path: str, params: Dict[str, List[str]]) -> Tuple[int, Any]:
+        """Return the status code and JSON body of the response to a GET request."""
+
+    def _should_fail(self) -> bool:
+        with self._lock:
+            self.requests += 1
+            fail = self._random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+            return fail
+
+    def _handler_class(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body are written separately, which Nagle's algorithm delays
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                if upstream.latency:
+                    time.sleep(upstream.latency)
+
+                if upstream._should_fail():
+                    status, body = 503, {"error": True, "message": "Try again later"}
+                    headers = {"Retry-After": "1"}
+                else:
+                    parsed = urlparse(self.path)
+                    status, body = upstream.handle(
+                        parsed.path, parse_qs(parsed.query, keep_blank_values=True)
+                    )
+                    headers = {}
+
+                content = json.dumps(body).encode("utf-8")
+                if upstream.etags and status == 200:
+                    etag = f'"{hashlib.blake2b(content, digest_size=8).hexdigest()}"'
+                    headers["ETag"] = etag
+                    if self.headers.get("If-None-Match") == etag:
+                        status, content = 304, b""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> "MockUpstream":
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class MockBugzilla(MockUpstream):
+    """Stand-in for the parts of the Bugzilla REST API used by the connector."""
+
+    PRODUCTS = {
+        "Core": ["DOM: Core & HTML", "Layout", "Networking", "Graphics"],
+        "Firefox": ["General", "Toolbars and Customization", "Sync"],
+    }
+    STATUSES = ["UNCONFIRMED", "NEW", "ASSIGNED", "RESOLVED", "VERIFIED"]
+
+    def __init__(self, rows: int = 1000, start: str = "2014-09-01T00:00:00Z", **kwargs):
+        super().__init__(**kwargs)
+        self.start_time = datetime.strptime(start, TIMESTAMP_FORMAT)
+        self.bugs = self._generate_bugs(rows)
+        self.bugs_by_id = {bug["id"]: bug for bug in self.bugs}
+
+    def _generate_bugs(self, rows: int) -> List[Dict[str, Any]]:
+        rng = random.Random(self.seed)
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        span = int((now - self.start_time).total_seconds())
+        products = sorted(self.PRODUCTS)
+        bugs = []
+        for bug_id in range(1, rows + 1):
+            product = rng.choice(products)
+            created = self.start_time + timedelta(seconds=rng.randint(0, span))
+            changed = created + timedelta(
+                seconds=rng.randint(0, int((now - created).total_seconds()))
+            )
+            bugs.append(
+                {
+                    "id": bug_id,
+                    "summary": f"Synthetic bug {bug_id}",
+                    "assigned_to": f"user{rng.randint(1, 500)}@example.com",
+                    "creation_time": created.strftime(TIMESTAMP_FORMAT),
+                    "status": rng.choice(self.STATUSES),
+                    # many bugs share a timestamp, like after mass updates
+                    "last_change_time": changed.replace(
+                        second=0, minute=changed.minute // 10 * 10
+                    ).strftime(TIMESTAMP_FORMAT),
+                    "creator": f"user{rng.randint(1, 500)}@example.com",
+                    "product": product,
+                    "component": rng.choice(self.PRODUCTS[product]),
+                    "cc": [f"user{i}@example.com" for i in range(rng.randint(0, 5))],
+                    "whiteboard": "",
+                }
+            )
+        bugs.sort(key=lambda bug: (bug["last_change_time"], bug["id"]))
+        return bugs
+
+    def secrets(self) -> Dict[str, Any]:
+        return {
+            "url": f"{self.url}/rest/",
+            "api_key": "mock-api-key",
+            "max_date": self.start_time.strftime(TIMESTAMP_FORMAT),
+            "bug_limit": 1000,
+            "products": sorted(self.PRODUCTS),
+        }
+
+    def handle(self, path: str, params: Dict[str, List[str]]) -> Tuple[int, Any]:
+        path = path.rstrip("/")
+        if path == "/rest/version":
+            return 200, {"version": "5.0.4"}
+        if path == "/rest/time":
+            now = datetime.now(timezone.utc).strftime(TIMESTAMP_FORMAT)
+            return 200, {"db_time": now, "web_time": now}
+        if path == "/rest/user":
+            return 200, {"users": [{"id": 1, "name": "nobody@example.com"}]}
+        if path == "/rest/product/get":
+            return 200, {"products": self._products(params)}
+        if path == "/rest/bug":
+            return 200, {"bugs": self._search(params)}
+        parts = path.split("/")
+        if len(parts) == 5 and parts[:3] == ["", "rest", "bug"]:
+            # the REST API returns data of the bug in the path and of all `ids`
+            ids = [int(parts[3])] + [int(i) for i in _list_param(params, "ids")]
+            since = _first(params, "new_since") or ""
+            if parts[4] == "history":
+                return 200, {"bugs": self._history(ids, since)}
+            if parts[4] == "comment":
+                return 200, {"bugs": self._comments(ids, since), "comments": {}}
+        return 404, {"error": True, "message": f"Unknown path {path}", "code": 32614}
+
+    def _history(self, ids: List[int], since: str) -> List[Dict[str, Any]]:
+        # a status change at creation and the last change of every bug
+        history = []
+        for bug_id in ids:
+            bug = self.bugs_by_id[bug_id]
+            entries = [
+                {
+                    "when": when,
+                    "who": bug["creator"],
+                    "changes": [
+                        {"field_name": "status", "removed": removed, "added": added}
+                    ],
+                }
+                for when, removed, added in [
+                    (bug["creation_time"], "", "NEW"),
+                    (bug["last_change_time"], "NEW", bug["status"]),
+                ]
+                if when > since
+            ]
+            history.append({"id": bug_id, "alias": [], "history": entries})
+        return history
+
+    def _comments(self, ids: List[int], since: str) -> Dict[str, Any]:
+        comments = {}
+        for bug_id in ids:
+            bug = self.bugs_by_id[bug_id]
+            created = [bug["creation_time"]] + [bug["last_change_time"]] * (bug_id % 3)
+            comments[str(bug_id)] = {
+                "comments": [
+                    {
+                        "id": bug_id * 10 + count,
+                        "bug_id": bug_id,
+                        "count": count,
+                        "creator": bug["creator"],
+                        "creation_time": creation_time,
+                        "time": creation_time,
+                        "text": f"Comment {count} on bug {bug_id}",
+                        "is_private": False,
+                        "attachment_id": None,
+                        "tags": [],
+                    }
+                    for count, creation_time in enumerate(created)
+                    if creation_time > since
+                ]
+            }
+        return comments
+
+    def _products(self, params):
+        names = _list_param(params, "names")
+        return [
+            {
+                "id": product_id,
+                "name": name,
+                "components": [
+                    {
+                        "id": product_id * 100 + i,
+                        "name": component,
+                        "default_qa_contact": "",
+                        "is_active": True,
+                        "description": f"{name} :: {component}",
+                    }
+                    for i, component in enumerate(self.PRODUCTS[name])
+                ],
+            }
+            for product_id, name in enumerate(sorted(self.PRODUCTS), start=1)
+            if name in names
+        ]
+
+    def _search(self, params):
+        products = set(_list_param(params, "product"))
+        components = set(_list_param(params, "component"))
+        since = _first(params, "last_change_time")
+        chart = _parse_chart(params)
+
+        matches = [
+            bug
+            for bug in self.bugs
+            if (not products or bug["product"] in products)
+            and (not components or bug["component"] in components)
+            and (since is None or bug["last_change_time"] >= since)
+            and (chart is None or _evaluate(chart, bug))
+        ]
+
+        offset = int(_first(params, "offset") or 0)
+        limit = int(_first(params, "limit") or 0)
+        matches = matches[offset : offset + limit] if limit else matches[offset:]
+
+        fields = _list_param(params, "include_fields")
+        if fields:
+            matches = [{field: bug.get(field) for field in fields} for bug in matches]
+        return matches
+
+
+class MockCasa(MockUpstream):
+    """Stand-in for the projects and users endpoints of the Biztera CASA API."""
+
+    def __init__(self, rows: int = 1000, **kwargs):
+        kwargs.setdefault("etags", True)
+        super().__init__(**kwargs)
+        self.projects = [
+            {"id": i, "name": f"project_{i}", "status": "active"}
+            for i in range(1, rows + 1)
+        ]
+        self.users = [
+            {"id": i, "name": f"user_{i}", "email": f"user_{i}@example.com"}
+            for i in range(1, rows + 1)
+        ]
+
+    def secrets(self) -> Dict[str, Any]:
+        return {"access_token": "mock-token", "url": f"{self.url}/api/v1"}
+
+    def handle(self, path: str, params: Dict[str, List[str]]) -> Tuple[int, Any]:
+        limit = int(_first(params, "limit") or 100)
+        if path == "/api/v1/users":
+            offset = int(_first(params, "offset") or 0)
+            return 200, self.users[offset : offset + limit]
+        if path == "/api/v1/projects":
+            # bookmarks are the index of the next project
+            start = int(_first(params, "bookmark") or 0)
+            page = self.projects[start : start + limit]
+            metadata: Dict[str, Any] = {"totalCount": len(self.projects)}
+            if start + limit < len(self.projects):
+                metadata["nextPage"] = {"bookmark": str(start + limit)}
+            return 200, {"data": page, "metadata": metadata}
+        return 404, {"error": f"Unknown path {path}"}
+
+
+MOCK_UPSTREAMS = {
+    "bugzilla": MockBugzilla,
+    "casa": MockCasa,
+}
+
+
+def _first(params: Dict[str, List[str]], name: str) -> Optional[str]:
+    values = params.get(name)
+    return values[0] if values else None
+
+
+def _list_param(params: Dict[str, List[str]], name: str) -> List[str]:
+    """Return all values of a repeated or comma-separated parameter."""
+    return [
+        item
+        for value in params.get(name, [])
+        for item in (value.split(",") if name == "include_fields" else [value])
+    ]
+
+
+def _parse_chart(params):
+    """
+    Parse Bugzilla's custom search parameters (f1, o1, v1, j1, ...) into a tree.
+
+    Nodes are either ("cond", field, operator, value) or ("group", join, children).
+    """
+    indices = sorted(
+        int(key[1:]) for key in params if key.startswith("f") and key[1:].isdigit()
+    )
+    if not indices:
+        return None
+
+    root: Tuple[str, str, list] = ("group", _first(params, "j_top") or "AND", [])
+    stack = [root]
+    for i in indices:
+        field = _first(params, f"f{i}")
+        if field == "OP":
+            group: Tuple[str, str, list] = (
+                "group",
+                _first(params, f"j{i}") or "AND",
+                [],
+            )
+            stack[-1][2].append(group)
+            stack.append(group)
+        elif field == "CP":
+            stack.pop()
+        else:
+            stack[-1][2].append(
+                ("cond", field, _first(params, f"o{i}"), _first(params, f"v{i}"))
+            )
+    return root
+
+
+FIELDS = {
+    "delta_ts": "last_change_time",
+    "bug_id": "id",
+    "creation_ts": "creation_time",
+}
+
+
+def _evaluate(node, bug) -> bool:
+    if node[0] == "group":
+        _, join, children = node
+        results = (_evaluate(child, bug) for child in children)
+        return any(results) if join == "OR" else all(results)
+
+    _, field, operator, value = node
+    actual = bug[FIELDS.get(field, field)]
+    if isinstance(actual, int):
+        value = int(value)
+    return {
+        "equals": actual == value,
+        "notequals": actual != value,
+        "greaterthan": actual > value,
+        "greaterthaneq": actual >= value,
+        "lessthan": actual < value,
+        "lessthaneq": actual <= value,
+    }[operator]
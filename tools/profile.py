@@ -0,0 +1,146 @@
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import click
+
+from .runtime.profiling import (
+    DEFAULT_DIRECTORY,
+    DirectorySink,
+    ObjectStoreSink,
+    decode_artifact,
+)
+
+SORT_KEYS = {"tottime": 2, "cumtime": 3, "calls": 1}
+
+
+@dataclass
+class ProfileReport:
+    """Time per function and allocation sites merged across profiled invocations."""
+
+    invocations: int = 0
+    failed_invocations: int = 0
+    seconds: float = 0.0
+    # (file, line, function) -> [primitive calls, calls, self seconds, cumulative]
+    functions: Dict[Tuple[str, int, str], List[float]] = field(default_factory=dict)
+    # (file, line) -> [bytes, blocks, invocations]
+    allocations: Dict[Tuple[str, int], List[int]] = field(default_factory=dict)
+    peak_bytes: List[int] = field(default_factory=list)
+
+    def add(self, artifact: Dict):
+        self.invocations += 1
+        self.failed_invocations += artifact["failed"]
+        self.seconds += artifact["seconds"]
+        for filename, line, name, *totals in artifact["functions"]:
+            merged = self.functions.setdefault((filename, line, name), [0, 0, 0.0, 0.0])
+            for i, value in enumerate(totals):
+                merged[i] += value
+        for filename, line, size, count in artifact["allocations"]:
+            merged = self.allocations.setdefault((filename, line), [0, 0, 0])
+            merged[0] += size
+            merged[1] += count
+            merged[2] += 1
+        if artifact.get("peak_bytes") is not None:
+            self.peak_bytes.append(artifact["peak_bytes"])
+
+    def summary(self, top: int = 20, sort: str = "tottime") -> str:
+        if not self.invocations:
+            return "no profiles found"
+
+        lines = [
+            f"invocations:  {self.invocations} ({self.failed_invocations} failed)",
+            f"mean time:    {self.seconds / self.invocations * 1000:8.1f} ms",
+        ]
+        if self.peak_bytes:
+            lines.append(
+                f"max. peak:    {max(self.peak_bytes) / 2**20:8.1f} MB "
+                "(while tracing allocations)"
+            )
+
+        lines += [
+            "",
+            f"hot functions by {sort}, per invocation:",
+            f"  {'calls':>10} {'tottime ms':>11} {'cumtime ms':>11}  function",
+        ]
+        key = SORT_KEYS[sort]
+        hottest = sorted(self.functions.items(), key=lambda i: i[1][key], reverse=True)
+        for (filename, line, name), (_, calls, tottime, cumtime) in hottest[:top]:
+            lines.append(
+                f"  {calls / self.invocations:>10.0f}"
+                f" {tottime / self.invocations * 1000:>11.1f}"
+                f" {cumtime / self.invocations * 1000:>11.1f}"
+                f"  {_function_name(filename, line, name)}"
+            )
+
+        if self.allocations:
+            lines += [
+                "",
+                "top allocation sites at the end of invocations, per invocation:",
+                f"  {'KiB':>10} {'blocks':>10} {'seen':>6}  location",
+            ]
+            largest = sorted(
+                self.allocations.items(), key=lambda i: i[1][0], reverse=True
+            )
+            for (filename, line), (size, count, seen) in largest[:top]:
+                lines.append(
+                    f"  {size / self.invocations / 1024:>10.1f}"
+                    f" {count / self.invocations:>10.0f} {seen:>6}"
+                    f"  {filename}:{line}"
+                )
+        return "\n".join(lines)
+
+
+def _function_name(filename: str, line: int, name: str) -> str:
+    # built-in functions are reported with the file "~"
+    if filename == "~":
+        return name
+    return f"{filename}:{line}({name})"
+
+
+def open_sink(source: str):
+    """Return the sink for a directory or a `gs://bucket/prefix` URL."""
+    if source.startswith("gs://"):
+        bucket, _, prefix = source[len("gs://") :].partition("/")
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+        return ObjectStoreSink(bucket, prefix)
+    return DirectorySink(source)
+
+
+def merge_profiles(sink, names: Iterable[str]) -> ProfileReport:
+    report = ProfileReport()
+    for name in names:
+        report.add(decode_artifact(sink.read(name)))
+    return report
+
+
+@click.group(help="Commands for inspecting profiles of connector invocations.")
+def profile():
+    """Create the CLI group for the profile command."""
+    pass
+
+
+@profile.command(
+    name="show",
+    help="""Merge profiles of connector invocations and show where time and memory
+    are spent. SOURCE is the directory or gs://bucket/prefix URL they were written to.""",
+)
+@click.argument("source", default=DEFAULT_DIRECTORY)
+@click.option("--connector", "-c", help="Only show profiles of this connector")
+@click.option("--last", type=int, help="Only merge the last N profiles")
+@click.option("--top", default=20, help="Number of functions and allocation sites")
+@click.option(
+    "--sort",
+    type=click.Choice(sorted(SORT_KEYS)),
+    default="tottime",
+    help="Order of the functions",
+)
+def show(source: str, connector: Optional[str], last: Optional[int], top: int, sort):
+    sink = open_sink(source)
+    names = sink.names()
+    if connector is not None:
+        names = [name for name in names if name.startswith(f"{connector}/")]
+    # names start with the connector and the time of the invocation
+    names.sort(key=lambda name: name.rsplit("/", 1)[-1])
+    if last is not None:
+        names = names[-last:]
+    click.echo(merge_profiles(sink, names).summary(top, sort))
@@ -0,0 +1,140 @@
+"""
+Change detection for connectors that do a full import on every sync.
+
+Row hashes from the last complete sync are compared against the rows fetched in the
+current sync, so that only new or changed rows need to be sent to Fivetran and rows
+that disappeared upstream can be deleted.
+"""
+
+import json
+import os
+import shutil
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List
+
+from .hashing import row_hash
+
+# digest of a table: {"previous": {key: hash}, "current": {key: hash}}
+Digest = Dict[str, Dict[str, str]]
+
+STATE_KEY = "row_digests"
+
+
+class StateDigestStore:
+    """Keeps digests in the Fivetran state, which is limited in size."""
+
+    def __init__(self, state: Dict[str, Any], key: str = STATE_KEY):
+        self.key = key
+        self.digests: Dict[str, Digest] = dict(state.get(key) or {})
+
+    def load(self, table: str) -> Digest:
+        return self.digests.get(table, {})
+
+    def save(self, table: str, digest: Digest):
+        self.digests[table] = digest
+
+    def to_state(self) -> Dict[str, Any]:
+        """Return the entries that need to be added to the new state."""
+        return {self.key: self.digests}
+
+
+class LocalDigestStore:
+    """
+    Keeps digests in JSON files in a local directory.
+
+    Digests saved by an invocation are only staged under a generation that is added to
+    the state. They take effect once Fivetran sends that state with a later request,
+    which it only does after it committed the rows of the response, so a failed or
+    retried invocation can't make rows look unchanged that were never delivered.
+
+    On Cloud Functions the local file system only lives as long as the instance, so if
+    the digests are lost the next sync emits all rows again and no deletes.
+    """
+
+    def __init__(self, directory: str, state: Dict[str, Any], key: str = STATE_KEY):
+        self.directory = Path(directory)
+        self.key = key
+        self.generation = uuid.uuid4().hex
+        acknowledged = (state.get(key) or {}).get("generation")
+        staged = self.directory / "staged"
+        if acknowledged is not None and (staged / acknowledged).is_dir():
+            for path in (staged / acknowledged).glob("*.json"):
+                os.replace(path, self.directory / path.name)
+        # generations that were never acknowledged belong to failed invocations
+        shutil.rmtree(staged, ignore_errors=True)
+
+    def _path(self, table: str) -> Path:
+        return self.directory / f"{table}.json"
+
+    def load(self, table: str) -> Digest:
+        try:
+            return json.loads(self._path(table).read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save(self, table: str, digest: Digest):
+        path = self.directory / "staged" / self.generation / f"{table}.json"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(digest, separators=(",", ":")))
+        os.replace(tmp_path, path)
+
+    def to_state(self) -> Dict[str, Any]:
+        """Return the entries that need to be added to the new state."""
+        return {self.key: {"generation": self.generation}}
+
+
+class ChangeTracker:
+    """Tracks row hashes of one table across the pages of a full import."""
+
+    def __init__(self, table: str, store, primary_key: str = "id"):
+        self.table = table
+        self.store = store
+        self.primary_key = primary_key
+        digest = store.load(table)
+        self.previous = digest.get("previous", {})
+        self.current = digest.get("current", {})
+
+    def _key(self, row: Dict[str, Any]) -> str:
+        # keys are JSON-encoded so that they can be turned back into typed values
+        return json.dumps(row[self.primary_key])
+
+    def changed_rows(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Record the hashes of `rows` and return the rows that are new or changed."""
+        changed = []
+        for row in rows:
+            key = self._key(row)
+            digest = row_hash(row)
+            self.current[key] = digest
+            if self.previous.get(key) != digest:
+                changed.append(row)
+        return changed
+
+    def keep(self, keys: List[Any]):
+        """Record that the rows with primary keys `keys` exist and haven't changed."""
+        for key in keys:
+            key = json.dumps(key)
+            if key in self.previous:
+                self.current[key] = self.previous[key]
+
+    def finish(self) -> List[Dict[str, Any]]:
+        """
+        Complete the full import of the table and return delete entries.
+
+        Rows that were part of the previous full import but haven't been seen in this
+        one have been removed upstream.
+        """
+        deletes = [
+            {self.primary_key: json.loads(key)}
+            for key in self.previous
+            if key not in self.current
+        ]
+        self.previous = self.current
+        self.current = {}
+        return deletes
+
+    def save(self):
+        self.store.save(
+            self.table, {"previous": self.previous, "current": self.current}
+        )
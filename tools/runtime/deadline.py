@@ -0,0 +1,73 @@
+"""
+Time and size budget for fetching several pages within a single invocation.
+
+Returning after every upstream page costs a full round trip from Fivetran to the
+function per page. With a budget, connectors keep fetching pages until the next page
+would no longer fit into a fraction of the function timeout or the response would get
+too large, and then return all rows at once.
+"""
+
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+# timeout of deployed functions in seconds, see `TIMEOUT` in the Makefile
+DEFAULT_FUNCTION_TIMEOUT = 60
+# fraction of the function timeout that can be spent on fetching pages
+DEFAULT_FRACTION = 0.5
+# 1st gen Cloud Functions responses are limited to 10MB
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+
+
+class TimeBudget:
+    """Budget of an invocation that is shared by all streams fetching pages."""
+
+    def __init__(
+        self,
+        seconds: float,
+        max_bytes: Optional[int] = DEFAULT_MAX_BYTES,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._clock = clock
+        self._started = clock()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: Optional[Dict[str, Any]]) -> Optional["TimeBudget"]:
+        """
+        Create a budget from the `time_budget` connector setting.
+
+        Returns None if no budget is configured, in which case connectors return after
+        a single page.
+        """
+        if config is None:
+            return None
+        function_timeout = float(
+            config.get("function_timeout", DEFAULT_FUNCTION_TIMEOUT)
+        )
+        fraction = float(config.get("fraction", DEFAULT_FRACTION))
+        if not 0 < fraction < 1:
+            raise ValueError(f"Invalid time budget fraction: {fraction}")
+        return cls(
+            seconds=function_timeout * fraction,
+            max_bytes=int(config.get("max_bytes", DEFAULT_MAX_BYTES)),
+        )
+
+    def elapsed(self) -> float:
+        return self._clock() - self._started
+
+    def add_bytes(self, num_bytes: int):
+        """Record the size of rows that will be part of the response."""
+        with self._lock:
+            self.num_bytes += num_bytes
+
+    def allows_another_page(self, page_seconds: float, page_bytes: int = 0) -> bool:
+        """Check whether a page similar to the last one still fits into the budget."""
+        if self.elapsed() + page_seconds > self.seconds:
+            return False
+        if self.max_bytes is not None and self.num_bytes + page_bytes > self.max_bytes:
+            return False
+        return True
@@ -0,0 +1,27 @@
+"""Content fingerprints for detecting changes in synced data."""
+
+import hashlib
+import json
+from typing import Any
+
+
+def fingerprint(data: Any) -> str:
+    """
+    Return a stable hex digest of JSON-serializable `data`.
+
+    Keys are sorted so that the digest doesn't depend on dict ordering.
+    """
+    serialized = json.dumps(data, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.blake2b(serialized.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def row_hash(row: Any) -> str:
+    """
+    Return a short digest of a single row.
+
+    Digests are kept per row in the state, so they are truncated to keep the state
+    small. A collision makes a changed row look unchanged, so the change isn't sent,
+    but with 48 bits per row that is negligible for tables with up to millions of rows.
+    """
+    serialized = json.dumps(row, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.blake2b(serialized.encode("utf-8"), digest_size=6).hexdigest()
@@ -0,0 +1,121 @@
+"""
+Pooled HTTP sessions that are reused across invocations.
+
+Cloud Functions keep module state alive between requests served by a warm instance.
+Holding `requests.Session` objects at module scope lets subsequent Fivetran calls reuse
+open keep-alive connections instead of paying for a new TCP+TLS handshake per request.
+"""
+
+import threading
+from typing import Dict
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import metrics, ratelimit
+
+# number of per-host connection pools kept by each session
+POOL_CONNECTIONS = 4
+# number of connections kept alive per host, sized for concurrent requests
+POOL_MAXSIZE = 16
+# (connect, read) timeout in seconds used if a request doesn't specify one
+DEFAULT_TIMEOUT = (5, 30)
+
+DEFAULT_SESSION = "default"
+
+_sessions: Dict[str, requests.Session] = {}
+_lock = threading.Lock()
+
+
+# methods that are safe to send again after a 503, which may have been processed
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    HTTP adapter that applies a default timeout and rate limits to every request.
+
+    Throttled requests are retried after backing off, and requests to hosts with a
+    configured limiter (see `runtime.ratelimit`) are paced by it as well.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, rate_limit: bool = True, **kwargs):
+        self.timeout = timeout
+        self.rate_limit = rate_limit
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        if not self.rate_limit:
+            return super().send(request, **kwargs)
+
+        limiter = ratelimit.backoff_for(request.url)
+        attempt = 0
+        while True:
+            sent_at = limiter.acquire()
+            http_response = super().send(request, **kwargs)
+            status = http_response.status_code
+            if status not in ratelimit.THROTTLE_STATUSES:
+                limiter.on_success()
+                return http_response
+
+            limiter.on_throttle(sent_at)
+            delay = limiter.backoff(
+                attempt,
+                ratelimit.parse_retry_after(http_response.headers.get("Retry-After")),
+            )
+            retryable = status == 429 or request.method in IDEMPOTENT_METHODS
+            if delay is None or not retryable:
+                return http_response
+
+            current_metrics = metrics.active()
+            if current_metrics is not None:
+                current_metrics.record_retry(urlsplit(request.url).path)
+            http_response.close()
+            limiter.sleep(delay)
+            attempt += 1
+
+
+def create_session(
+    pool_connections: int = POOL_CONNECTIONS, pool_maxsize: int = POOL_MAXSIZE
+) -> requests.Session:
+    """Create a new session with tuned connection pools and keep-alive enabled."""
+    session = requests.Session()
+    adapter = PooledAdapter(
+        pool_connections=pool_connections, pool_maxsize=pool_maxsize
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # responses are decompressed transparently by urllib3
+    session.headers.update(
+        {"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"}
+    )
+    session.hooks["response"].append(metrics.record_response)
+    return session
+
+
+def get_session(name: str = DEFAULT_SESSION) -> requests.Session:
+    """
+    Return the module-level session registered under `name`, creating it if necessary.
+
+    Clients that modify session headers (e.g. python-bugzilla) should use their own
+    `name` so that those headers don't leak into requests made by other code.
+    """
+    session = _sessions.get(name)
+    if session is None:
+        with _lock:
+            session = _sessions.get(name)
+            if session is None:
+                session = create_session()
+                _sessions[name] = session
+    return session
+
+
+def close_sessions():
+    """Close all pooled sessions and drop their connections."""
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -0,0 +1,141 @@
+"""
+Local simulation of Fivetran syncs.
+
+Fivetran calls a connector's `main` repeatedly within a sync: the returned `state` is
+passed into the next call for as long as the connector responds with `hasMore`. Failed
+calls are retried with the last state that was returned successfully.
+"""
+
+import importlib.util
+import json
+import sys
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from types import ModuleType
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+@dataclass
+class FivetranRequest:
+    """Mimics the Flask request object passed to Cloud Functions."""
+
+    json: dict
+
+
+@dataclass
+class SyncReport:
+    """Statistics of a simulated sync."""
+
+    invocations: int = 0
+    failed_invocations: int = 0
+    rows: Counter = field(default_factory=Counter)
+    deletes: Counter = field(default_factory=Counter)
+    response_bytes: int = 0
+    wall_time: float = 0.0
+    state: Dict[str, Any] = field(default_factory=dict)
+    completed: bool = False
+
+    @property
+    def total_rows(self) -> int:
+        return sum(self.rows.values())
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.total_rows / self.wall_time if self.wall_time else 0.0
+
+    def summary(self) -> str:
+        lines = [
+            f"completed:      {self.completed}",
+            f"invocations:    {self.invocations} ({self.failed_invocations} failed)",
+            f"wall time:      {self.wall_time:.2f}s",
+            f"rows:           {self.total_rows} ({self.rows_per_second:.0f} rows/s)",
+            f"response bytes: {self.response_bytes}",
+        ]
+        lines += [
+            f"  {table}: {count} rows" for table, count in sorted(self.rows.items())
+        ]
+        lines += [
+            f"  {table}: {count} deletes"
+            for table, count in sorted(self.deletes.items())
+        ]
+        return "\n".join(lines)
+
+
+def load_connector_module(connector_path: Path) -> ModuleType:
+    """
+    Import the `main` module of the connector in `connector_path`.
+
+    Cloud Functions import `main.py` with the connector directory on the path, which
+    is what makes modules like the vendored `runtime` package importable.
+    """
+    sys.path.insert(0, str(connector_path))
+    spec = importlib.util.spec_from_file_location("main", connector_path / "main.py")
+    if spec is None or spec.loader is None:
+        raise FileNotFoundError(f"No main.py in {connector_path}")
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["main"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_connector_main(connector_path: Path) -> Callable:
+    """Import `main` of the connector in `connector_path`."""
+    return load_connector_module(connector_path).main
+
+
+def decode_response(result) -> Tuple[Dict[str, Any], int]:
+    """Turn a connector return value into the response dict and its size in bytes."""
+    if isinstance(result, tuple):
+        body = result[0]
+        return json.loads(body), len(body)
+    body = json.dumps(result, default=str).encode("utf-8")
+    return result, len(body)
+
+
+def run_sync(
+    main: Callable,
+    secrets: Dict[str, Any],
+    state: Optional[Dict[str, Any]] = None,
+    max_invocations: int = 10000,
+    max_retries: int = 3,
+) -> SyncReport:
+    """Drive `main` through a complete sync the way Fivetran does."""
+    report = SyncReport(state=dict(state or {}))
+    retries = 0
+    start = time.perf_counter()
+
+    while report.invocations < max_invocations:
+        request = FivetranRequest(
+            json={
+                "agent": "fivetran-connectors simulator",
+                "state": report.state,
+                "secrets": secrets,
+            }
+        )
+        report.invocations += 1
+        try:
+            response, num_bytes = decode_response(main(request))
+        except Exception as e:
+            report.failed_invocations += 1
+            retries += 1
+            print(f"Invocation {report.invocations} failed: {e}", file=sys.stderr)
+            if retries > max_retries:
+                break
+            continue
+
+        retries = 0
+        report.response_bytes += num_bytes
+        for table, rows in response.get("insert", {}).items():
+            report.rows[table] += len(rows)
+        for table, rows in response.get("delete", {}).items():
+            report.deletes[table] += len(rows)
+        report.state = response["state"]
+
+        if not response.get("hasMore"):
+            report.completed = True
+            break
+
+    report.wall_time = time.perf_counter() - start
+    return report
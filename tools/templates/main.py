@@ -1,9 +1,11 @@
-from typing import Any, Dict
+from runtime.metrics import instrumented
+from runtime.response import response
+from runtime.session import get_session
 
-import requests
 
-
-def main(request):
+# replace with the name of the connector, which identifies its metrics in the logs
+@instrumented("connector")
+def main(request, metrics):
     """
     Function to execute.
 
@@ -14,21 +16,20 @@ def main(request):
     """
     # add custom connector code
     config = request.json["secrets"]
-    pass
-
-
-def response(
-    state: Dict[str, Any],
-    schema: Dict[Any, Any],
-    inserts: Dict[Any, Any] = {},
-    deletes: Dict[Any, Any] = {},
-    has_more: bool = False,
-):
-    """Creates the response JSON object that will be processed by Fivetran."""
-    return {
-        "state": state,
-        "schema": schema,
-        "insert": inserts,
-        "delete": deletes,
-        "has_more": has_more,
-    }
+    state = request.json.get("state", {})
+
+    # time phases with e.g. `with metrics.phase("fetch"):`
+    with metrics.phase("serialize"):
+        return response(state=state, schema={}, inserts={}, hasMore=False)
+
+
+# Module state is kept across invocations of a warm instance. Create expensive objects
+# like API clients once (e.g. with `runtime.cache.TTLCache`) instead of per invocation,
+# and import heavy libraries that are only needed on some code paths where they are used.
+
+
+def _fetch(url, params=None):
+    """Fetch JSON data, reusing pooled connections across warm invocations."""
+    http_response = get_session().get(url, params=params)
+    http_response.raise_for_status()
+    return http_response.json()
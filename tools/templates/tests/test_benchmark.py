@@ -0,0 +1,46 @@
+import os
+from dataclasses import dataclass
+from pathlib import Path
+
+import main as connector
+import pytest
+
+BASELINE = Path(__file__).parent / "benchmarks" / "baseline.json"
+SIZES = [
+    int(size)
+    for size in os.environ.get("BENCHMARK_SIZES", "1000,10000,100000").split(",")
+]
+
+pytestmark = pytest.mark.skipif(
+    not os.environ.get("RUN_BENCHMARKS"), reason="set RUN_BENCHMARKS=1 to run"
+)
+
+
+@dataclass
+class FivetranRequest:
+    json: dict
+
+
+def synthetic_responder(rows):
+    def respond(url, params):
+        # replace with payloads resembling the responses of the upstream API
+        return [{"id": i, "name": f"row_{i}"} for i in range(rows)]
+
+    return respond
+
+
+class TestBenchmark:
+    @pytest.mark.parametrize("rows", SIZES)
+    def test_main(self, rows):
+        # the harness is part of the tools, installed by `./fivetran bootstrap`
+        from tools.benchmark_harness import compare_to_baseline, run_benchmark
+
+        fivetran_request = FivetranRequest(json={"secrets": {}, "state": {}})
+        results = run_benchmark(connector, fivetran_request, synthetic_responder(rows))
+        regressions = compare_to_baseline(
+            f"main_{rows}",
+            results,
+            BASELINE,
+            update=bool(os.environ.get("UPDATE_BENCHMARK_BASELINE")),
+        )
+        assert not regressions, regressions